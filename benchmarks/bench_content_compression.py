@@ -0,0 +1,82 @@
+"""
+Benchmarks the database size and CPU cost of compressing blog content.
+Run with: python3 benchmarks/bench_content_compression.py
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from blogdb import BlogDB
+
+WORDS = ('the blog post content is long form writing about movies books '
+         'and everything else that people want to say on the internet').split()
+
+
+def make_content(size):
+    """
+    Makes pseudo-random prose of roughly the given size
+    :param size: number of characters
+    :return: text of the content
+    """
+
+    words = []
+    length = 0
+
+    while length < size:
+        word = random.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+
+    return ' '.join(words)
+
+
+def run(threshold, contents):
+    """
+    Inserts and reads back the contents with the given threshold
+    :param threshold: compression threshold, or None for no compression
+    :param contents: list of blog contents
+    :return: tuple of file size, insert seconds and read seconds
+    """
+
+    db_fd, filename = tempfile.mkstemp()
+    db = BlogDB(filename, compress_threshold=threshold)
+    db.init_db()
+    db.insert_account('bench', 'bench')
+
+    started = time.perf_counter()
+    for content in contents:
+        db.insert_blog('title', content, 1)
+    insert_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    db.get_all_rows('blog')
+    read_time = time.perf_counter() - started
+
+    size = os.path.getsize(filename)
+
+    os.close(db_fd)
+    os.unlink(filename)
+
+    return size, insert_time, read_time
+
+
+def main():
+    random.seed(0)
+    contents = [make_content(random.choice((200, 2000, 20000)))
+                for _ in range(500)]
+
+    print('{:>10} {:>12} {:>12} {:>12}'.format('threshold', 'size (KB)',
+                                               'insert (s)', 'read (s)'))
+
+    for threshold in (None, 4096, 1024, 256):
+        size, insert_time, read_time = run(threshold, contents)
+        print('{:>10} {:>12.0f} {:>12.3f} {:>12.3f}'.format(
+            str(threshold), size / 1024, insert_time, read_time))
+
+
+if __name__ == '__main__':
+    main()
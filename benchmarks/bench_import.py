@@ -0,0 +1,47 @@
+"""
+Benchmarks how long the server entry point takes to import and create an
+app, and how much of that importing requests would add.
+Run with: python3 benchmarks/bench_import.py
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+TIMED = '''
+import time
+started = time.perf_counter()
+{}
+print((time.perf_counter() - started) * 1000)
+'''
+
+
+def import_time(code, runs=9):
+    """
+    Runs code in fresh interpreters and measures it
+    :param code: statements to time
+    :param runs: number of interpreters to start
+    :return: median milliseconds
+    """
+
+    times = []
+
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', TIMED.format(code)], cwd=ROOT)
+        times.append(float(output))
+
+    return statistics.median(times)
+
+
+def main():
+    print('import main, create_app(): {:.1f} ms'.format(
+        import_time('import main; main.create_app()')))
+    print('... plus import requests:  {:.1f} ms'.format(
+        import_time('import main; main.create_app(); import requests')))
+
+
+if __name__ == '__main__':
+    main()
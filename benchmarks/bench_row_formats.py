@@ -0,0 +1,74 @@
+"""
+Benchmarks the memory and time of reading a large listing as dictionaries,
+records and columns.
+Run with: python3 benchmarks/bench_row_formats.py
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from blogdb import BlogDB
+
+ROWS = 50000
+
+
+def fill(db):
+    """
+    Inserts ROWS blogs with short contents in a single transaction
+    :param db: BlogDB object
+    :return: None
+    """
+
+    db.init_db()
+    db.insert_account('bench', 'bench')
+    db._conn.executemany(
+        'INSERT INTO blog(title, content, author_id, time) VALUES (?,?,?,?)',
+        (('Blog {}'.format(i), 'Content of blog {}'.format(i), 1, 'now')
+         for i in range(ROWS)))
+    db._conn.commit()
+
+
+def run(db, row_format):
+    """
+    Reads every blog in the given row format
+    :param db: BlogDB object
+    :param row_format: 'dict', 'record' or 'columns'
+    :return: tuple of peak memory in bytes, memory still held by the
+    result in bytes, and seconds
+    """
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    rows = db.get_all_rows('blog', row_format=row_format)
+    elapsed = time.perf_counter() - started
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rows
+
+    return peak, held, elapsed
+
+
+def main():
+    db_fd, filename = tempfile.mkstemp()
+    db = BlogDB(filename)
+    fill(db)
+
+    print('{} blogs'.format(ROWS))
+    print('{:>10} {:>12} {:>12} {:>10}'.format('format', 'held (MB)',
+                                               'peak (MB)', 'read (s)'))
+
+    for row_format in BlogDB.ROW_FORMATS:
+        peak, held, elapsed = run(db, row_format)
+        print('{:>10} {:>12.1f} {:>12.1f} {:>10.3f}'.format(
+            row_format, held / 2 ** 20, peak / 2 ** 20, elapsed))
+
+    os.close(db_fd)
+    os.unlink(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmarks how long a new worker takes to render its first homepage, blog
+and author pages, without the template cache, with an empty cache and with
+a cache warmed by 'flask precompile-templates'.
+Run with: python3 benchmarks/bench_template_cold_start.py
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Runs in a fresh interpreter, like a new worker. Prints the milliseconds
+# spent loading and rendering the three templates for the first time.
+WORKER = '''
+import sys, time
+from jinja2 import FileSystemBytecodeCache
+import main
+
+cache_dir = sys.argv[1]
+app = main.create_app({'JOB_WORKERS': 0})
+app.jinja_env.bytecode_cache = \\
+    FileSystemBytecodeCache(cache_dir) if cache_dir else None
+
+blog = {'id': 1, 'title': 't', 'content': 'c', 'username': 'u',
+        'author_id': 1, 'time': 'now'}
+author = {'id': 1, 'username': 'u'}
+
+with app.test_request_context():
+    started = time.perf_counter()
+    main.render_template('homepage.html', blogs=[blog], author=author)
+    main.render_template('post.html', blog=blog, comments=[], author=author)
+    main.render_template('authors.html', blogs=[blog], authors=[author],
+                         author=author, top_author=author, menu_page=1,
+                         more_authors=False, following=False)
+    print((time.perf_counter() - started) * 1000)
+'''
+
+
+def first_render(cache_dir, runs=7):
+    """
+    Starts fresh interpreters and measures their first render
+    :param cache_dir: template cache folder, or '' for no cache
+    :param runs: number of interpreters to start
+    :return: median milliseconds
+    """
+
+    times = []
+
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', WORKER, cache_dir], cwd=ROOT)
+        times.append(float(output))
+
+    return statistics.median(times)
+
+
+def main():
+    print('no cache:    {:.2f} ms'.format(first_render('')))
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        print('cold cache:  {:.2f} ms'.format(first_render(cache_dir, 1)))
+        print('warm cache:  {:.2f} ms'.format(first_render(cache_dir)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,22 @@
+import gzip
 import hashlib
+import heapq
+import html
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import shutil
 import sqlite3
+import threading
 import time
+import urllib.parse
+import zlib
+
+import markdown
+from markdown.treeprocessors import Treeprocessor
 
 
 class BlogDB:
@@ -9,13 +25,106 @@ class BlogDB:
     blogs.
     """
 
-    def __init__(self, filename):
+    # Tables whose rows live in the shard files when sharding is enabled.
+    # Accounts always stay in the global database.
+    SHARDED_TABLES = ('blog', 'comment')
+
+    # Tables copied by export_rows() and import_rows(), in dependency order
+    TABLES = ('account', 'follow', 'blog', 'comment')
+
+    # Number of characters of content kept in a blog's excerpt
+    EXCERPT_LENGTH = 200
+
+    # Columns of account that may be returned outside of this class
+    PUBLIC_ACCOUNT_COLUMNS = ('id', 'username')
+
+    # Prefix of compressed blog content and rendered HTML. Compressed
+    # values are stored as BLOBs, so rows written as TEXT read back
+    # unchanged.
+    COMPRESSED_MARKER = b'zlib:'
+
+    # Version of render_markdown(), part of the rendered HTML cache keys so
+    # that HTML rendered by an older version is not served again
+    RENDER_VERSION = 2
+
+    # Number of digits of each comment id in a comment's path
+    PATH_DIGITS = 10
+
+    # Number of an author's latest blogs copied into a new follower's
+    # timeline
+    TIMELINE_BACKFILL = 50
+
+    # Methods that queued jobs may run, see enqueue()
+    JOB_KINDS = ('fan_out',)
+
+    # Number of authors kept in the cached author directory
+    AUTHOR_DIRECTORY_SIZE = 1000
+
+    # Number of ids bound in each IN (...) query, below SQLite's limit on
+    # the number of parameters of a statement
+    IDS_PER_QUERY = 500
+
+    # Representations of the rows of listings, see _collect_rows()
+    ROW_FORMATS = ('dict', 'record', 'columns')
+
+    # Values derived from each database file, such as the author directory,
+    # shared by every BlogDB of the process since one is created per
+    # request. Keyed by filename, then by name of the value, each stored
+    # with the cache_version it was computed at. The generation of a file
+    # is bumped whenever its cache is invalidated, so a value computed from
+    # data that changed meanwhile is not stored.
+    _caches = {}
+    _cache_generations = {}
+    _cache_lock = threading.Lock()
+
+    # Long-lived read-only connections used to notice commits to each
+    # database file by other connections, including other processes, and
+    # the last PRAGMA data_version each of them returned. See
+    # check_data_version().
+    _watchers = {}
+    _data_versions = {}
+    _watcher_lock = threading.Lock()
+
+    def __init__(self, filename, shards=None, replicas=None, read_only=False,
+                 compress_threshold=None, jobs=None, events=None,
+                 row_format='dict'):
         """
-        Creates a connection to the database stored at filename
+        Creates a connection to the database stored at filename. When shards
+        is given, blogs and comments are stored in the shard files and the
+        database at filename only holds accounts and the shard map.
         :param filename: the address of the database
+        :param shards: list of shard database addresses, or None to keep
+        everything in a single database
+        :param replicas: ReplicaSet of read-only snapshots of the database,
+        or None to serve all reads from the database itself
+        :param read_only: whether to open the database read-only
+        :param compress_threshold: size in bytes above which blog content is
+        stored compressed, or None to store it as text
+        :param jobs: JobQueue running the follow-up work of writes in the
+        background, or None to do it before the write method returns
+        :param events: EventBroker that insert_comment() publishes new
+        comments to, or None
+        :param row_format: how listings return their rows by default: 'dict'
+        for a list of dictionaries, 'record' for a list of Record objects
+        or 'columns' for a dictionary of lists, one per column
         """
+        if shards and replicas is not None:
+            raise ValueError('replicas are not supported with shards')
+        if row_format not in self.ROW_FORMATS:
+            raise ValueError('no such row format: {}'.format(row_format))
+
         self.filename = filename
+        self.shards = list(shards) if shards else []
+        self.replicas = replicas
+        self.read_only = read_only
+        self.compress_threshold = compress_threshold
+        self.jobs = jobs
+        self.events = events
+        self.row_format = row_format
+        self.last_write = None
+        self._pending_jobs = []
         self._conn = self.connect_db()
+        self._shard_conns = {}
 
     def connect_db(self):
         """
@@ -24,21 +133,507 @@ class BlogDB:
         database file
         """
 
-        conn = sqlite3.connect(self.filename)
+        if self.read_only:
+            uri = 'file:{}?mode=ro'.format(urllib.parse.quote(self.filename))
+            conn = sqlite3.connect(uri, uri=True)
+        else:
+            conn = sqlite3.connect(self.filename)
         conn.row_factory = sqlite3.Row
 
         return conn
 
+    def reader(self, since=None):
+        """
+        Gets the database that read-only requests should be served from. This
+        is a snapshot when replicas are configured and one is recent enough,
+        otherwise the database itself. A BlogDB that has written always reads
+        from itself so it sees its own writes.
+        :param since: time of the caller's last write, or None
+        :return: a BlogDB object
+        """
+
+        if self.replicas is None or self.last_write is not None:
+            return self
+
+        path = self.replicas.snapshot(since)
+
+        if path is None:
+            return self
+
+        return BlogDB(path, read_only=True)
+
+    def close(self):
+        """
+        Closes the connections to the database and its shards
+        :return: None
+        """
+
+        self._conn.close()
+
+        for conn in self._shard_conns.values():
+            conn.close()
+
+        self._shard_conns = {}
+
+    def _note_write(self):
+        """
+        Records that a write was committed so replicas can be refreshed
+        :return: None
+        """
+
+        self.last_write = time.time()
+
+        if self.replicas is not None:
+            self.replicas.note_write()
+
+    def connect_shard(self, index):
+        """
+        Connects sqlite object with one of the shard databases. The global
+        database is attached so that queries on the shard can still join
+        blogs and comments with their accounts.
+        :param index: index of the shard in self.shards
+        :return: an sqlite connection object associated with the shard
+        """
+
+        if index not in self._shard_conns:
+            conn = sqlite3.connect(self.shards[index])
+            conn.row_factory = sqlite3.Row
+            conn.execute('ATTACH DATABASE ? AS global_db', (self.filename,))
+            self._shard_conns[index] = conn
+
+        return self._shard_conns[index]
+
+    def shard_for_author(self, author_id):
+        """
+        Gets the shard that new blogs of an author are written to
+        :param author_id: ID of the author
+        :return: index of the shard
+        """
+
+        return int(author_id) % len(self.shards)
+
+    def get_shard(self, table_name, item_id):
+        """
+        Gets the shard a row of a sharded table belongs on. Rows written
+        before ids were allocated per shard, and imported rows, are looked
+        up in the shard map. Other rows are on the shard whose index is
+        their id modulo the number of shards, see _new_row(). The row may
+        not exist.
+        :param table_name: 'blog' or 'comment'
+        :param item_id: id of the row
+        :return: index of the shard
+        """
+
+        cur = self._conn.cursor()
+
+        query = 'SELECT shard FROM {}_shard WHERE id = ?'.format(table_name)
+
+        cur.execute(query, (item_id,))
+
+        row = cur.fetchone()
+
+        if row is not None:
+            return row['shard']
+
+        return int(item_id) % len(self.shards)
+
+    def _conn_for(self, table_name, item_id):
+        """
+        Gets the connection a row belongs on. The row may not exist.
+        :param table_name: name of the table
+        :param item_id: id of the row
+        :return: an sqlite connection object
+        """
+
+        if not self.shards or table_name not in self.SHARDED_TABLES:
+            return self._conn
+
+        return self.connect_shard(self.get_shard(table_name, item_id))
+
+    def _data_conns(self):
+        """
+        Gets the connections holding blogs and comments
+        :return: list of sqlite connection objects
+        """
+
+        if not self.shards:
+            return [self._conn]
+
+        return [self.connect_shard(i) for i in range(len(self.shards))]
+
+    def _new_row(self, table_name, shard):
+        """
+        Gets the connection a new blog or comment should be written to, along
+        with the SQL expression of its id and the expression's parameters.
+        Outside sharded mode the id is NULL so sqlite picks it. In sharded
+        mode the id is the first one above every id used so far whose
+        remainder modulo the number of shards is the shard's index. Shards
+        never pick the same id, so ids are unique without writing to the
+        global database, and they still grow in the order rows are written.
+        The shard's own highest id is read by the INSERT itself, under the
+        shard's write lock; other shards and the shard map, which holds the
+        ids handed out before, are only read.
+        :param table_name: 'blog' or 'comment'
+        :param shard: index of the shard the row goes to
+        :return: tuple of the sqlite connection, the SQL expression of the
+        new id and its parameters
+        """
+
+        if not self.shards:
+            return self._conn, '?', (None,)
+
+        query = 'SELECT MAX(id) FROM main.{}'.format(table_name)
+        highest = [self.connect_shard(i).execute(query).fetchone()[0] or 0
+                   for i in range(len(self.shards)) if i != shard]
+
+        query = 'SELECT MAX(id) FROM {}_shard'.format(table_name)
+        highest.append(self._conn.execute(query).fetchone()[0] or 0)
+
+        count = len(self.shards)
+        expression = '''
+        (SELECT highest + 1 + ((? - highest - 1) % ? + ?) % ?
+         FROM (SELECT MAX(?, IFNULL(MAX(id), 0)) AS highest FROM main.{}))
+        '''.format(table_name)
+
+        return (self.connect_shard(shard), expression,
+                (shard, count, count, count, max(highest)))
+
+    def _commit(self, conn):
+        """
+        Commits a write to a data connection, then the global database which
+        may hold its feed, timeline or job rows. The two commits are not
+        atomic, so a crash in between keeps the row without those.
+        :param conn: the sqlite connection written to
+        :return: None
+        """
+
+        conn.commit()
+
+        if conn is not self._conn:
+            self._conn.commit()
+
+    def _merge_shards(self, query, params=(), reverse=False):
+        """
+        Runs a query ordered by id on every shard and merges the results
+        into a single list ordered by id.
+        :param query: SQL query ordered by id
+        :param params: parameters of the query
+        :param reverse: whether the query is in descending order of id
+        :return: list of dictionaries representing the rows
+        """
+
+        cursors = [conn.execute(query, params) for conn in self._data_conns()]
+
+        results = []
+
+        for row in heapq.merge(*cursors, key=lambda r: r['id'],
+                               reverse=reverse):
+            results.append(self._to_dict(row))
+
+        return results
+
+    def _select_list(self, table_name, fields, allowed=None):
+        """
+        Builds the list of columns of a SELECT statement from the fields a
+        caller asked for, so that only those columns are read.
+        :param table_name: name of the table
+        :param fields: list of column names, or None for all columns.
+        Raises ValueError if it is empty.
+        :param allowed: columns the caller may ask for, or None for all of
+        the table's columns
+        :return: SQL column list
+        """
+
+        if fields is None:
+            return '*' if allowed is None else ', '.join(allowed)
+
+        if not fields:
+            raise ValueError('no fields given')
+
+        if allowed is None:
+            allowed = self.get_columns(table_name)
+
+        for field in fields:
+            if field not in allowed:
+                raise ValueError('unknown field {}'.format(field))
+
+        return ', '.join(fields)
+
+    @classmethod
+    def make_excerpt(cls, content):
+        """
+        Gets the excerpt of blog content shown in listings
+        :param content: text of the blog
+        :return: first EXCERPT_LENGTH characters of the content
+        """
+
+        return content[:cls.EXCERPT_LENGTH]
+
+    def compress_content(self, content):
+        """
+        Compresses blog content if it is larger than the compression
+        threshold and compressing makes it smaller
+        :param content: text of the blog
+        :return: the text, or the compressed content as bytes
+        """
+
+        if self.compress_threshold is None or content is None:
+            return content
+
+        data = content.encode()
+
+        if len(data) < self.compress_threshold:
+            return content
+
+        compressed = self.COMPRESSED_MARKER + zlib.compress(data)
+
+        if len(compressed) >= len(data):
+            return content
+
+        return compressed
+
+    @classmethod
+    def decompress_content(cls, content):
+        """
+        Reverses compress_content(). Text is returned unchanged.
+        :param content: content as stored in the database
+        :return: text of the content
+        """
+
+        if isinstance(content, bytes) \
+                and content.startswith(cls.COMPRESSED_MARKER):
+            marker_size = len(cls.COMPRESSED_MARKER)
+            return zlib.decompress(content[marker_size:]).decode()
+
+        return content
+
+    @classmethod
+    def content_hash(cls, content):
+        """
+        Gets the key of content in the rendered HTML cache
+        :param content: Markdown text
+        :return: hex digest of the content and RENDER_VERSION
+        """
+
+        return hashlib.sha256('{}:{}'.format(
+            cls.RENDER_VERSION, content).encode()).hexdigest()
+
+    @staticmethod
+    def render_markdown(content):
+        """
+        Renders Markdown to HTML. Raw HTML in the content is escaped rather
+        than passed through, and link and image URLs with a scheme other
+        than those in SafeUrlTreeprocessor.SCHEMES are dropped, so the
+        result is safe to put in a page.
+        :param content: Markdown text
+        :return: HTML string
+        """
+
+        md = markdown.Markdown()
+        md.preprocessors.deregister('html_block')
+        md.inlinePatterns.deregister('html')
+        # Runs last, after escaped characters in URLs are restored
+        md.treeprocessors.register(SafeUrlTreeprocessor(md), 'safe_urls', -1)
+
+        return md.convert(content)
+
+    def _store_rendered(self, content):
+        """
+        Renders content and stores it in the rendered HTML cache, unless the
+        same content was rendered before. The HTML is compressed like blog
+        content. Called by the methods that write blogs and comments; the
+        caller commits.
+        :param content: Markdown text
+        :return: HTML string
+        """
+
+        cur = self._conn.cursor()
+
+        key = self.content_hash(content)
+
+        cur.execute('SELECT html FROM rendered WHERE hash = ?', (key,))
+
+        row = cur.fetchone()
+
+        if row is not None:
+            return self.decompress_content(row['html'])
+
+        html = self.render_markdown(content)
+
+        cur.execute('INSERT OR IGNORE INTO rendered(hash, html) VALUES(?, ?)',
+                    (key, self.compress_content(html)))
+
+        return html
+
+    def prune_rendered(self, batch_size=500):
+        """
+        Deletes the rendered HTML of contents that no blog or comment has
+        anymore, such as edited or deleted ones or those rendered by an
+        older RENDER_VERSION. The cache otherwise only grows.
+        :param batch_size: number of rows read and deleted at a time
+        :return: number of rendered HTML entries deleted
+        """
+
+        live = set()
+        for table_name in self.SHARDED_TABLES:
+            for row in self.iter_rows(table_name, batch_size, ['content']):
+                live.add(self.content_hash(row['content']))
+
+        stale = []
+        query = 'SELECT hash FROM rendered'
+        for rows in self._iter_batches(self._conn, query,
+                                       batch_size=batch_size):
+            stale.extend(row['hash'] for row in rows
+                         if row['hash'] not in live)
+
+        for start in range(0, len(stale), batch_size):
+            batch = stale[start:start + batch_size]
+            self._conn.executemany('DELETE FROM rendered WHERE hash = ?',
+                                   [(key,) for key in batch])
+            self._conn.commit()
+
+        return len(stale)
+
+    def get_rendered_html(self, contents):
+        """
+        Gets the HTML of blog or comment contents from the rendered HTML
+        cache with one query per IDS_PER_QUERY contents. Content written
+        before the cache existed is rendered on the spot, and stored unless
+        the database is read-only.
+        :param contents: list of Markdown texts
+        :return: list of HTML strings in the same order
+        """
+
+        keys = [self.content_hash(content) for content in contents]
+        unique_keys = list(set(keys))
+        rendered = {}
+
+        for start in range(0, len(unique_keys), self.IDS_PER_QUERY):
+            chunk = unique_keys[start:start + self.IDS_PER_QUERY]
+            query = 'SELECT hash, html FROM rendered WHERE hash IN ({})'
+            query = query.format(', '.join('?' * len(chunk)))
+
+            for row in self._conn.execute(query, chunk):
+                rendered[row['hash']] = self.decompress_content(row['html'])
+
+        missing = False
+
+        for key, content in zip(keys, contents):
+            if key not in rendered:
+                missing = True
+                if self.read_only:
+                    rendered[key] = self.render_markdown(content)
+                else:
+                    rendered[key] = self._store_rendered(content)
+
+        if missing and not self.read_only:
+            self._conn.commit()
+
+        return [rendered[key] for key in keys]
+
+    @classmethod
+    def comment_path(cls, parent_path, comment_id):
+        """
+        Builds the materialized path of a comment: the zero-padded ids of
+        its ancestors and itself, each followed by '/'. Sorting comments by
+        path lists every reply right after its parent, and the replies to a
+        comment are the comments whose path starts with its path.
+        :param parent_path: path of the parent comment, or '' for a comment
+        on the blog itself
+        :param comment_id: ID of the comment
+        :return: path string
+        """
+
+        return '{}{:0{}d}/'.format(parent_path, comment_id, cls.PATH_DIGITS)
+
+    def _to_dict(self, row):
+        """
+        Converts a row to a dictionary, decompressing its content if the row
+        has any. Queries that do not select content skip the decompression.
+        :param row: sqlite3.Row object
+        :return: dictionary representing the row
+        """
+
+        item = dict(row)
+
+        if 'content' in item:
+            item['content'] = self.decompress_content(item['content'])
+
+        return item
+
+    def _collect_rows(self, rows, columns, row_format=None, skip=0):
+        """
+        Builds the result of a listing from its rows, decompressing their
+        content. Records and columns avoid the memory overhead of a
+        dictionary per row for large listings that are only iterated or
+        serialized.
+        :param rows: iterable of sqlite3.Row objects
+        :param columns: list of the names of the rows' columns
+        :param row_format: 'dict', 'record' or 'columns', or None for the
+        row format of the database. Raises ValueError for any other format.
+        :param skip: number of leading columns left out of the result
+        :return: list of dictionaries, list of Record objects, or dictionary
+        mapping each column name to the list of its values
+        """
+
+        row_format = row_format or self.row_format
+        if row_format not in self.ROW_FORMATS:
+            raise ValueError('no such row format: {}'.format(row_format))
+
+        names = tuple(columns[skip:])
+        content = names.index('content') if 'content' in names else None
+
+        if row_format == 'columns':
+            values = [[] for _ in names]
+            for row in rows:
+                for column, value in zip(values, row[skip:]):
+                    column.append(value)
+            if content is not None:
+                values[content] = [self.decompress_content(value)
+                                   for value in values[content]]
+            return dict(zip(names, values))
+
+        if row_format == 'record':
+            make = Record.for_columns(names)
+        else:
+            def make(*values):
+                return dict(zip(names, values))
+
+        results = []
+        for row in rows:
+            values = row[skip:]
+            if content is not None:
+                values = list(values)
+                values[content] = self.decompress_content(values[content])
+            results.append(make(*values))
+
+        return results
+
     def init_db(self):
         """
         Initializes blog database
         :return: None
         """
 
-        blog_sql = '''
+        account_sql = '''
         DROP TABLE IF EXISTS account;
         CREATE TABLE account(id INTEGER PRIMARY KEY, username TEXT UNIQUE,
                              password TEXT);
+        DROP TABLE IF EXISTS rendered;
+        DROP TABLE IF EXISTS follow;
+        DROP TABLE IF EXISTS timeline;
+        DROP TABLE IF EXISTS jobs;
+        DROP TABLE IF EXISTS feed;
+        '''
+
+        shard_map_sql = '''
+        DROP TABLE IF EXISTS blog_shard;
+        CREATE TABLE blog_shard(id INTEGER PRIMARY KEY, shard INTEGER);
+        DROP TABLE IF EXISTS comment_shard;
+        CREATE TABLE comment_shard(id INTEGER PRIMARY KEY, shard INTEGER);
+        '''
+
+        blog_sql = '''
         DROP TABLE IF EXISTS blog;
         CREATE TABLE blog(id INTEGER PRIMARY KEY, title TEXT, 
                           content TEXT, author_id INTEGER, time TEXT,
@@ -50,7 +645,505 @@ class BlogDB:
                              FOREIGN KEY(author_id) REFERENCES account(id));
         '''
 
-        self._conn.cursor().executescript(blog_sql)
+        self._conn.cursor().executescript(account_sql)
+
+        if self.shards:
+            self._conn.cursor().executescript(shard_map_sql)
+
+            # Shards are initialized without the global database attached,
+            # so DROP TABLE can never reach the global database's tables.
+            for shard in self.shards:
+                conn = sqlite3.connect(shard)
+                conn.executescript(blog_sql)
+                conn.close()
+        else:
+            self._conn.cursor().executescript(blog_sql)
+
+        self.upgrade_db()
+
+    def upgrade_db(self):
+        """
+        Adds the tables and columns introduced after the original schema to
+        an existing database. Running it again changes nothing. init_db()
+        runs it on new databases.
+        :return: None
+        """
+
+        global_sql = '''
+        CREATE TABLE IF NOT EXISTS rendered(hash TEXT PRIMARY KEY, html TEXT)
+            WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS follow(
+            follower_id INTEGER, followee_id INTEGER,
+            PRIMARY KEY(follower_id, followee_id)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS follow_followee
+            ON follow(followee_id, follower_id);
+        CREATE TABLE IF NOT EXISTS timeline(
+            account_id INTEGER, blog_id INTEGER, author_id INTEGER,
+            PRIMARY KEY(account_id, blog_id)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS timeline_blog ON timeline(blog_id);
+        CREATE TABLE IF NOT EXISTS jobs(
+            id INTEGER PRIMARY KEY, kind TEXT, payload TEXT,
+            attempts INTEGER DEFAULT 0, run_at REAL, claimed_until REAL,
+            error TEXT);
+        CREATE INDEX IF NOT EXISTS jobs_run_at ON jobs(run_at);
+        CREATE TABLE IF NOT EXISTS feed(
+            blog_id INTEGER PRIMARY KEY, title TEXT, excerpt TEXT,
+            author_id INTEGER, username TEXT, time TEXT,
+            comment_count INTEGER DEFAULT 0);
+        CREATE INDEX IF NOT EXISTS feed_author ON feed(author_id);
+        CREATE TABLE IF NOT EXISTS cache_version(
+            name TEXT PRIMARY KEY, version INTEGER NOT NULL) WITHOUT ROWID;
+        '''
+
+        blog_index_sql = '''
+        CREATE INDEX IF NOT EXISTS blog_author ON blog(author_id, id);
+        '''
+
+        # Comments written before threading are replies to the blog itself
+        comment_sql = '''
+        UPDATE comment SET path = printf('%0{}d/', id) WHERE path IS NULL;
+        CREATE INDEX IF NOT EXISTS comment_thread ON comment(blog_id, path);
+        '''.format(self.PATH_DIGITS)
+
+        tables = [row['name'] for row in self._conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")]
+        has_feed = 'feed' in tables
+        has_timeline = 'timeline' in tables
+
+        self._conn.cursor().executescript(global_sql)
+
+        for conn in self._data_conns():
+            columns = [row['name'] for row in
+                       conn.execute('PRAGMA main.table_info(blog)')]
+
+            if 'excerpt' not in columns:
+                conn.execute('ALTER TABLE blog ADD COLUMN excerpt TEXT')
+                conn.commit()
+
+            self._fill_excerpts(conn)
+            conn.executescript(blog_index_sql)
+
+            columns = [row['name'] for row in
+                       conn.execute('PRAGMA main.table_info(comment)')]
+
+            if 'path' not in columns:
+                conn.execute('ALTER TABLE comment ADD COLUMN parent_id '
+                             'INTEGER REFERENCES comment(id)')
+                conn.execute('ALTER TABLE comment ADD COLUMN path TEXT')
+
+            conn.executescript(comment_sql)
+
+        if not has_feed:
+            self.rebuild_feed()
+
+        if not has_timeline:
+            self._fill_own_timelines()
+
+        self._touch_cache('author_directory')
+        self._conn.commit()
+        self.invalidate_caches(self.filename)
+
+    def rebuild_feed(self, batch_size=500):
+        """
+        Fills the feed table from the blogs, comments and accounts. Write
+        methods keep it up to date afterwards, so this is only needed for
+        blogs written before the table existed or imported.
+        :param batch_size: number of blogs read and written at a time
+        :return: None
+        """
+
+        select_query = '''
+        SELECT blog.id, title, excerpt, author_id, username, time,
+               (SELECT COUNT(*) FROM comment WHERE comment.blog_id = blog.id)
+        FROM blog LEFT JOIN account ON account.id = blog.author_id
+        '''
+        insert_query = '''
+        INSERT INTO feed(blog_id, title, excerpt, author_id, username, time,
+                         comment_count)
+        VALUES(?, ?, ?, ?, ?, ?, ?)
+        '''
+
+        self._conn.execute('DELETE FROM feed')
+
+        for conn in self._data_conns():
+            for rows in self._iter_batches(conn, select_query,
+                                           batch_size=batch_size):
+                self._conn.executemany(insert_query,
+                                       [tuple(row) for row in rows])
+
+        self._conn.commit()
+
+    def _fill_own_timelines(self, batch_size=500):
+        """
+        Copies the blogs written before timelines existed into their
+        authors' timelines. Nobody followed anyone yet, so these are the
+        only timeline rows there should be.
+        :param batch_size: number of blogs read and written at a time
+        :return: None
+        """
+
+        select_query = 'SELECT author_id, id, author_id FROM blog'
+        insert_query = '''
+        INSERT OR IGNORE INTO timeline(account_id, blog_id, author_id)
+        VALUES(?, ?, ?)
+        '''
+
+        for conn in self._data_conns():
+            for rows in self._iter_batches(conn, select_query,
+                                           batch_size=batch_size):
+                self._conn.executemany(insert_query,
+                                       [tuple(row) for row in rows])
+                self._conn.commit()
+
+    def rebuild_timelines(self, batch_size=500):
+        """
+        Fills the timeline table from the blogs and follows: every author's
+        own blogs, and the latest TIMELINE_BACKFILL blogs of each author an
+        account follows, as follow() copies them. Write methods keep it up
+        to date afterwards, so this is only needed after importing rows.
+        :param batch_size: number of followers written at a time
+        :return: None
+        """
+
+        blogs_query = '''
+        SELECT id FROM blog WHERE author_id = ? ORDER BY id DESC LIMIT ?
+        '''
+        followers_query = '''
+        SELECT follower_id FROM follow WHERE followee_id = ?
+        '''
+        insert_query = '''
+        INSERT OR IGNORE INTO timeline(account_id, blog_id, author_id)
+        VALUES(?, ?, ?)
+        '''
+
+        self._conn.execute('DELETE FROM timeline')
+        self._conn.commit()
+
+        self._fill_own_timelines(batch_size)
+
+        followees = [row['followee_id'] for row in self._conn.execute(
+            'SELECT DISTINCT followee_id FROM follow')]
+
+        for followee_id in followees:
+            if self.shards:
+                conn = self.connect_shard(self.shard_for_author(followee_id))
+            else:
+                conn = self._conn
+
+            blog_ids = [row['id'] for row in conn.execute(
+                blogs_query, (followee_id, self.TIMELINE_BACKFILL))]
+
+            for rows in self._iter_batches(self._conn, followers_query,
+                                           (followee_id,),
+                                           batch_size=batch_size):
+                self._conn.executemany(insert_query,
+                                       [(row['follower_id'], blog_id,
+                                         followee_id)
+                                        for row in rows
+                                        for blog_id in blog_ids])
+                self._conn.commit()
+
+    def _fill_excerpts(self, conn, batch_size=500):
+        """
+        Computes the excerpt of blogs written before excerpts existed
+        :param conn: sqlite connection holding blogs
+        :param batch_size: number of blogs updated per transaction
+        :return: None
+        """
+
+        select_query = '''
+        SELECT id, content FROM blog WHERE excerpt IS NULL AND id > ?
+        ORDER BY id LIMIT ?
+        '''
+        update_query = 'UPDATE blog SET excerpt = ? WHERE id = ?'
+
+        last_id = 0
+
+        while True:
+            rows = conn.execute(select_query,
+                                (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for row in rows:
+                content = self.decompress_content(row['content']) or ''
+                updates.append((self.make_excerpt(content), row['id']))
+
+            conn.executemany(update_query, updates)
+            conn.commit()
+
+            last_id = rows[-1]['id']
+
+    def backup(self, target, pages=64, sleep=0.01, compress=False,
+               progress=None):
+        """
+        Copies the database to target while it is in use, with the sqlite3
+        online backup API. Pages are copied a few at a time with a sleep in
+        between, so writers keep making progress during the backup. In
+        sharded mode the shards are copied to target.shard0, target.shard1,
+        ...
+        :param target: address of the backup file
+        :param pages: number of pages copied per step
+        :param sleep: seconds to sleep between steps
+        :param compress: whether to gzip the backup
+        :param progress: function called with the remaining and total number
+        of pages after each step, or None
+        :return: dictionary with the number of pages copied, the duration in
+        seconds and the number of pages copied per second
+        """
+
+        started = time.time()
+
+        copied = self._backup_conn(self._conn, target, pages, sleep, compress,
+                                   progress)
+
+        for i in range(len(self.shards)):
+            copied += self._backup_conn(self.connect_shard(i),
+                                        '{}.shard{}'.format(target, i),
+                                        pages, sleep, compress, progress)
+
+        duration = time.time() - started
+
+        return {
+            'pages': copied,
+            'duration': duration,
+            'pages_per_second': copied / duration if duration > 0 else 0.0,
+        }
+
+    @staticmethod
+    def _backup_conn(conn, target, pages, sleep, compress, progress):
+        """
+        Copies the main database of a connection to target, see backup()
+        :return: number of pages copied
+        """
+
+        total = [0]
+
+        def step(status, remaining, count):
+            total[0] = count
+            if progress is not None:
+                progress(remaining, count)
+            if remaining and sleep:
+                time.sleep(sleep)
+
+        # A compressed backup is copied to a temporary file first, then
+        # streamed through gzip so it is never held in memory
+        path = target + '.tmp' if compress else target
+
+        dst = sqlite3.connect(path)
+        try:
+            conn.backup(dst, pages=pages, progress=step)
+        finally:
+            dst.close()
+
+        if compress:
+            with open(path, 'rb') as src, gzip.open(target, 'wb') as out:
+                shutil.copyfileobj(src, out, 1 << 20)
+            os.remove(path)
+
+        return total[0]
+
+    def export_rows(self, out, batch_size=500, progress=None):
+        """
+        Writes every row of every table to out as newline-delimited JSON,
+        one object with 'table' and 'row' keys per line. Rows are fetched
+        batch_size at a time so memory use does not grow with the database.
+        :param out: text file object to write to
+        :param batch_size: number of rows fetched at a time
+        :param progress: function called with the number of rows written so
+        far after each batch and at the end of each table, or None. It is
+        only called when the number changed since its last call.
+        :return: number of rows written
+        """
+
+        count = 0
+        reported = 0
+
+        for table_name in self.TABLES:
+            for row in self.iter_rows(table_name, batch_size):
+                out.write(json.dumps({'table': table_name, 'row': row}))
+                out.write('\n')
+
+                count += 1
+                if progress is not None and count % batch_size == 0:
+                    progress(count)
+                    reported = count
+
+            if progress is not None and count != reported:
+                progress(count)
+                reported = count
+
+        return count
+
+    def import_rows(self, src, batch_size=500, progress=None):
+        """
+        Reads rows written by export_rows() from src and inserts them with
+        their ids, batch_size rows per transaction. Lines are parsed one at a
+        time so memory use does not grow with the input. The feed and the
+        timelines are rebuilt from the imported rows afterwards.
+        :param src: text file object to read from
+        :param batch_size: number of rows inserted per transaction
+        :param progress: function called with the number of rows inserted so
+        far after each batch, or None
+        :return: number of rows inserted
+        """
+
+        count = 0
+        table_name = None
+        batch = []
+
+        for line in src:
+            if not line.strip():
+                continue
+
+            item = json.loads(line)
+
+            # Batches never mix tables so each is a single executemany()
+            if batch and (item['table'] != table_name
+                          or len(batch) >= batch_size):
+                count += self._insert_rows(table_name, batch)
+                batch = []
+                if progress is not None:
+                    progress(count)
+
+            table_name = item['table']
+            batch.append(item['row'])
+
+        if batch:
+            count += self._insert_rows(table_name, batch)
+            if progress is not None:
+                progress(count)
+
+        self.rebuild_feed()
+        self.rebuild_timelines()
+        self._touch_cache('author_directory')
+        self._conn.commit()
+        self.invalidate_caches(self.filename)
+
+        return count
+
+    def get_columns(self, table_name):
+        """
+        Gets the names of the columns of a table
+        :param table_name: name of the table
+        :return: list of column names
+        """
+
+        if table_name not in self.TABLES:
+            raise ValueError('unknown table {}'.format(table_name))
+
+        if self.shards and table_name in self.SHARDED_TABLES:
+            conn = self.connect_shard(0)
+        else:
+            conn = self._conn
+
+        cur = conn.execute('PRAGMA main.table_info({})'.format(table_name))
+
+        return [row['name'] for row in cur]
+
+    def _insert_rows(self, table_name, rows):
+        """
+        Inserts rows of a table keeping their ids, with one executemany()
+        and one commit per database written to.
+        :param table_name: name of the table
+        :param rows: list of dictionaries representing the rows
+        :return: number of rows inserted
+        """
+
+        if table_name == 'blog':
+            for row in rows:
+                if 'content' in row:
+                    if row.get('excerpt') is None:
+                        row['excerpt'] = self.make_excerpt(row['content'])
+                    row['content'] = self.compress_content(row['content'])
+
+        if table_name == 'comment':
+            for row in rows:
+                if row.get('path') is None:
+                    row['path'] = self.comment_path('', row['id'])
+
+        columns = list(rows[0].keys())
+
+        if not set(columns) <= set(self.get_columns(table_name)):
+            raise ValueError('unknown columns for {}'.format(table_name))
+
+        query = 'INSERT INTO {}({}) VALUES({})'.format(
+            table_name, ', '.join(columns), ', '.join('?' * len(columns)))
+
+        groups = {}
+
+        for row in rows:
+            conn = self._conn
+
+            if self.shards and table_name in self.SHARDED_TABLES:
+                shard = None
+                if table_name == 'comment':
+                    shard = self.get_shard('blog', row['blog_id'])
+                if shard is None:
+                    shard = self.shard_for_author(row['author_id'])
+
+                map_query = 'INSERT INTO {}_shard(id, shard) VALUES(?, ?)'
+                self._conn.execute(map_query.format(table_name),
+                                   (row['id'], shard))
+                conn = self.connect_shard(shard)
+
+            values = tuple(row[column] for column in columns)
+            groups.setdefault(conn, []).append(values)
+
+        for conn, values in groups.items():
+            conn.executemany(query, values)
+            conn.commit()
+
+        self._conn.commit()
+        self._note_write()
+
+        return len(rows)
+
+    def compress_existing_content(self, batch_size=500):
+        """
+        Compresses the content of blogs written before compression was turned
+        on, batch_size blogs per transaction.
+        :param batch_size: number of blogs read and updated at a time
+        :return: number of blogs compressed
+        """
+
+        if self.compress_threshold is None:
+            raise ValueError('compress_threshold is not set')
+
+        select_query = '''
+        SELECT id, content FROM blog
+        WHERE id > ? AND typeof(content) = 'text'
+              AND length(CAST(content AS BLOB)) >= ?
+        ORDER BY id LIMIT ?
+        '''
+        update_query = 'UPDATE blog SET content = ? WHERE id = ?'
+
+        count = 0
+
+        for conn in self._data_conns():
+            last_id = 0
+
+            while True:
+                rows = conn.execute(select_query,
+                                    (last_id, self.compress_threshold,
+                                     batch_size)).fetchall()
+                if not rows:
+                    break
+
+                updates = []
+                for row in rows:
+                    content = self.compress_content(row['content'])
+                    if isinstance(content, bytes):
+                        updates.append((content, row['id']))
+
+                conn.executemany(update_query, updates)
+                conn.commit()
+
+                count += len(updates)
+                last_id = rows[-1]['id']
+
+        return count
 
     @staticmethod
     def get_current_time():
@@ -63,44 +1156,420 @@ class BlogDB:
 
         return current_time
 
-    def get_all_rows(self, table_name):
+    def get_all_rows(self, table_name, fields=None, row_format=None):
         """
         Returns all of the rows from a table as a list of dictionaries. This is
         suitable for passing to jsonify().
         :param table_name: name of the table
+        :param fields: list of columns to return, or None for all columns.
+        Raises ValueError if the table has no such column.
+        :param row_format: representation of the rows, see _collect_rows()
         :return: list of dictionaries representing the table's rows
         """
 
+        columns = self._select_list(table_name, fields)
+
+        if self.shards and table_name in self.SHARDED_TABLES:
+            # Shards are merged on id, so it is read even if not asked for
+            query = 'SELECT id AS _id, {} FROM {} ORDER BY id'.format(
+                columns, table_name)
+            cursors = [conn.execute(query) for conn in self._data_conns()]
+            return self._collect_rows(
+                heapq.merge(*cursors, key=lambda r: r['_id']),
+                self._column_names(cursors[0]), row_format, skip=1)
+
         cur = self._conn.cursor()
 
-        query = 'SELECT * FROM {}'.format(table_name)
+        query = 'SELECT {} FROM {}'.format(columns, table_name)
+        cur.execute(query)
 
-        results = []
+        return self._collect_rows(cur, self._column_names(cur), row_format)
+
+    @staticmethod
+    def _column_names(cur):
+        """
+        Gets the names of the columns of a query's rows
+        :param cur: sqlite3.Cursor that executed the query
+        :return: list of column names
+        """
 
-        for row in cur.execute(query):
-            results.append(dict(row))
+        return [column[0] for column in cur.description]
 
-        return results
+    @staticmethod
+    def _iter_batches(conn, query, params=(), batch_size=500):
+        """
+        Runs a query and yields its rows fetched batch_size at a time. The
+        cursor is closed once the rows are exhausted or the generator is
+        closed, so callers stopping early should close it, for example with
+        contextlib.closing().
+        :param conn: sqlite connection to run the query on
+        :param query: SQL query
+        :param params: parameters of the query
+        :param batch_size: number of rows fetched at a time
+        :return: generator of lists of sqlite3.Row objects
+        """
+
+        cur = conn.cursor()
 
-    def get_all_accounts(self):
+        try:
+            cur.execute(query, params)
+
+            rows = cur.fetchmany(batch_size)
+            while rows:
+                yield rows
+                rows = cur.fetchmany(batch_size)
+        finally:
+            cur.close()
+
+    def _iter_query(self, conns, query, params=(), batch_size=500):
+        """
+        Yields the rows of a query as dictionaries, merging the rows of
+        several connections on their leading _id column, which is left out.
+        Memory use is one batch of rows per connection.
+        :param conns: list of sqlite connections to run the query on
+        :param query: SQL query selecting _id first when there are several
+        connections
+        :param params: parameters of the query
+        :param batch_size: number of rows fetched at a time per connection
+        :return: generator of dictionaries
+        """
+
+        batches = [self._iter_batches(conn, query, params, batch_size)
+                   for conn in conns]
+
+        try:
+            if len(batches) == 1:
+                for rows in batches[0]:
+                    for row in rows:
+                        yield self._to_dict(row)
+                return
+
+            rows = [itertools.chain.from_iterable(b) for b in batches]
+            for row in heapq.merge(*rows, key=lambda r: r['_id']):
+                item = self._to_dict(row)
+                del item['_id']
+                yield item
+        finally:
+            for batch in batches:
+                batch.close()
+
+    def iter_rows(self, table_name, batch_size=500, fields=None):
+        """
+        Yields every row of a table as a dictionary, in id order for tables
+        with ids, fetching batch_size rows at a time so memory use does not
+        grow with the table. Account passwords are included, as export needs
+        them.
+        :param table_name: name of the table
+        :param batch_size: number of rows fetched at a time
+        :param fields: list of columns to return, or None for all columns.
+        Raises ValueError if the table has no such column.
+        :return: generator of dictionaries representing the table's rows
+        """
+
+        columns = self._select_list(table_name, fields)
+
+        if self.shards and table_name in self.SHARDED_TABLES:
+            query = 'SELECT id AS _id, {} FROM {} ORDER BY id'.format(
+                columns, table_name)
+            return self._iter_query(self._data_conns(), query,
+                                    batch_size=batch_size)
+
+        query = 'SELECT {} FROM {}'.format(columns, table_name)
+        if 'id' in self.get_columns(table_name):
+            query += ' ORDER BY id'
+
+        return self._iter_query([self._conn], query, batch_size=batch_size)
+
+    def get_all_accounts(self, fields=None, row_format=None):
         """
            Returns all attribute accounts except password as a list of
            dictionaries.
            This is suitable for passing to jsonify().
+           :param fields: list of columns to return, or None for all columns
+           but the password. Raises ValueError for any other column.
+           :param row_format: representation of the rows, see
+           _collect_rows()
            :return: list of dictionaries representing the account's rows
            """
 
         cur = self._conn.cursor()
 
-        query = 'SELECT id, username FROM account'
+        query = 'SELECT {} FROM account'.format(
+            self._select_list('account', fields, self.PUBLIC_ACCOUNT_COLUMNS))
+        cur.execute(query)
+
+        return self._collect_rows(cur, self._column_names(cur), row_format)
+
+    def has_accounts(self):
+        """
+        Checks whether there is any account, without reading them all
+        :return: True if there is at least one account
+        """
+
+        query = 'SELECT 1 FROM account LIMIT 1'
+
+        return self._conn.execute(query).fetchone() is not None
+
+    def _touch_cache(self, name):
+        """
+        Bumps the cache_version of a cached value, so that every process
+        drops it at its next check_data_version(). Called by the methods
+        that change what the value is computed from; the caller commits.
+        :param name: name of the value
+        :return: None
+        """
+
+        self._conn.execute('INSERT OR IGNORE INTO cache_version(name, '
+                           'version) VALUES(?, 0)', (name,))
+        self._conn.execute('UPDATE cache_version SET version = version + 1 '
+                           'WHERE name = ?', (name,))
+
+    def _get_cached(self, name, compute):
+        """
+        Gets a value from the cache of this database file, computing and
+        storing it if it is not cached
+        :param name: name of the value
+        :param compute: function computing the value
+        :return: the value
+        """
+
+        cls = BlogDB
+
+        with cls._cache_lock:
+            cache = cls._caches.get(self.filename, {})
+            if name in cache:
+                return cache[name][1]
+            generation = cls._cache_generations.get(self.filename, 0)
+
+        # Read first, so a write made while computing makes it stale
+        row = self._conn.execute('SELECT version FROM cache_version '
+                                 'WHERE name = ?', (name,)).fetchone()
+        version = 0 if row is None else row['version']
+
+        value = compute()
+
+        with cls._cache_lock:
+            if cls._cache_generations.get(self.filename, 0) == generation:
+                cls._caches.setdefault(self.filename, {})[name] = \
+                    (version, value)
+
+        return value
+
+    @classmethod
+    def invalidate_caches(cls, filename, names=None):
+        """
+        Drops the cached values of a database file after it changed
+        :param filename: the address of the database
+        :param names: names of the values to drop, or None for all of them
+        :return: None
+        """
+
+        with cls._cache_lock:
+            cls._cache_generations[filename] = \
+                cls._cache_generations.get(filename, 0) + 1
+
+            if names is None:
+                cls._caches.pop(filename, None)
+            else:
+                cache = cls._caches.get(filename, {})
+                for name in names:
+                    cache.pop(name, None)
+
+    @classmethod
+    def check_data_version(cls, filename):
+        """
+        Drops the cached values of a database file that another connection,
+        possibly in another process, changed since the last check. This
+        costs one PRAGMA data_version on a connection kept open for the
+        file, so it is cheap enough to run at the start of every request.
+        Only when that shows a commit is the cache_version table read, and
+        only the values whose version moved are dropped, so commits that do
+        not touch them, such as comments or jobs, keep them cached.
+        :param filename: the address of the database
+        :return: True if any cached value was dropped
+        """
+
+        versions = None
+
+        with cls._watcher_lock:
+            conn = cls._watchers.get(filename)
+
+            try:
+                if conn is None:
+                    uri = 'file:{}?mode=ro'.format(
+                        urllib.parse.quote(filename))
+                    conn = sqlite3.connect(uri, uri=True,
+                                           check_same_thread=False)
+                    cls._watchers[filename] = conn
+
+                version = conn.execute('PRAGMA data_version').fetchone()[0]
+            except sqlite3.Error:
+                # The file is missing or unreadable, so nothing is trusted
+                version = None
+
+            changed = version is None or \
+                cls._data_versions.get(filename) != version
+            cls._data_versions[filename] = version
+
+            if changed and version is not None:
+                try:
+                    versions = dict(conn.execute(
+                        'SELECT name, version FROM cache_version'))
+                except sqlite3.Error:
+                    # No cache_version table yet, so nothing is trusted
+                    versions = None
+
+        if not changed:
+            return False
+
+        with cls._cache_lock:
+            cache = cls._caches.get(filename, {})
+            stale = [name for name, (cached, _) in cache.items()
+                     if versions is None or versions.get(name, 0) != cached]
+
+        if stale:
+            cls.invalidate_caches(filename, stale)
+
+        return bool(stale)
+
+    @classmethod
+    def close_watchers(cls, filename=None):
+        """
+        Closes the connections check_data_version() keeps open, so the
+        database file can be removed. The next check opens a new one and
+        compares the cache_version of every cached value again.
+        :param filename: the address of the database, or None for all
+        """
+
+        with cls._watcher_lock:
+            if filename is None:
+                filenames = list(cls._watchers)
+            else:
+                filenames = [filename]
+
+            for name in filenames:
+                conn = cls._watchers.pop(name, None)
+                if conn is not None:
+                    conn.close()
+                cls._data_versions.pop(name, None)
+
+    def get_author_directory(self, offset=0, limit=None):
+        """
+        Returns authors ordered by their number of blogs, most first, with
+        'id', 'username' and 'post_count' keys. Only the top
+        AUTHOR_DIRECTORY_SIZE authors are listed. The directory is cached
+        for the process and computed again after accounts are added or
+        deleted or blogs posted or deleted, by this process or, once
+        check_data_version() noticed it, by another one.
+        :param offset: number of authors to skip
+        :param limit: maximum number of authors returned, or None for all
+        :return: list of dictionaries representing the authors
+        """
+
+        def compute():
+            query = '''
+            SELECT account.id AS id, account.username AS username,
+                   COUNT(feed.blog_id) AS post_count
+            FROM account LEFT JOIN feed ON feed.author_id = account.id
+            GROUP BY account.id
+            ORDER BY post_count DESC, account.id LIMIT ?
+            '''
+
+            return [dict(row) for row in self._conn.execute(
+                query, (self.AUTHOR_DIRECTORY_SIZE,))]
+
+        directory = self._get_cached('author_directory', compute)
+
+        if limit is None:
+            return directory[offset:]
+
+        return directory[offset:offset + limit]
+
+    def get_rows_by_ids(self, table_name, ids, fields=None):
+        """
+        Returns the rows of a table with the given ids as a list of
+        dictionaries ordered by id, using one IN (...) query per database
+        holding them and IDS_PER_QUERY ids. Ids without a row are skipped.
+        Account passwords are never returned.
+        :param table_name: name of the table
+        :param ids: list of ids
+        :param fields: list of columns to return, or None for all columns.
+        Raises ValueError if the table has no such column.
+        :return: list of dictionaries representing the rows
+        """
+
+        allowed = None
+        if table_name == 'account':
+            allowed = self.PUBLIC_ACCOUNT_COLUMNS
+
+        columns = self._select_list(table_name, fields, allowed)
+
+        ids = list(set(ids))
+
+        if not ids:
+            return []
+
+        chunks = [ids[start:start + self.IDS_PER_QUERY]
+                  for start in range(0, len(ids), self.IDS_PER_QUERY)]
+
+        if self.shards and table_name in self.SHARDED_TABLES:
+            mapped = {}
+            for chunk in chunks:
+                query = 'SELECT id, shard FROM {}_shard WHERE id IN ({})'
+                query = query.format(table_name, ', '.join('?' * len(chunk)))
+                for row in self._conn.execute(query, chunk):
+                    mapped[row['id']] = row['shard']
+
+            # Ids not in the shard map are on the shard given by their id
+            shard_ids = {}
+            for item_id in ids:
+                shard = mapped.get(item_id, item_id % len(self.shards))
+                shard_ids.setdefault(shard, []).append(item_id)
+
+            groups = [(self.connect_shard(shard), shard_ids[shard])
+                      for shard in shard_ids]
+        else:
+            groups = [(self._conn, ids)]
 
         results = []
 
-        for row in cur.execute(query):
-            results.append(dict(row))
+        for conn, group_ids in groups:
+            for start in range(0, len(group_ids), self.IDS_PER_QUERY):
+                chunk = group_ids[start:start + self.IDS_PER_QUERY]
+                query = 'SELECT id AS _id, {} FROM {} WHERE id IN ({})'.format(
+                    columns, table_name, ', '.join('?' * len(chunk)))
+
+                for row in conn.execute(query, chunk):
+                    results.append(self._to_dict(row))
+
+        results.sort(key=lambda item: item['_id'])
+
+        for item in results:
+            del item['_id']
 
         return results
 
+    def get_blog_excerpts(self, limit=None):
+        """
+        Returns the latest blogs, newest first, with their excerpt, author's
+        username and number of comments instead of their content. This is
+        what listings show. The rows are read from the feed table with one
+        scan of its primary key, which is much cheaper than reading the
+        blogs.
+        :param limit: maximum number of blogs returned, or None for all
+        :return: list of dictionaries with keys 'id', 'title', 'excerpt',
+        'author_id', 'time', 'username' and 'comment_count'
+        """
+
+        query = '''
+        SELECT blog_id AS id, title, excerpt, author_id, time, username,
+               comment_count
+        FROM feed ORDER BY blog_id DESC LIMIT ?
+        '''
+
+        return [dict(row) for row in self._conn.execute(
+            query, (-1 if limit is None else limit,))]
+
     def query_by_id(self, table_name, item_id):
         """
         Get a row from a table that has a primary key attribute named id.
@@ -110,7 +1579,9 @@ class BlogDB:
         :return: a dictionary representing the row
         """
 
-        cur = self._conn.cursor()
+        conn = self._conn_for(table_name, item_id)
+
+        cur = conn.cursor()
 
         query = 'SELECT * FROM {} WHERE id = ?'.format(table_name)
 
@@ -119,7 +1590,7 @@ class BlogDB:
         row = cur.fetchone()
 
         if row is not None:
-            return dict(row)
+            return self._to_dict(row)
         else:
             return None
 
@@ -153,49 +1624,488 @@ class BlogDB:
         :return: dictionary containing the account
         """
 
-        cur = self._conn.cursor()
-        query = 'SELECT * FROM account WHERE username = ?'
-        cur.execute(query, (username,))
-        row = cur.fetchone()
+        cur = self._conn.cursor()
+        query = 'SELECT * FROM account WHERE username = ?'
+        cur.execute(query, (username,))
+        row = cur.fetchone()
+
+        if row is None:
+            return None
+        else:
+            return dict(row)
+
+    def get_blog_by_author(self, id, before=None, after=None, limit=None,
+                           row_format=None):
+        """
+        Returns blog posts posted by account with given ID, newest first.
+        Pages are read with a range scan of the (author_id, id) index: the
+        blogs older than before, or the blogs just newer than after.
+        :param id: ID of the account
+        :param before: ID of a blog to return blogs older than, or None
+        :param after: ID of a blog to return blogs newer than, or None
+        :param limit: maximum number of blogs returned, or None for all
+        :param row_format: representation of the rows, see _collect_rows().
+        Columns are not supported.
+        :return: list of blog posts posted from account with given ID
+        """
+
+        if self.shards:
+            cur = self.connect_shard(self.shard_for_author(id)).cursor()
+        else:
+            cur = self._conn.cursor()
+
+        if row_format == 'columns':
+            raise ValueError('blogs by author cannot be read as columns')
+
+        # The page just newer than after is the oldest blogs newer than it
+        if after is not None:
+            query = '''
+            SELECT * FROM blog WHERE author_id = ? AND id > ?
+            ORDER BY id LIMIT ?
+            '''
+            params = (id, after)
+        else:
+            query = '''
+            SELECT * FROM blog WHERE author_id = ? AND id < ?
+            ORDER BY id DESC LIMIT ?
+            '''
+            params = (id, before if before is not None else 2 ** 63 - 1)
+
+        params += (-1 if limit is None else limit,)
+        cur.execute(query, params)
+
+        blog_posts = self._collect_rows(cur, self._column_names(cur),
+                                        row_format)
+
+        if after is not None:
+            blog_posts.reverse()
+
+        return blog_posts
+
+    def iter_blogs_by_author(self, id, batch_size=500):
+        """
+        Yields the blogs posted by account with given ID as dictionaries,
+        newest first, fetching batch_size blogs at a time
+        :param id: ID of the account
+        :param batch_size: number of blogs fetched at a time
+        :return: generator of dictionaries representing the blogs
+        """
+
+        if self.shards:
+            conn = self.connect_shard(self.shard_for_author(id))
+        else:
+            conn = self._conn
+
+        query = 'SELECT * FROM blog WHERE author_id = ? ORDER BY id DESC'
+
+        return self._iter_query([conn], query, (id,), batch_size)
+
+    def iter_comments_for_blog(self, id, batch_size=500):
+        """
+        Yields the comments posted for a blog post with given ID as
+        dictionaries, oldest first, fetching batch_size comments at a time
+        :param id: ID of the blog
+        :param batch_size: number of comments fetched at a time
+        :return: generator of dictionaries representing the comments
+        """
+
+        conn = self._conn_for('blog', id)
+
+        query = 'SELECT * FROM comment WHERE blog_id = ? ORDER BY id'
+
+        return self._iter_query([conn], query, (id,), batch_size)
+
+    def get_comments_from_blog(self, id, row_format=None):
+        """
+        Returns a list of comments posted for a blog post with given ID
+        :param row_format: representation of the rows, see _collect_rows()
+        :return: comments and associated information for blog with ID blog_id
+        """
+
+        conn = self._conn_for('blog', id)
+        row_format = row_format or self.row_format
+
+        cur = conn.cursor()
+
+        query = 'SELECT * FROM comment WHERE blog_id = (?)'
+        cur.execute(query, (id,))
+
+        return self._collect_rows(cur, self._column_names(cur), row_format)
+
+    def get_comment_thread(self, blog_id):
+        """
+        Returns the comments of a blog in thread order, each reply right
+        after its parent, with one query on the (blog_id, path) index. Each
+        comment also has the 'username' of its author and its 'depth', 0 for
+        comments on the blog itself.
+        :param blog_id: ID of the blog
+        :return: list of dictionaries representing the comments
+        """
+
+        conn = self._conn_for('blog', blog_id)
+
+        query = '''
+        SELECT comment.*, username FROM comment
+        LEFT JOIN account ON account.id = comment.author_id
+        WHERE blog_id = ? ORDER BY path
+        '''
+
+        return self._thread_dicts(conn.execute(query, (blog_id,)))
+
+    def get_comment_subtree(self, comment_id):
+        """
+        Returns a comment followed by all of its replies in thread order,
+        with one query scanning the range of paths that start with the
+        comment's path. Comments have 'username' and 'depth' like in
+        get_comment_thread().
+        :param comment_id: ID of the comment
+        :return: list of dictionaries representing the comments, empty if
+        there is no comment with that ID
+        """
+
+        conn = self._conn_for('comment', comment_id)
+
+        # Paths only hold digits and '/', so '~' sorts after all of them
+        query = '''
+        SELECT comment.*, username
+        FROM (SELECT blog_id, path FROM comment WHERE id = ?) AS root
+        JOIN comment ON comment.blog_id = root.blog_id
+                    AND comment.path >= root.path
+                    AND comment.path < root.path || '~'
+        LEFT JOIN account ON account.id = comment.author_id
+        ORDER BY comment.path
+        '''
+
+        return self._thread_dicts(conn.execute(query, (comment_id,)))
+
+    def get_comments_since(self, blog_id, last_id):
+        """
+        Returns the comments of a blog with an ID greater than last_id, in
+        the order they were posted, with the 'username' of their author
+        :param blog_id: ID of the blog
+        :param last_id: ID of the last comment already seen
+        :return: list of dictionaries representing the comments
+        """
+
+        conn = self._conn_for('blog', blog_id)
+
+        query = '''
+        SELECT comment.*, username FROM comment
+        LEFT JOIN account ON account.id = comment.author_id
+        WHERE blog_id = ? AND comment.id > ? ORDER BY comment.id
+        '''
+
+        return [self._to_dict(row) for row in
+                conn.execute(query, (blog_id, last_id))]
+
+    def _thread_dicts(self, rows):
+        """
+        Converts comment rows to dictionaries with their depth in the thread
+        :param rows: iterable of sqlite3.Row objects with a path
+        :return: list of dictionaries representing the comments
+        """
+
+        comments = []
+
+        for row in rows:
+            comment = self._to_dict(row)
+            comment['depth'] = comment['path'].count('/') - 1
+            comments.append(comment)
+
+        return comments
+
+    def follow(self, follower_id, followee_id):
+        """
+        Makes an account follow an author, and copies the author's latest
+        blogs into the follower's timeline.
+        :param follower_id: ID of the following account
+        :param followee_id: ID of the followed account
+        :return: True, or None if either account does not exist
+        """
+
+        if self.query_by_id('account', follower_id) is None \
+                or self.query_by_id('account', followee_id) is None:
+            return None
+
+        cur = self._conn.cursor()
+
+        cur.execute('INSERT OR IGNORE INTO follow(follower_id, followee_id) '
+                    'VALUES(?, ?)', (follower_id, followee_id))
+
+        if self.shards:
+            conn = self.connect_shard(self.shard_for_author(followee_id))
+        else:
+            conn = self._conn
+
+        query = '''
+        SELECT id FROM blog WHERE author_id = ? ORDER BY id DESC LIMIT ?
+        '''
+        rows = conn.execute(query,
+                            (followee_id, self.TIMELINE_BACKFILL)).fetchall()
+
+        cur.executemany('INSERT OR IGNORE INTO timeline(account_id, blog_id, '
+                        'author_id) VALUES(?, ?, ?)',
+                        [(follower_id, row['id'], followee_id)
+                         for row in rows])
+        self._conn.commit()
+        self._note_write()
+
+        return True
+
+    def unfollow(self, follower_id, followee_id):
+        """
+        Makes an account stop following an author, and removes the author's
+        blogs from the follower's timeline.
+        :param follower_id: ID of the following account
+        :param followee_id: ID of the followed account
+        :return: None
+        """
+
+        cur = self._conn.cursor()
+
+        cur.execute('DELETE FROM follow WHERE follower_id = ? '
+                    'AND followee_id = ?', (follower_id, followee_id))
+
+        # Accounts always see their own blogs
+        if int(follower_id) != int(followee_id):
+            cur.execute('DELETE FROM timeline WHERE account_id = ? '
+                        'AND author_id = ?', (follower_id, followee_id))
+
+        self._conn.commit()
+        self._note_write()
+
+    def is_following(self, follower_id, followee_id):
+        """
+        Checks whether an account follows an author
+        :param follower_id: ID of the following account
+        :param followee_id: ID of the followed account
+        :return: True if it does
+        """
+
+        query = '''
+        SELECT 1 FROM follow WHERE follower_id = ? AND followee_id = ?
+        '''
+
+        return self._conn.execute(
+            query, (follower_id, followee_id)).fetchone() is not None
+
+    def fan_out(self, blog_id, author_id, batch_size=500):
+        """
+        Copies a new blog into the timelines of its author and the author's
+        followers, batch_size followers per transaction so an author with
+        many followers does not hold the write lock for long.
+        :param blog_id: ID of the blog
+        :param author_id: ID of the blog's author
+        :param batch_size: number of timelines written per transaction
+        :return: number of timelines written, 0 if the blog was deleted
+        before the job ran
+        """
+
+        if self.query_by_id('blog', blog_id) is None:
+            return 0
+
+        select_query = '''
+        SELECT follower_id FROM follow
+        WHERE followee_id = ? AND follower_id > ?
+        ORDER BY follower_id LIMIT ?
+        '''
+        insert_query = '''
+        INSERT OR IGNORE INTO timeline(account_id, blog_id, author_id)
+        VALUES(?, ?, ?)
+        '''
+
+        cur = self._conn.cursor()
+        cur.execute(insert_query, (author_id, blog_id, author_id))
+        self._conn.commit()
+        count = 1
+
+        last_id = -1
+
+        while True:
+            rows = cur.execute(select_query,
+                               (author_id, last_id, batch_size)).fetchall()
+            if not rows:
+                break
+
+            cur.executemany(insert_query,
+                            [(row['follower_id'], blog_id, author_id)
+                             for row in rows])
+            self._conn.commit()
+
+            count += len(rows)
+            last_id = rows[-1]['follower_id']
+
+        self._note_write()
+
+        return count
+
+    def get_timeline(self, account_id, limit=50):
+        """
+        Returns the latest blogs of an account's timeline, which holds its
+        own blogs and those of the authors it follows. The timeline is read
+        with one range scan of its primary key, joined with the feed table.
+        Blogs have the same keys as in get_blog_excerpts().
+        :param account_id: ID of the account
+        :param limit: maximum number of blogs returned
+        :return: list of dictionaries representing the blogs, newest first
+        """
+
+        query = '''
+        SELECT feed.blog_id AS id, title, excerpt, feed.author_id AS author_id,
+               time, username, comment_count
+        FROM timeline JOIN feed ON feed.blog_id = timeline.blog_id
+        WHERE timeline.account_id = ?
+        ORDER BY timeline.blog_id DESC LIMIT ?
+        '''
+
+        return [dict(row) for row in
+                self._conn.execute(query, (account_id, limit))]
+
+    def enqueue(self, kind, **payload):
+        """
+        Queues follow-up work of a write, to be run by the JobQueue in the
+        background. The job is written to the global database, so it
+        survives a restart. Without shards that is the write's own
+        transaction. With shards the row is committed to its shard first
+        and the job right after, so a crash in between loses the job but
+        never leaves one for a row that was not written; jobs check that
+        their row still exists anyway, since it may have been deleted since.
+        Without a JobQueue the job is held until run_jobs(), which write
+        methods call once they have committed. The caller commits.
+        :param kind: name of the method running the job, from JOB_KINDS
+        :param payload: keyword arguments of the method
+        :return: None
+        """
+
+        if kind not in self.JOB_KINDS:
+            raise ValueError('unknown job {}'.format(kind))
+
+        if self.jobs is None:
+            self._pending_jobs.append((kind, payload))
+            return
+
+        self._conn.execute('INSERT INTO jobs(kind, payload, run_at) '
+                           'VALUES(?, ?, ?)',
+                           (kind, json.dumps(payload), time.time()))
+
+    def run_jobs(self):
+        """
+        Wakes the JobQueue up after a write queued jobs, or runs the jobs
+        straight away when there is no JobQueue
+        :return: None
+        """
+
+        if self.jobs is not None:
+            self.jobs.notify()
+            return
+
+        while self._pending_jobs:
+            kind, payload = self._pending_jobs.pop(0)
+            getattr(self, kind)(**payload)
+
+    def claim_job(self, lease):
+        """
+        Takes the oldest job that is due, so no other worker runs it for the
+        next lease seconds. A job whose lease ran out without it finishing
+        is due again. The write lock is only taken once a read found a due
+        job, so idle workers polling do not hold up other writes.
+        :param lease: seconds the job is reserved for
+        :return: dictionary with the job's 'id', 'kind', 'payload' and
+        'attempts' so far, or None if no job is due
+        """
+
+        now = time.time()
 
-        if row is None:
+        select_query = '''
+        SELECT id FROM jobs
+        WHERE run_at <= ? AND (claimed_until IS NULL OR claimed_until < ?)
+        ORDER BY run_at LIMIT 1
+        '''
+        update_query = '''
+        UPDATE jobs SET claimed_until = ?, attempts = attempts + 1
+        WHERE id = ({})
+        '''.format(select_query)
+
+        if self._conn.execute(select_query, (now, now)).fetchone() is None:
             return None
+
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            query = update_query + 'RETURNING id, kind, payload, attempts'
+            row = self._conn.execute(query,
+                                     (now + lease, now, now)).fetchone()
         else:
-            return dict(row)
+            # RETURNING needs SQLite 3.35, so older versions take the write
+            # lock first to keep other workers from claiming the same job
+            self._conn.commit()
+            self._conn.execute('BEGIN IMMEDIATE')
+            row = self._conn.execute(select_query, (now, now)).fetchone()
+            if row is not None:
+                self._conn.execute(update_query, (now + lease, now, now))
+                row = self._conn.execute(
+                    'SELECT id, kind, payload, attempts FROM jobs '
+                    'WHERE id = ?', (row['id'],)).fetchone()
 
-    def get_blog_by_author(self, id):
-        """
-        Returns a list of blog posts posted by account with given ID
-        :return: list of blog posts posted from account with given ID
-        """
+        self._conn.commit()
 
-        cur = self._conn.cursor()
+        if row is None:
+            return None
 
-        blog_posts = []
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
 
-        query = 'SELECT * FROM blog WHERE author_id = (?)'
+        return job
 
-        for row in cur.execute(query, (id,)):
-            blog_posts.append(row)
+    def finish_job(self, job_id):
+        """
+        Removes a job that ran successfully
+        :param job_id: ID of the job
+        :return: None
+        """
 
-        return blog_posts
+        self._conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+        self._conn.commit()
 
-    def get_comments_from_blog(self, id):
+    def fail_job(self, job, error, max_attempts, retry_delay):
         """
-        Returns a list of comments posted for a blog post with given ID
-        :return: comments and associated information for blog with ID blog_id
+        Schedules a job that failed to run again after retry_delay seconds,
+        doubled for every further attempt. A job that failed max_attempts
+        times is kept with its error but not run again.
+        :param job: dictionary returned by claim_job()
+        :param error: description of the error
+        :param max_attempts: number of times a job is tried
+        :param retry_delay: seconds before the first retry
+        :return: None
         """
 
-        cur = self._conn.cursor()
+        run_at = None
 
-        comments = []
+        if job['attempts'] < max_attempts:
+            run_at = time.time() + retry_delay * 2 ** (job['attempts'] - 1)
 
-        query = 'SELECT * FROM comment WHERE blog_id = (?)'
+        self._conn.execute('UPDATE jobs SET run_at = ?, claimed_until = NULL, '
+                           'error = ? WHERE id = ?',
+                           (run_at, error, job['id']))
+        self._conn.commit()
 
-        for row in cur.execute(query, (id,)):
-            comments.append(row)
+    def get_job_counts(self):
+        """
+        Counts the jobs in the queue by state: 'ready' to run, 'scheduled'
+        to be retried later, 'running' and 'failed' for good
+        :return: dictionary of counts
+        """
 
-        return comments
+        query = '''
+        SELECT
+            COUNT(CASE WHEN claimed_until >= :now THEN 1 END) AS running,
+            COUNT(CASE WHEN run_at IS NULL THEN 1 END) AS failed,
+            COUNT(CASE WHEN run_at <= :now AND (claimed_until IS NULL
+                       OR claimed_until < :now) THEN 1 END) AS ready,
+            COUNT(CASE WHEN run_at > :now AND (claimed_until IS NULL
+                       OR claimed_until < :now) THEN 1 END) AS scheduled
+        FROM jobs
+        '''
+
+        return dict(self._conn.execute(query, {'now': time.time()}).fetchone())
 
     def get_blog_by_id(self, id):
         """
@@ -207,7 +2117,9 @@ class BlogDB:
         :return: dictionary containing the blog
         """
 
-        cur = self._conn.cursor()
+        conn = self._conn_for('blog', id)
+
+        cur = conn.cursor()
         query = '''SELECT title, content, username, time, author_id, blog.id as id 
                    FROM blog, account 
                    WHERE blog.id = ? AND account.id = blog.author_id'''
@@ -215,7 +2127,7 @@ class BlogDB:
         blog = cur.fetchone()
 
         if blog is not None:
-            return dict(blog)
+            return self._to_dict(blog)
         else:
             return None
 
@@ -229,7 +2141,9 @@ class BlogDB:
         :return: dictionary containing the comment
         """
 
-        cur = self._conn.cursor()
+        conn = self._conn_for('comment', id)
+
+        cur = conn.cursor()
         query = '''SELECT content, time, username, author_id FROM comment, account 
                    WHERE comment.id = ? AND account.id = comment.author_id'''
         cur.execute(query, (id,))
@@ -249,34 +2163,63 @@ class BlogDB:
         :return: dictionary representing new blog information
         """
 
-        cur = self._conn.cursor()
         account = self.query_by_id('account', author_id)
 
         if account is None:
             return None
 
+        shard = self.shard_for_author(author_id) if self.shards else None
+        conn, id_sql, id_params = self._new_row('blog', shard)
+        cur = conn.cursor()
+
         time_posted = self.get_current_time()
 
         insert_query = '''
-        INSERT INTO blog(title, content, author_id, time) VALUES(?, ?, ?, ?)
+        INSERT INTO blog(id, title, content, excerpt, author_id, time)
+        VALUES({}, ?, ?, ?, ?, ?)
+        '''.format(id_sql)
+        cur.execute(insert_query,
+                    id_params + (title, self.compress_content(content),
+                                 self.make_excerpt(content), author_id,
+                                 time_posted))
+        self._store_rendered(content)
+        blog_id = cur.lastrowid
+
+        feed_query = '''
+        INSERT INTO feed(blog_id, title, excerpt, author_id, username, time)
+        VALUES(?, ?, ?, ?, ?, ?)
         '''
-        cur.execute(insert_query, (title, content, author_id, time_posted))
-        self._conn.commit()
+        self._conn.execute(feed_query,
+                           (blog_id, title, self.make_excerpt(content),
+                            author_id, account['username'], time_posted))
+
+        # The author's own timeline is written now so the page shown after
+        # posting has the blog, while followers' wait for the job
+        self._conn.execute('INSERT INTO timeline(account_id, blog_id, '
+                           'author_id) VALUES(?, ?, ?)',
+                           (author_id, blog_id, author_id))
+
+        self.enqueue('fan_out', blog_id=blog_id, author_id=author_id)
+        self._touch_cache('author_directory')
+        self._commit(conn)
+        self._note_write()
+        self.invalidate_caches(self.filename)
+        self.run_jobs()
 
-        blog_id = cur.lastrowid
         return self.query_by_id('blog', blog_id)
 
-    def insert_comment(self, blog_id, author_id, content):
+    def insert_comment(self, blog_id, author_id, content, parent_id=None):
         """
         Create comment on existing blog post. Account login/verification required
         before posting.
         :param blog_id: ID of blog comment is posted on
         :param author_id: ID of account from which the comment is being posted
         :param content: writing in the comment
+        :param parent_id: ID of the comment on the same blog this is a reply
+        to, or None for a comment on the blog itself
         :return: dictionary representing new comment information
         """
 
-        cur = self._conn.cursor()
         account = self.query_by_id('account', author_id)
 
         # Return None if author does not exist
@@ -287,16 +2230,56 @@ class BlogDB:
         if self.query_by_id('blog', blog_id) is None:
             return None
 
+        parent_path = ''
+
+        if parent_id is not None:
+            parent_query = '''
+            SELECT path FROM comment WHERE id = ? AND blog_id = ?
+            '''
+            conn = self._conn_for('comment', parent_id)
+            parent = None
+            if conn is not None:
+                parent = conn.execute(parent_query,
+                                      (parent_id, blog_id)).fetchone()
+
+            # Return None if parent is not a comment on the blog
+            if parent is None:
+                return None
+
+            parent_path = parent['path']
+
+        # Comments are kept on the same shard as their blog
+        shard = self.get_shard('blog', blog_id) if self.shards else None
+        conn, id_sql, id_params = self._new_row('comment', shard)
+        cur = conn.cursor()
+
         time_posted = self.get_current_time()
 
         insert_query = '''
-        INSERT INTO comment(blog_id, author_id, content, time) VALUES(?, ?, ?, ?)
-        '''
-        cur.execute(insert_query, (blog_id, author_id, content, time_posted))
+        INSERT INTO comment(id, blog_id, author_id, content, time, parent_id)
+        VALUES({}, ?, ?, ?, ?, ?)
+        '''.format(id_sql)
+        cur.execute(insert_query,
+                    id_params + (blog_id, author_id, content, time_posted,
+                                 parent_id))
         id = cur.lastrowid
-        self._conn.commit()
 
-        return self.query_by_id('comment', id)
+        # The path ends with the comment's own id, known once it is inserted
+        cur.execute('UPDATE comment SET path = ? WHERE id = ?',
+                    (self.comment_path(parent_path, id), id))
+        html = self._store_rendered(content)
+        self._conn.execute('UPDATE feed SET comment_count = comment_count + 1 '
+                           'WHERE blog_id = ?', (blog_id,))
+        self._commit(conn)
+        self._note_write()
+
+        comment = self.query_by_id('comment', id)
+
+        if self.events is not None:
+            self.events.publish(blog_id, dict(comment, html=html,
+                                              username=account['username']))
+
+        return comment
 
     def insert_account(self, username, password):
         """
@@ -316,7 +2299,10 @@ class BlogDB:
         '''
 
         cur.execute(insert_query, (username, hashed_password))
+        self._touch_cache('author_directory')
         self._conn.commit()
+        self._note_write()
+        self.invalidate_caches(self.filename)
 
         account_id = cur.lastrowid
 
@@ -341,6 +2327,7 @@ class BlogDB:
 
         cur.execute(update_query, (hashed_password, account_id))
         self._conn.commit()
+        self._note_write()
 
         return self.get_account_by_id(account_id)
 
@@ -355,18 +2342,19 @@ class BlogDB:
         :return: a dictionary containing the updated blog information
         """
 
-        cur = self._conn.cursor()
-
         if self.query_by_id('blog', blog_id) is None:
             return None
 
+        conn = self._conn_for('blog', blog_id)
+        cur = conn.cursor()
+
         new_time = self.get_current_time()
 
         update_query_1 = '''
         UPDATE blog SET title = ? WHERE id = ?
         '''
         update_query_2 = '''
-        UPDATE blog SET content = ? WHERE id = ?
+        UPDATE blog SET content = ?, excerpt = ? WHERE id = ?
         '''
         update_query_3 = '''
         UPDATE blog SET time = ? WHERE id = ?
@@ -374,11 +2362,21 @@ class BlogDB:
 
         if blog_title is not None:
             cur.execute(update_query_1, (blog_title, blog_id,))
+            self._conn.execute('UPDATE feed SET title = ? WHERE blog_id = ?',
+                               (blog_title, blog_id))
         if blog_content is not None:
-            cur.execute(update_query_2, (blog_content, blog_id,))
+            cur.execute(update_query_2,
+                        (self.compress_content(blog_content),
+                         self.make_excerpt(blog_content), blog_id,))
+            self._store_rendered(blog_content)
+            self._conn.execute('UPDATE feed SET excerpt = ? WHERE blog_id = ?',
+                               (self.make_excerpt(blog_content), blog_id))
         if new_time is not None:
             cur.execute(update_query_3, (new_time, blog_id,))
-        self._conn.commit()
+            self._conn.execute('UPDATE feed SET time = ? WHERE blog_id = ?',
+                               (new_time, blog_id))
+        self._commit(conn)
+        self._note_write()
 
         return self.query_by_id('blog', blog_id)
 
@@ -392,10 +2390,12 @@ class BlogDB:
         :return: a dictionary containing the updated comment information
         """
 
-        cur = self._conn.cursor()
         if self.query_by_id('comment', comment_id) is None:
             return None
 
+        conn = self._conn_for('comment', comment_id)
+        cur = conn.cursor()
+
         new_time = self.get_current_time()
 
         update_query_1 = '''
@@ -407,9 +2407,11 @@ class BlogDB:
 
         if comment_content is not None:
             cur.execute(update_query_1, (comment_content, comment_id,))
+            self._store_rendered(comment_content)
         if new_time is not None:
             cur.execute(update_query_2, (new_time, comment_id,))
-        self._conn.commit()
+        self._commit(conn)
+        self._note_write()
 
         return self.query_by_id('comment', comment_id)
 
@@ -421,59 +2423,639 @@ class BlogDB:
         :param blog_id: ID of blog
         """
 
-        cur = self._conn.cursor()
+        conn = self._conn_for('blog', blog_id)
+
+        cur = conn.cursor()
 
         query1 = 'DELETE FROM comment WHERE blog_id = ?'
         query2 = 'DELETE FROM blog WHERE id = ?'
+        query3 = 'DELETE FROM timeline WHERE blog_id = ?'
+        query4 = 'DELETE FROM feed WHERE blog_id = ?'
         cur.execute(query1, (blog_id,))
         cur.execute(query2, (blog_id,))
-        self._conn.commit()
+        self._conn.execute(query3, (blog_id,))
+        self._conn.execute(query4, (blog_id,))
+        self._touch_cache('author_directory')
+        self._commit(conn)
+        self._note_write()
+        self.invalidate_caches(self.filename)
 
     def delete_account(self, account_id):
         """
         Deletes all comments and blogs and account with given author_id. The
         owner of the account that this ID is related to (blog's/comment's author
         or account owner) must verify their username and password before
-        continuing.
+        continuing. With shards, each shard and then the global database is
+        committed on its own, so a crash part way leaves the deletion to be
+        finished by running it again.
 
         :param account_id: ID of account you want to delete
         """
 
-        cur = self._conn.cursor()
-
         query1 = 'SELECT id FROM blog WHERE author_id = ?'
         query2 = 'DELETE FROM comment WHERE blog_id = ?'
-        query3 = 'DELETE FROM comment WHERE author_id = ?'
-        query4 = 'DELETE FROM blog WHERE author_id =?'
-        query5 = 'DELETE FROM account WHERE id = ?'
+        query3 = 'DELETE FROM blog WHERE author_id =?'
+        query4 = 'DELETE FROM account WHERE id = ?'
+        query5 = 'DELETE FROM follow WHERE follower_id = ? OR followee_id = ?'
+        query6 = 'DELETE FROM timeline WHERE account_id = ? OR author_id = ?'
+        query7 = 'DELETE FROM feed WHERE author_id = ?'
 
-        results = []
-        for row in cur.execute(query1, (account_id,)):
-            results.append(dict(row))
+        # The author's comments can be on any shard
+        for conn in self._data_conns():
+            cur = conn.cursor()
 
-        for item in results:
-            cur.execute(query2, (item['id'],))
+            results = []
+            for row in cur.execute(query1, (account_id,)):
+                results.append(dict(row))
 
-        cur.execute(query3, (account_id,))
+            for item in results:
+                cur.execute(query2, (item['id'],))
 
-        cur.execute(query4, (account_id,))
+            # Replies to the author's comments go with them, as in
+            # delete_comment()
+            self._delete_subtrees(conn, 'root.author_id = ?', (account_id,))
+
+            cur.execute(query3, (account_id,))
+
+            conn.commit()
 
-        cur.execute(query5, (account_id,))
+        cur = self._conn.cursor()
+
+        cur.execute(query4, (account_id,))
+        cur.execute(query5, (account_id, account_id))
+        cur.execute(query6, (account_id, account_id))
+        cur.execute(query7, (account_id,))
+        self._touch_cache('author_directory')
 
         self._conn.commit()
+        self._note_write()
+        self.invalidate_caches(self.filename)
 
     def delete_comment(self, comment_id):
         """
-        Deletes a comment in the database using its ID.
+        Deletes a comment in the database using its ID, along with all the
+        replies to it.
 
         :param comment_id: ID of the comment
         :return: None
         """
 
-        cur = self._conn.cursor()
+        conn = self._conn_for('comment', comment_id)
 
-        query = 'DELETE FROM comment WHERE id = ?'
+        self._delete_subtrees(conn, 'root.id = ?', (comment_id,))
 
-        cur.execute(query, (comment_id,))
+        self._commit(conn)
+        self._note_write()
 
-        self._conn.commit()
+    def _delete_subtrees(self, conn, condition, params):
+        """
+        Deletes the comments matching a condition along with all the replies
+        to them, and takes them off the comment counts of the feed. The
+        caller commits.
+        :param conn: sqlite connection holding the comments
+        :param condition: SQL condition on the matching comments, called
+        root
+        :param params: parameters of the condition
+        :return: number of comments deleted
+        """
+
+        subtrees = '''
+        SELECT DISTINCT comment.id AS id, comment.blog_id AS blog_id
+        FROM comment AS root
+        JOIN comment ON comment.blog_id = root.blog_id
+                    AND comment.path >= root.path
+                    AND comment.path < root.path || '~'
+        WHERE {}
+        '''.format(condition)
+
+        counts = conn.execute('SELECT COUNT(*), blog_id FROM ({}) '
+                              'GROUP BY blog_id'.format(subtrees),
+                              params).fetchall()
+        conn.execute('DELETE FROM comment WHERE id IN (SELECT id FROM ({}))'
+                     .format(subtrees), params)
+
+        self._conn.executemany('UPDATE feed SET comment_count = '
+                               'comment_count - ? WHERE blog_id = ?',
+                               [tuple(row) for row in counts])
+
+        return sum(row[0] for row in counts)
+
+
+class ReplicaSet:
+    """
+    This class keeps read-only snapshot copies of a database for serving
+    read traffic. Snapshots are refreshed with the sqlite3 online backup API
+    once a number of writes have been made or an interval has passed, by a
+    background thread so that no request waits for the copy. Reads are
+    served from the previous snapshot, or from the database until there is
+    one. One ReplicaSet is shared by every BlogDB of a process.
+    """
+
+    def __init__(self, filename, count=1, interval=None, writes=None,
+                 background=True):
+        """
+        Creates a set of snapshots of the database stored at filename. The
+        snapshots are stored next to it as filename.replica0, .replica1, ...
+        :param filename: the address of the database
+        :param count: number of snapshot copies to keep
+        :param interval: seconds after which snapshots are refreshed, or None
+        :param writes: number of writes after which snapshots are refreshed,
+        or None
+        :param background: whether refreshes run on a background thread
+        rather than in the request that made them due
+        """
+        self.filename = filename
+        self.paths = ['{}.replica{}'.format(filename, i) for i in range(count)]
+        self.interval = interval
+        self.writes = writes
+        self.writes_since_refresh = 0
+        self.refreshed_at = None
+        self.background = background
+        self._lock = threading.Lock()
+        self._next = itertools.cycle(range(count))
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._wanted = threading.Event()
+
+    def note_write(self):
+        """
+        Counts a write to the database and refreshes the snapshots if enough
+        writes have been made
+        :return: None
+        """
+
+        self.writes_since_refresh += 1
+
+        if self.writes is not None \
+                and self.writes_since_refresh >= self.writes:
+            self.request_refresh()
+
+    def request_refresh(self):
+        """
+        Has the background thread refresh the snapshots, starting it if
+        needed, or refreshes them straight away without background refreshes
+        :return: None
+        """
+
+        if not self.background:
+            self.refresh()
+            return
+
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='blog-replicas',
+                                                daemon=True)
+                self._thread.start()
+
+        self._wanted.set()
+
+    def _run(self):
+        """
+        Refreshes the snapshots whenever a refresh is requested
+        :return: None
+        """
+
+        while True:
+            self._wanted.wait()
+            self._wanted.clear()
+            self.refresh()
+
+    def is_stale(self):
+        """
+        Checks whether the snapshots are missing or due for a refresh
+        :return: True if the snapshots should be refreshed
+        """
+
+        if self.refreshed_at is None:
+            return True
+
+        if self.interval is not None:
+            return time.time() - self.refreshed_at >= self.interval
+
+        return False
+
+    def refresh(self):
+        """
+        Copies the database into every snapshot. Each copy is written to a
+        temporary file next to the snapshot and then moved over it, so
+        readers of the previous copy are never blocked by the backup. If
+        another thread is already refreshing, returns straight away rather
+        than waiting for it.
+        :return: True if the snapshots were refreshed
+        """
+
+        if not self._lock.acquire(blocking=False):
+            return False
+
+        try:
+            started = time.time()
+            writes = self.writes_since_refresh
+
+            src = sqlite3.connect(self.filename)
+            try:
+                for path in self.paths:
+                    self._copy(src, path)
+                    BlogDB.invalidate_caches(path)
+            except sqlite3.OperationalError:
+                # The database is busy; keep serving the previous copy
+                return False
+            finally:
+                src.close()
+
+            # Writes made during the copy still count towards the next one
+            self.writes_since_refresh -= writes
+            self.refreshed_at = started
+            return True
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def _copy(src, path):
+        """
+        Copies a database into a snapshot through a temporary file in the
+        same directory, which replaces the snapshot once it is complete
+        :param src: sqlite connection to the database
+        :param path: path of the snapshot
+        :return: None
+        """
+
+        tmp_path = path + '.tmp'
+
+        try:
+            dst = sqlite3.connect(tmp_path)
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def snapshot(self, since=None):
+        """
+        Gets the path of a snapshot to read from, requesting a refresh if
+        they are stale. Returns None if there is no snapshot yet or none
+        includes writes made at time since.
+        :param since: time of the caller's last write, or None
+        :return: path of a snapshot, or None
+        """
+
+        if self.is_stale():
+            self.request_refresh()
+
+        if self.refreshed_at is None:
+            return None
+
+        if since is not None and self.refreshed_at < since:
+            return None
+
+        return self.paths[next(self._next)]
+
+
+class JobQueue:
+    """
+    This class runs the jobs queued by write methods, such as copying new
+    blogs into timelines, on a pool of background threads so the requests
+    that wrote do not wait for them. Jobs are rows of the jobs table, so
+    they survive a restart. Failed jobs are retried with exponential
+    backoff. One JobQueue is shared by every BlogDB of a process.
+    """
+
+    def __init__(self, filename, shards=None, replicas=None, workers=2,
+                 max_attempts=5, retry_delay=1.0, poll_interval=1.0,
+                 lease=60.0):
+        """
+        Creates a queue of the jobs in the database stored at filename. The
+        threads are started by resume() when jobs were left over from before
+        a restart, or else by the first notify(), so processes that never
+        write and have nothing to resume do not run any.
+        :param filename: the address of the database
+        :param shards: list of shard database addresses, or None
+        :param replicas: ReplicaSet told about the jobs' writes, or None
+        :param workers: number of threads running jobs
+        :param max_attempts: number of times a job is tried
+        :param retry_delay: seconds before a failed job is first retried
+        :param poll_interval: seconds between checks for due jobs when no
+        write has woken the threads up
+        :param lease: seconds after which a job that a worker took but did
+        not finish, for instance because the process died, runs again
+        """
+        self.filename = filename
+        self.shards = shards
+        self.replicas = replicas
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the worker threads, unless they are already running
+        :return: None
+        """
+
+        with self._lock:
+            if self._threads:
+                return
+
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run,
+                                          name='blog-jobs-{}'.format(i),
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def resume(self):
+        """
+        Starts the worker threads if the database has jobs left over from
+        before a restart. Called when the app starts, since notify() only
+        runs after a write.
+        :return: True if the threads were started
+        """
+
+        uri = 'file:{}?mode=ro'.format(urllib.parse.quote(self.filename))
+
+        try:
+            conn = sqlite3.connect(uri, uri=True)
+            try:
+                pending = conn.execute('SELECT 1 FROM jobs WHERE run_at '
+                                       'IS NOT NULL LIMIT 1').fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            # No database or no jobs table yet, so nothing to resume
+            return False
+
+        if pending is None:
+            return False
+
+        self.start()
+
+        return True
+
+    def notify(self):
+        """
+        Wakes the worker threads up to run newly queued jobs, starting them
+        if needed
+        :return: None
+        """
+
+        self.start()
+        self._wakeup.set()
+
+    def run_once(self, db):
+        """
+        Runs the oldest due job, if any
+        :param db: BlogDB object to run the job with
+        :return: True if a job was run, whether it succeeded or not
+        """
+
+        job = db.claim_job(self.lease)
+
+        if job is None:
+            return False
+
+        try:
+            if job['kind'] not in db.JOB_KINDS:
+                raise ValueError('unknown job {}'.format(job['kind']))
+            getattr(db, job['kind'])(**job['payload'])
+        except Exception as e:
+            logging.getLogger(__name__).exception(
+                'Job %s (%s) failed', job['id'], job['kind'])
+            db.fail_job(job, repr(e), self.max_attempts, self.retry_delay)
+        else:
+            db.finish_job(job['id'])
+
+        return True
+
+    def _run(self):
+        """
+        Runs due jobs until there are none, then sleeps until a write wakes
+        the thread up or poll_interval passes. Each thread has a connection
+        of its own since sqlite connections cannot be shared between threads.
+        :return: None
+        """
+
+        db = BlogDB(self.filename, self.shards, replicas=self.replicas)
+
+        while True:
+            try:
+                while self.run_once(db):
+                    pass
+            except sqlite3.Error:
+                logging.getLogger(__name__).exception('Could not run jobs')
+
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+
+class Subscription(queue.Queue):
+    """
+    This class is the queue of events of one subscriber of an EventBroker.
+    closed is set once the broker stops adding events to it.
+    """
+
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.closed = False
+
+
+class EventBroker:
+    """
+    This class passes new comments to the clients streaming a blog's
+    events. Subscribers block on a queue of their own, so idle streams use
+    no CPU. A subscriber that falls more than queue_size events behind is
+    dropped rather than buffered without limit. One EventBroker is shared by
+    every BlogDB of a process.
+    """
+
+    def __init__(self, queue_size=100):
+        """
+        Creates a broker with no subscribers
+        :param queue_size: number of events each subscriber can fall behind
+        """
+        self.queue_size = queue_size
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, blog_id):
+        """
+        Starts collecting the events of a blog
+        :param blog_id: ID of the blog
+        :return: Subscription object to get the events from
+        """
+
+        subscription = Subscription(self.queue_size)
+
+        with self._lock:
+            self._subscriptions.setdefault(int(blog_id), set()).add(
+                subscription)
+
+        return subscription
+
+    def unsubscribe(self, blog_id, subscription):
+        """
+        Stops adding the events of a blog to a subscription
+        :param blog_id: ID of the blog
+        :param subscription: Subscription object returned by subscribe()
+        :return: None
+        """
+
+        subscription.closed = True
+
+        with self._lock:
+            subscriptions = self._subscriptions.get(int(blog_id))
+
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[int(blog_id)]
+
+    def publish(self, blog_id, event):
+        """
+        Adds an event to the subscriptions of a blog, without waiting on
+        subscribers that are behind
+        :param blog_id: ID of the blog
+        :param event: the event
+        :return: None
+        """
+
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(int(blog_id), ()))
+
+        for subscription in subscriptions:
+            try:
+                subscription.put_nowait(event)
+            except queue.Full:
+                self.unsubscribe(blog_id, subscription)
+
+    def count(self):
+        """
+        Counts the open subscriptions
+        :return: number of subscriptions
+        """
+
+        with self._lock:
+            return sum(len(s) for s in self._subscriptions.values())
+
+
+class Record:
+    """
+    Base of the classes of rows read with the 'record' row format. Values
+    are kept in slots rather than a per-row dictionary, and are read either
+    as attributes or by column name like a dictionary.
+    """
+
+    __slots__ = ()
+
+    # Record classes made by for_columns(), keyed by column names
+    _classes = {}
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def for_columns(cls, columns):
+        """
+        Gets the record class of rows with the given columns, making it the
+        first time
+        :param columns: tuple of column names
+        :return: subclass of Record
+        """
+
+        record_class = cls._classes.get(columns)
+
+        if record_class is None:
+            record_class = type('Record', (cls,), {'__slots__': columns})
+            cls._classes[columns] = record_class
+
+        return record_class
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return self._asdict() == other._asdict()
+        return NotImplemented
+
+    def __repr__(self):
+        return 'Record({})'.format(', '.join(
+            '{}={!r}'.format(name, value)
+            for name, value in self._asdict().items()))
+
+    def keys(self):
+        """
+        Gets the column names, so dict(record) makes a dictionary
+        :return: tuple of column names
+        """
+
+        return self.__slots__
+
+    def get(self, key, default=None):
+        """
+        Gets the value of a column, like dict.get()
+        :param key: column name
+        :param default: value returned if there is no such column
+        :return: the value
+        """
+
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def _asdict(self):
+        """
+        Converts the record to a dictionary
+        :return: dictionary mapping column names to values
+        """
+
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class SafeUrlTreeprocessor(Treeprocessor):
+    """
+    Markdown treeprocessor dropping the href and src attributes whose URL
+    has a scheme not in SCHEMES, such as javascript: links. Character
+    references and the whitespace browsers ignore are taken into account.
+    Relative URLs are kept.
+    """
+
+    SCHEMES = ('http', 'https', 'mailto')
+
+    ATTRIBUTES = ('href', 'src')
+
+    SCHEME_PATTERN = re.compile(r'([a-z][a-z0-9+.-]*):', re.IGNORECASE)
+
+    IGNORED_PATTERN = re.compile(r'[\x00-\x20\x7f]+')
+
+    def run(self, root):
+        for element in root.iter():
+            for attribute in self.ATTRIBUTES:
+                url = element.get(attribute)
+                if url is not None and not self.is_safe(url):
+                    del element.attrib[attribute]
+
+    @classmethod
+    def is_safe(cls, url):
+        """
+        Checks whether a URL may be put in a link or image
+        :param url: the URL
+        :return: True if the URL is relative or has a scheme in SCHEMES
+        """
+
+        url = cls.IGNORED_PATTERN.sub('', html.unescape(url))
+        match = cls.SCHEME_PATTERN.match(url)
+
+        return match is None or match.group(1).lower() in cls.SCHEMES
@@ -10,7 +10,10 @@ Description:
 Get a list of all accounts
 
 Parameters:
-None
+fields - optional comma-separated list of the attributes to return, e.g.
+?fields=id
+ids - optional comma-separated list of at most MAX_IDS IDs, to get only
+those accounts, e.g. ?ids=1,2
 
 Example response:
 [
@@ -82,16 +85,20 @@ Example response:
 GET /api/blogs/
 
 Description:
-Get all blogs
+Get all blogs. Each blog also has an excerpt, its first 200 characters.
 
 Parameters:
-None
+fields - optional comma-separated list of the attributes to return, e.g.
+?fields=id,title,author_id,time,excerpt to list blogs without their content
+ids - optional comma-separated list of at most MAX_IDS IDs, to get only
+those blogs, e.g. ?ids=1,2
 
 Example response:
 [
   {
     "author_id": 1,
     "content": "What do you want to say?",
+    "excerpt": "What do you want to say?",
     "id": 1,
     "time": "Mon Apr 30 00:21:19 2018",
     "title": "Hello World"
@@ -99,6 +106,7 @@ Example response:
   {
     "author_id": 2,
     "content": "What do you want to say?What do you want to say?",
+    "excerpt": "What do you want to say?What do you want to say?",
     "id": 2,
     "time": "Mon Apr 30 00:31:54 2018",
     "title": "ashjashjawhdjas"
@@ -112,6 +120,8 @@ Get a single blog by ID
 
 Parameters:
 blog_id - the ID of the blog
+include - optional comma-separated list of related resources to embed in
+the blog: 'author', 'comments' or both, e.g. ?include=author,comments
 
 Example response:
 {
@@ -122,6 +132,29 @@ Example response:
     "title": "Hello World"
 }
 
+Example response with ?include=author,comments:
+{
+    "author": {
+        "id": 1,
+        "username": "htran20"
+    },
+    "author_id": 1,
+    "comments": [
+        {
+            "author_id": 1,
+            "blog_id": 1,
+            "content": "LOL",
+            "id": 1,
+            "time": "Mon Apr 30 00:21:30 2018",
+            "username": "htran20"
+        }
+    ],
+    "content": "What do you want to say?",
+    "id": 1,
+    "time": "Mon Apr 30 00:21:19 2018",
+    "title": "Hello World"
+}
+
 POST /api/blogs/
 
 Description:
@@ -175,7 +208,10 @@ Description:
 Get all comments
 
 Parameters:
-None
+fields - optional comma-separated list of the attributes to return, e.g.
+?fields=id,blog_id
+ids - optional comma-separated list of at most MAX_IDS IDs, to get only
+those comments, e.g. ?ids=1,2
 
 Example response:
 [
@@ -198,7 +234,9 @@ Example response:
 GET /api/comments/:comment_id
 
 Description:
-Get a single comment by ID
+Get a single comment by ID. parent_id is the ID of the comment it replies
+to, or null for a comment on the blog itself, and path lists the IDs of the
+comment and its ancestors.
 
 Parameters:
 comment_id - the ID of the comment
@@ -208,14 +246,17 @@ Example response:
     "author_id": 1,
     "blog_id": 1,
     "content": "LOL",
-    "id": 1,
+    "id": 2,
+    "parent_id": 1,
+    "path": "0000000001/0000000002/",
     "time": "Mon Apr 30 00:21:30 2018"
 }
 
-POST /api/accounts/
+POST /api/comments/
 
 Description:
-Create a new account with author_id, content, blog_id provided
+Create a new comment with author_id, content, blog_id provided, and
+optionally the parent_id of a comment on the same blog it replies to
 
 Parameters:
 None
@@ -226,6 +267,8 @@ Example response:
     "blog_id": 1,
     "content": "LOL",
     "id": 1,
+    "parent_id": null,
+    "path": "0000000001/",
     "time": "Mon Apr 30 00:21:30 2018"
 }
 
@@ -249,7 +292,7 @@ Example response:
 DELETE /api/comments/:comment_id
 
 Description:
-Delete a comment
+Delete a comment and the replies to it
 
 Parameters:
 id - the ID of the comment
@@ -258,30 +301,177 @@ Example response:
 {
   "Delete Successfully"
 }
+
+GET /api/jobs/
+
+Description:
+Get the number of background jobs that are ready to run, scheduled to be
+retried later, running, and failed for good. Requires logging in.
+
+Parameters:
+None
+
+Example response:
+{
+    "failed": 0,
+    "ready": 3,
+    "running": 2,
+    "scheduled": 1
+}
 """
+import gzip
 import hashlib
+import json
 import os
+import queue
+import shutil
 import sys
-import requests
+import threading
+import time
+import click
+from collections import OrderedDict
 from functools import wraps
-from flask import Flask, g, jsonify, request, render_template,\
-    redirect
+from flask import Blueprint, Flask, Response, current_app, g, jsonify,\
+    request, render_template, redirect, session, url_for
 from flask_login import LoginManager, UserMixin, login_user,\
     logout_user, current_user, login_required
+from flask.json.provider import DefaultJSONProvider
 from flask.views import MethodView
-from blogdb import BlogDB
+from jinja2 import FileSystemBytecodeCache
+from blogdb import BlogDB, EventBroker, JobQueue, Record, ReplicaSet
 
-app = Flask(__name__)
+bp = Blueprint('blog', __name__, cli_group=None)
 login_manager = LoginManager()
-login_manager.init_app(app)
 
-app.config['DATABASE'] = os.path.join(app.root_path, 'blog.sqlite')
-app.config["SECRET_KEY"] = 'hello'
-app.config.update(
-    DATABASE=os.path.join(app.root_path, 'WooMessages.sqlite'),
-    DEBUG=True,
-    SECRET_KEY='hello'
-)
+
+def create_app(config=None):
+    """
+    Creates an instance of the blog app, so that several differently
+    configured instances can run in one process.
+    :param config: dictionary of settings overriding the defaults, or None
+    :return: the Flask app
+    """
+
+    app = Flask(__name__)
+    app.json = BlogJSONProvider(app)
+    app.config.update(
+        DATABASE=os.path.join(app.root_path, 'WooMessages.sqlite'),
+        # List of shard database files for blogs and comments. When empty,
+        # everything is stored in DATABASE.
+        DATABASE_SHARDS=[],
+        # Number of read-only snapshot copies of DATABASE to serve GET
+        # requests from. Snapshots are refreshed every
+        # REPLICA_REFRESH_INTERVAL seconds or after REPLICA_REFRESH_WRITES
+        # writes, whichever comes first. With READ_YOUR_WRITES, a session
+        # that wrote reads from DATABASE until a snapshot includes its write.
+        DATABASE_REPLICAS=0,
+        REPLICA_REFRESH_INTERVAL=5.0,
+        REPLICA_REFRESH_WRITES=100,
+        READ_YOUR_WRITES=True,
+        # Blog content larger than this many bytes is stored zlib
+        # compressed. None stores all content as text.
+        CONTENT_COMPRESS_THRESHOLD=None,
+        # Number of background threads running the follow-up work of
+        # writes, such as copying new blogs into followers' timelines. With
+        # 0 the work is done before the write request returns. Failed jobs
+        # are tried JOB_MAX_ATTEMPTS times, first retried after
+        # JOB_RETRY_DELAY seconds and then after twice as long each time.
+        JOB_WORKERS=2,
+        JOB_MAX_ATTEMPTS=5,
+        JOB_RETRY_DELAY=1.0,
+        JOB_POLL_INTERVAL=1.0,
+        # Number of blogs shown on the homepage, and on each page of an
+        # author's blogs
+        HOMEPAGE_LENGTH=50,
+        # Maximum number of IDs a collection request can ask for with ?ids=
+        MAX_IDS=100,
+        AUTHOR_PAGE_SIZE=10,
+        # Number of authors listed on each page of the author page's menu
+        AUTHOR_MENU_SIZE=20,
+        # How API listings hold their rows before serializing them: 'record'
+        # keeps each row in slots instead of a dictionary, 'dict' uses
+        # dictionaries and 'columns' returns an object of arrays, one per
+        # column, instead of an array of objects
+        API_ROW_FORMAT='record',
+        # Number of new comments a client streaming a blog's events can fall
+        # behind before its stream is closed, and seconds between keepalive
+        # messages on idle streams
+        EVENT_QUEUE_SIZE=100,
+        EVENT_KEEPALIVE=15.0,
+        # Token buckets limiting the POST, PATCH and DELETE requests of each
+        # client IP and each logged in or author_id account, as a tuple of
+        # the burst size and the number of requests allowed per second.
+        # None disables a limit. Buckets of the RATE_LIMIT_KEYS most recent
+        # clients are kept.
+        RATE_LIMIT_PER_IP=(60, 2.0),
+        RATE_LIMIT_PER_ACCOUNT=(30, 1.0),
+        RATE_LIMIT_KEYS=10000,
+        # Number of read (GET) and write requests handled at once, and
+        # number of requests of each kind allowed to wait for a turn, as a
+        # tuple. Requests beyond that, or waiting more than
+        # ADMISSION_TIMEOUT seconds, get 503 straight away. Writes have a
+        # low limit because SQLite has a single writer. None disables a
+        # limit.
+        ADMISSION_READS=(32, 64),
+        ADMISSION_WRITES=(4, 16),
+        ADMISSION_TIMEOUT=2.0,
+        # Whether each request first checks PRAGMA data_version so that
+        # values cached by this process, such as the author directory, are
+        # dropped after other processes write to the database. Only turn it
+        # off when a single process serves the app.
+        CHECK_DATA_VERSION=True,
+        # Responses of these types and at least GZIP_MIN_SIZE bytes are
+        # gzipped for clients that accept it. The gzipped bodies of the last
+        # GZIP_CACHE_SIZE distinct responses are kept so hot pages are not
+        # compressed again on every hit. Static files are sent as files and
+        # are left to the front-end server to compress.
+        GZIP_MIMETYPES=['text/html', 'text/plain', 'application/json'],
+        GZIP_MIN_SIZE=500,
+        GZIP_LEVEL=6,
+        GZIP_CACHE_SIZE=128,
+        # Folder inside the static folder where 'flask build-assets' writes
+        # content-hash fingerprinted copies of the static files and their
+        # manifest. Fingerprinted files are served with immutable caching.
+        ASSET_DIST='dist',
+        ASSET_MAX_AGE=365 * 24 * 60 * 60,
+        # Folder where compiled templates are cached so new workers do not
+        # compile them again. None disables the cache.
+        TEMPLATE_CACHE_DIR=os.path.join(app.instance_path, 'jinja_cache'),
+        DEBUG=True,
+        SECRET_KEY='hello'
+    )
+
+    if config is not None:
+        app.config.update(config)
+
+    if app.config['TEMPLATE_CACHE_DIR'] is not None:
+        os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            app.config['TEMPLATE_CACHE_DIR'])
+
+    login_manager.init_app(app)
+    app.register_blueprint(bp)
+
+    # Jobs left over from before a restart run without waiting for a write
+    with app.app_context():
+        jobs = get_jobs()
+        if jobs is not None:
+            jobs.resume()
+
+    return app
+
+
+class BlogJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider that also serializes the Record rows of BlogDB listings.
+    Each record is converted to a dictionary only while it is encoded.
+    """
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, Record):
+            return o._asdict()
+        return DefaultJSONProvider.default(o)
 
 
 class User(UserMixin):
@@ -294,17 +484,270 @@ def load_user(user_id):
     return User(user_id)
 
 
-@app.cli.command('initdb')
+@bp.cli.command('initdb')
 def initdb_command():
     """
     Implements blog database initialization
     :return: prints statement confirming initialization of database
     """
-    BlogDB(app.config['DATABASE']).init_db()
+    BlogDB(current_app.config['DATABASE'],
+           current_app.config['DATABASE_SHARDS']).init_db()
 
     print('Initialized the blog database.')
 
 
+@bp.cli.command('upgradedb')
+def upgradedb_command():
+    """
+    Adds tables and columns introduced since the database was initialized
+    :return: prints statement confirming the upgrade of the database
+    """
+    get_db().upgrade_db()
+
+    print('Upgraded the blog database.')
+
+
+@bp.cli.command('backup')
+@click.argument('target')
+@click.option('--pages', default=64, help='Pages copied per step.')
+@click.option('--sleep', default=0.01,
+              help='Seconds to sleep between steps.')
+@click.option('--gzip', 'compress', is_flag=True,
+              help='Compress the backup with gzip.')
+def backup_command(target, pages, sleep, compress):
+    """
+    Copies the live blog database to TARGET without blocking writers
+    :return: prints statement reporting the size and speed of the backup
+    """
+    db = get_db()
+    stats = db.backup(target, pages, sleep, compress)
+
+    print('Backed up {} pages in {:.2f} seconds ({:.0f} pages/s).'.format(
+        stats['pages'], stats['duration'], stats['pages_per_second']))
+
+
+def open_ndjson(path, mode, compress):
+    """
+    Opens an NDJSON file for the export and import commands. '-' stands for
+    stdout or stdin.
+    :param path: address of the file, or '-'
+    :param mode: 'r' or 'w'
+    :param compress: whether the file is gzip compressed
+    :return: a text file object
+    """
+
+    if compress or path.endswith('.gz'):
+        if path == '-':
+            path = click.get_binary_stream('stdin' if mode == 'r'
+                                           else 'stdout')
+        return gzip.open(path, mode + 't', encoding='utf-8')
+
+    return click.open_file(path, mode, encoding='utf-8')
+
+
+def print_progress(count):
+    """
+    Prints the number of rows exported or imported so far on stderr
+    :param count: number of rows
+    :return: None
+    """
+    click.echo('\r{} rows'.format(count), nl=False, err=True)
+
+
+@bp.cli.command('export')
+@click.argument('target', default='-')
+@click.option('--gzip', 'compress', is_flag=True,
+              help='Compress the output with gzip.')
+@click.option('--batch-size', default=500, help='Rows fetched at a time.')
+def export_command(target, compress, batch_size):
+    """
+    Exports all accounts, blogs and comments to TARGET as NDJSON
+    :return: prints statement with the number of rows exported
+    """
+    db = get_db()
+
+    with open_ndjson(target, 'w', compress) as out:
+        count = db.export_rows(out, batch_size, print_progress)
+
+    click.echo('\nExported {} rows.'.format(count), err=True)
+
+
+@bp.cli.command('import')
+@click.argument('source', default='-')
+@click.option('--gzip', 'compress', is_flag=True,
+              help='Decompress the input with gzip.')
+@click.option('--batch-size', default=500,
+              help='Rows inserted per transaction.')
+def import_command(source, compress, batch_size):
+    """
+    Imports accounts, blogs and comments from an NDJSON file written by
+    'flask export' into an initialized database
+    :return: prints statement with the number of rows imported
+    """
+    db = get_db()
+
+    with open_ndjson(source, 'r', compress) as src:
+        count = db.import_rows(src, batch_size, print_progress)
+
+    click.echo('\nImported {} rows.'.format(count), err=True)
+
+
+@bp.cli.command('compress-content')
+@click.option('--batch-size', default=500,
+              help='Blogs compressed per transaction.')
+def compress_content_command(batch_size):
+    """
+    Compresses the content of existing blogs larger than
+    CONTENT_COMPRESS_THRESHOLD
+    :return: prints statement with the number of blogs compressed
+    """
+    if current_app.config['CONTENT_COMPRESS_THRESHOLD'] is None:
+        sys.exit('CONTENT_COMPRESS_THRESHOLD is not set')
+
+    count = get_db().compress_existing_content(batch_size)
+
+    print('Compressed {} blogs.'.format(count))
+
+
+@bp.cli.command('prune-rendered')
+@click.option('--batch-size', default=500,
+              help='Rows read and deleted at a time.')
+def prune_rendered_command(batch_size):
+    """
+    Deletes cached HTML that no blog or comment content renders to anymore
+    :return: prints statement with the number of entries deleted
+    """
+    count = get_db().prune_rendered(batch_size)
+
+    print('Deleted {} rendered entries.'.format(count))
+
+
+def build_assets(static_folder, dist):
+    """
+    Copies every static file to a name containing a hash of its content and
+    writes a manifest.json mapping the original names to the new ones.
+    :param static_folder: address of the static folder
+    :param dist: name of the folder inside static_folder to write to
+    :return: the manifest as a dictionary
+    """
+
+    dist_folder = os.path.join(static_folder, dist)
+    manifest = {}
+
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != dist_folder]
+
+        for name in files:
+            if name.startswith('.'):
+                continue
+
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, static_folder).replace(os.sep,
+                                                                    '/')
+
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:12]
+
+            base, ext = os.path.splitext(filename)
+            fingerprinted = '{}/{}.{}{}'.format(dist, base, digest, ext)
+
+            target = os.path.join(static_folder, fingerprinted)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(path, target)
+
+            manifest[filename] = fingerprinted
+
+    with open(os.path.join(dist_folder, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+@bp.cli.command('build-assets')
+def build_assets_command():
+    """
+    Writes fingerprinted copies of the static files and their manifest
+    :return: prints statement with the number of files fingerprinted
+    """
+    manifest = build_assets(current_app.static_folder,
+                            current_app.config['ASSET_DIST'])
+    current_app.extensions['asset_manifest'] = manifest
+
+    print('Fingerprinted {} static files.'.format(len(manifest)))
+
+
+@bp.cli.command('precompile-templates')
+def precompile_templates_command():
+    """
+    Compiles every template into the template cache so that the first
+    request of a new worker does not pay for compiling them
+    :return: prints statement with the number of templates compiled
+    """
+    if current_app.jinja_env.bytecode_cache is None:
+        sys.exit('TEMPLATE_CACHE_DIR is not set')
+
+    names = current_app.jinja_env.list_templates(extensions=['html'])
+
+    for name in names:
+        current_app.jinja_env.get_template(name)
+
+    print('Precompiled {} templates.'.format(len(names)))
+
+
+def get_asset_manifest():
+    """
+    Gets the manifest written by 'flask build-assets', loading it the first
+    time it is needed. The manifest is empty if the assets were not built.
+    :return: dictionary mapping static file names to fingerprinted names
+    """
+
+    manifest = current_app.extensions.get('asset_manifest')
+
+    if manifest is None:
+        path = os.path.join(current_app.static_folder,
+                            current_app.config['ASSET_DIST'], 'manifest.json')
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {}
+        current_app.extensions['asset_manifest'] = manifest
+
+    return manifest
+
+
+@bp.app_template_global()
+def asset_url(filename):
+    """
+    Gets the URL of a static file, fingerprinted if the assets were built
+    :param filename: name of the file in the static folder
+    :return: URL of the file
+    """
+
+    filename = get_asset_manifest().get(filename, filename)
+
+    return url_for('static', filename=filename)
+
+
+@bp.after_app_request
+def cache_fingerprinted_assets(response):
+    """
+    Lets clients cache fingerprinted static files forever, since their URL
+    changes whenever their content does.
+    :param response: the response
+    :return: the response
+    """
+
+    if request.endpoint == 'static' and response.status_code == 200 \
+            and request.view_args['filename'] in \
+            get_asset_manifest().values():
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['ASSET_MAX_AGE']
+        response.cache_control.immutable = True
+
+    return response
+
+
 def get_db():
     """
     Connects to the database. If a connection has already been created,
@@ -313,12 +756,135 @@ def get_db():
     """
 
     if not hasattr(g, 'sqlite_db'):
-        g.sqlite_db = BlogDB(app.config['DATABASE'])
+        g.sqlite_db = BlogDB(current_app.config['DATABASE'],
+                             current_app.config['DATABASE_SHARDS'],
+                             replicas=get_replicas(),
+                             compress_threshold=current_app.config[
+                                 'CONTENT_COMPRESS_THRESHOLD'],
+                             jobs=get_jobs(), events=get_events())
         g.sqlite_db.connect_db()
 
     return g.sqlite_db
 
 
+def get_replicas():
+    """
+    Gets the set of read-only snapshots shared by all requests, creating it
+    the first time it is needed.
+    :return: ReplicaSet object, or None if replicas are disabled
+    """
+
+    if not current_app.config['DATABASE_REPLICAS']:
+        return None
+
+    replicas = current_app.extensions.get('blog_replicas')
+
+    if replicas is None or replicas.filename != current_app.config['DATABASE']:
+        replicas = ReplicaSet(current_app.config['DATABASE'],
+                              current_app.config['DATABASE_REPLICAS'],
+                              current_app.config['REPLICA_REFRESH_INTERVAL'],
+                              current_app.config['REPLICA_REFRESH_WRITES'])
+        current_app.extensions['blog_replicas'] = replicas
+
+    return replicas
+
+
+def get_jobs():
+    """
+    Gets the queue of background jobs shared by all requests, creating it
+    the first time it is needed.
+    :return: JobQueue object, or None if the follow-up work of writes is
+    done before the write request returns
+    """
+
+    if not current_app.config['JOB_WORKERS']:
+        return None
+
+    jobs = current_app.extensions.get('blog_jobs')
+
+    if jobs is None or jobs.filename != current_app.config['DATABASE']:
+        jobs = JobQueue(current_app.config['DATABASE'],
+                        current_app.config['DATABASE_SHARDS'],
+                        get_replicas(),
+                        current_app.config['JOB_WORKERS'],
+                        current_app.config['JOB_MAX_ATTEMPTS'],
+                        current_app.config['JOB_RETRY_DELAY'],
+                        current_app.config['JOB_POLL_INTERVAL'])
+        current_app.extensions['blog_jobs'] = jobs
+
+    return jobs
+
+
+def get_events():
+    """
+    Gets the broker passing new comments to event streams, shared by all
+    requests, creating it the first time it is needed.
+    :return: EventBroker object
+    """
+
+    events = current_app.extensions.get('blog_events')
+
+    if events is None:
+        events = EventBroker(current_app.config['EVENT_QUEUE_SIZE'])
+        current_app.extensions['blog_events'] = events
+
+    return events
+
+
+def get_read_db():
+    """
+    Gets the database to serve reads from. This is a read-only snapshot when
+    replicas are enabled, unless the current session has written since the
+    snapshot was taken.
+    :return: BlogDB object representing the database
+    """
+
+    if not hasattr(g, 'read_db'):
+        since = None
+        if current_app.config['READ_YOUR_WRITES']:
+            since = session.get('last_write')
+        g.read_db = get_db().reader(since)
+
+    return g.read_db
+
+
+@bp.teardown_app_request
+def close_db(error):
+    """
+    Closes the request's database connections, including those to a
+    snapshot
+    :param error: exception raised by the request, or None
+    :return: None
+    """
+
+    read_db = g.pop('read_db', None)
+    db = g.pop('sqlite_db', None)
+
+    if read_db is not None and read_db is not db:
+        read_db.close()
+
+    if db is not None:
+        db.close()
+
+
+@bp.after_app_request
+def remember_last_write(response):
+    """
+    Records the time of the request's last write in the session so that
+    later reads by the same session can avoid stale snapshots.
+    :param response: the response
+    :return: the response
+    """
+
+    db = g.get('sqlite_db')
+
+    if db is not None and db.last_write is not None \
+            and current_app.config['READ_YOUR_WRITES']:
+        session['last_write'] = db.last_write
+
+    return response
+
+
 def verify_account_by_id(id):
     """
     Prompts users for the username and password. Checks the username and
@@ -348,6 +914,9 @@ def verify_account_by_id(id):
     if hashed_password != account['password']:
         raise RequestError(401, 'Invalid authentication')
 
+    if request.method in ('POST', 'PUT', 'PATCH', 'DELETE'):
+        limit_account(account['id'])
+
 
 def log_in():
     """
@@ -399,6 +968,537 @@ def browser_log_in(username, password):
         raise RequestError(401, 'Invalid authentication')
 
 
+class GzipCache:
+    """
+    This class keeps the gzipped bodies of recently served responses, keyed
+    by a hash of the uncompressed body. Hashing is much cheaper than
+    compressing, so a page served again unchanged is not compressed again.
+    """
+
+    def __init__(self, size, level):
+        """
+        Creates an empty cache
+        :param size: maximum number of bodies kept
+        :param level: gzip compression level
+        """
+        self.size = size
+        self.level = level
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def compress(self, data):
+        """
+        Gets the gzipped version of a body, from the cache if possible
+        :param data: uncompressed body
+        :return: compressed body
+        """
+
+        key = hashlib.sha1(data).digest()
+
+        with self._lock:
+            body = self._bodies.get(key)
+            if body is not None:
+                self._bodies.move_to_end(key)
+                return body
+
+        body = gzip.compress(data, self.level)
+
+        with self._lock:
+            self._bodies[key] = body
+            if len(self._bodies) > self.size:
+                self._bodies.popitem(last=False)
+
+        return body
+
+
+def get_gzip_cache():
+    """
+    Gets the cache of gzipped response bodies, creating it the first time it
+    is needed.
+    :return: GzipCache object
+    """
+
+    cache = current_app.extensions.get('gzip_cache')
+
+    if cache is None:
+        cache = GzipCache(current_app.config['GZIP_CACHE_SIZE'],
+                          current_app.config['GZIP_LEVEL'])
+        current_app.extensions['gzip_cache'] = cache
+
+    return cache
+
+
+@bp.after_app_request
+def compress_response(response):
+    """
+    Gzips the response if the client accepts it and the response is large
+    enough and of a compressible type. Static files are passed through as
+    files and never gzipped here; the front-end server compresses them.
+    :param response: the response
+    :return: the possibly compressed response
+    """
+
+    if response.mimetype not in current_app.config['GZIP_MIMETYPES']:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if request.accept_encodings.quality('gzip') <= 0 \
+            or response.direct_passthrough or response.is_streamed \
+            or response.status_code != 200 \
+            or 'Content-Encoding' in response.headers:
+        return response
+
+    data = response.get_data()
+
+    if len(data) < current_app.config['GZIP_MIN_SIZE']:
+        return response
+
+    response.set_data(get_gzip_cache().compress(data))
+    response.headers['Content-Encoding'] = 'gzip'
+
+    return response
+
+
+class TokenBuckets:
+    """
+    This class keeps a token bucket per key, such as a client IP. Buckets
+    are refilled when they are next used rather than on a timer, so a check
+    costs O(1) whatever the number of keys. Only the buckets of the most
+    recently used keys are kept; a forgotten bucket comes back full.
+    """
+
+    def __init__(self, capacity, rate, size):
+        """
+        Creates buckets holding up to capacity tokens, refilled at rate
+        tokens per second
+        :param capacity: maximum number of tokens, the allowed burst
+        :param rate: number of tokens added per second
+        :param size: maximum number of buckets kept
+        """
+        self.capacity = capacity
+        self.rate = rate
+        self.size = size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def wait(self, key):
+        """
+        Gets how long the bucket of a key needs to have a token, without
+        taking it
+        :param key: the key
+        :return: 0 if the bucket has a token, otherwise the number of
+        seconds until it has one
+        """
+
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.capacity, now))
+
+        tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def put_back(self, key):
+        """
+        Returns a token taken from the bucket of a key, for a request that
+        was turned away by another limit
+        :param key: the key
+        :return: None
+        """
+
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated = self._buckets[key]
+                self._buckets[key] = (min(self.capacity, tokens + 1),
+                                      updated)
+
+    def take(self, key):
+        """
+        Takes a token from the bucket of a key
+        :param key: the key
+        :return: 0 if a token was taken, otherwise the number of seconds
+        until the bucket has one
+        """
+
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.size:
+                self._buckets.popitem(last=False)
+
+        return wait
+
+
+def get_rate_limits():
+    """
+    Gets the token buckets of client IPs and accounts, creating them the
+    first time they are needed.
+    :return: dictionary of TokenBuckets objects keyed by 'ip' and 'account',
+    without the limits that are disabled
+    """
+
+    limits = current_app.extensions.get('rate_limits')
+
+    if limits is None:
+        limits = {}
+        for name, setting in (('ip', 'RATE_LIMIT_PER_IP'),
+                              ('account', 'RATE_LIMIT_PER_ACCOUNT')):
+            if current_app.config[setting] is not None:
+                capacity, rate = current_app.config[setting]
+                limits[name] = TokenBuckets(
+                    capacity, rate, current_app.config['RATE_LIMIT_KEYS'])
+        current_app.extensions['rate_limits'] = limits
+
+    return limits
+
+
+def take_tokens(keys):
+    """
+    Takes a token from the bucket of each key, or from none of them and
+    rejects the request with 429 if any bucket is empty. Tokens taken are
+    remembered so that a later rejection can put them back.
+    :param keys: dictionary mapping 'ip' or 'account' to the key
+    :return: None
+    """
+
+    limits = get_rate_limits()
+    keys = {name: key for name, key in keys.items() if name in limits}
+
+    wait = max([limits[name].wait(key) for name, key in keys.items()] + [0])
+
+    if wait:
+        for name, key in g.pop('rate_limit_keys', {}).items():
+            limits[name].put_back(key)
+        raise RequestError(429, 'Too many requests',
+                           {'Retry-After': str(int(wait) + 1)})
+
+    for name, key in keys.items():
+        limits[name].take(key)
+
+    g.rate_limit_keys = dict(g.get('rate_limit_keys', {}), **keys)
+
+
+def limit_account(account_id):
+    """
+    Applies the account rate limit to a write once its account is verified,
+    unless the logged in account was already limited
+    :param account_id: ID of the verified account
+    :return: None
+    """
+
+    if 'account' not in g.get('rate_limit_keys', {}):
+        take_tokens({'account': int(account_id)})
+
+
+@bp.before_app_request
+def limit_writes():
+    """
+    Rejects write requests with 429 once the client IP or the logged in
+    account has used up its token bucket. Accounts named in API requests are
+    limited by verify_account_by_id() once their password is checked, so a
+    client cannot use up the bucket of someone else's account. Reads are not
+    limited.
+    :return: None
+    """
+
+    if request.method not in ('POST', 'PUT', 'PATCH', 'DELETE'):
+        return
+
+    keys = {'ip': request.remote_addr}
+
+    if current_user.is_authenticated:
+        keys['account'] = int(current_user.id)
+
+    take_tokens(keys)
+
+
+class AdmissionLimit:
+    """
+    This class limits the number of requests handled at once. Requests over
+    the limit wait in a bounded queue, and are turned away when the queue is
+    full or their turn does not come before a deadline, so an overloaded
+    server answers at once instead of piling requests up until they time
+    out.
+    """
+
+    def __init__(self, limit, queue_size, timeout):
+        """
+        Creates a limit with no requests in progress
+        :param limit: number of requests handled at once
+        :param queue_size: number of requests allowed to wait
+        :param timeout: seconds a request may wait
+        """
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Waits for a turn to handle a request
+        :return: True if the request may go ahead, False if it was turned
+        away
+        """
+
+        with self._condition:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+
+            if self.waiting >= self.queue_size:
+                return False
+
+            deadline = time.monotonic() + self.timeout
+            self.waiting += 1
+
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+            self.active += 1
+            return True
+
+    def release(self):
+        """
+        Ends the turn of a request, letting the next waiting one go ahead
+        :return: None
+        """
+
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+def get_admission_limits():
+    """
+    Gets the limits of concurrent reads and writes, creating them the first
+    time they are needed.
+    :return: dictionary of AdmissionLimit objects keyed by 'read' and
+    'write', without the limits that are disabled
+    """
+
+    limits = current_app.extensions.get('admission_limits')
+
+    if limits is None:
+        limits = {}
+        for name, setting in (('read', 'ADMISSION_READS'),
+                              ('write', 'ADMISSION_WRITES')):
+            if current_app.config[setting] is not None:
+                limit, queue_size = current_app.config[setting]
+                limits[name] = AdmissionLimit(
+                    limit, queue_size, current_app.config['ADMISSION_TIMEOUT'])
+        current_app.extensions['admission_limits'] = limits
+
+    return limits
+
+
+@bp.before_app_request
+def admit_request():
+    """
+    Waits for a turn under the read or write limit, and rejects the request
+    with 503 if it does not get one. Static files and event streams, which
+    stay open for a long time, are not limited.
+    :return: None
+    """
+
+    if request.endpoint in ('static', 'blog.stream_blog_events'):
+        return
+
+    if request.method in ('GET', 'HEAD', 'OPTIONS'):
+        limit = get_admission_limits().get('read')
+    else:
+        limit = get_admission_limits().get('write')
+
+    if limit is None:
+        return
+
+    if not limit.acquire():
+        raise RequestError(503, 'Server is busy', {'Retry-After': '1'})
+
+    g.admission_limit = limit
+
+
+@bp.teardown_app_request
+def end_admission(error):
+    """
+    Ends the request's turn under the read or write limit
+    :param error: exception raised by the request, or None
+    :return: None
+    """
+
+    limit = g.pop('admission_limit', None)
+
+    if limit is not None:
+        limit.release()
+
+
+@bp.before_app_request
+def check_data_version():
+    """
+    Drops the values cached from the database if another process wrote to
+    it since the last request. Static files do not read the database.
+    :return: None
+    """
+
+    if request.endpoint == 'static':
+        return
+
+    if current_app.config['CHECK_DATA_VERSION']:
+        BlogDB.check_data_version(current_app.config['DATABASE'])
+
+
+def get_fields():
+    """
+    Gets the attributes a collection request asked for with ?fields=
+    :return: list of attribute names, or None for all attributes
+    """
+
+    fields = request.args.get('fields')
+
+    if fields is None:
+        return None
+
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+
+    if not fields:
+        raise RequestError(422, 'fields must name at least one attribute')
+
+    return fields
+
+
+def get_ids():
+    """
+    Gets the IDs a collection request asked for with ?ids=, at most
+    MAX_IDS of them
+    :return: list of IDs, or None for all rows
+    """
+
+    ids = request.args.get('ids')
+
+    if ids is None:
+        return None
+
+    try:
+        ids = [int(item) for item in ids.split(',') if item.strip()]
+    except ValueError:
+        raise RequestError(422, 'ids must be a comma-separated list of '
+                                'integers')
+
+    if len(ids) > current_app.config['MAX_IDS']:
+        raise RequestError(422, 'at most {} ids can be asked for'.format(
+            current_app.config['MAX_IDS']))
+
+    return ids
+
+
+def get_rows(db, table_name):
+    """
+    Gets the rows of a collection request, limited to the fields and IDs
+    asked for with ?fields= and ?ids=
+    :param db: BlogDB object to read from
+    :param table_name: name of the table
+    :return: the rows, in the API_ROW_FORMAT representation when all of
+    them are listed
+    """
+
+    fields = get_fields()
+    ids = get_ids()
+    row_format = current_app.config['API_ROW_FORMAT']
+
+    try:
+        if ids is not None:
+            return db.get_rows_by_ids(table_name, ids, fields)
+        elif table_name == 'account':
+            return db.get_all_accounts(fields, row_format)
+        else:
+            return db.get_all_rows(table_name, fields, row_format)
+    except ValueError as e:
+        raise RequestError(422, str(e))
+
+
+def include_related(db, blog):
+    """
+    Embeds the resources asked for with ?include= in a blog. Comments get
+    their author's username, fetched with a single query.
+    :param db: BlogDB object to read from
+    :param blog: dictionary representing the blog
+    :return: the dictionary
+    """
+
+    include = request.args.get('include')
+
+    if include is None:
+        return blog
+
+    include = [item.strip() for item in include.split(',') if item.strip()]
+
+    for item in include:
+        if item not in ('author', 'comments'):
+            raise RequestError(422, 'cannot include {}'.format(item))
+
+    comments = []
+    if 'comments' in include:
+        comments = db.get_comments_from_blog(blog['id'])
+
+    author_ids = [blog['author_id']] + [c['author_id'] for c in comments]
+    accounts = {}
+    for account in db.get_rows_by_ids('account', author_ids):
+        accounts[account['id']] = account
+
+    if 'author' in include:
+        blog['author'] = accounts.get(blog['author_id'])
+
+    if 'comments' in include:
+        for comment in comments:
+            account = accounts.get(comment['author_id'])
+            comment['username'] = account['username'] if account else None
+        blog['comments'] = comments
+
+    return blog
+
+
+def add_rendered_html(db, items):
+    """
+    Adds the HTML rendered from the Markdown content of blogs or comments
+    to them under the 'html' key.
+    :param db: BlogDB object to read the rendered HTML cache from
+    :param items: list of dictionaries representing blogs or comments
+    :return: the list of dictionaries
+    """
+
+    contents = [item['content'] for item in items]
+
+    for item, html in zip(items, db.get_rendered_html(contents)):
+        item['html'] = html
+
+    return items
+
+
 class RequestError(Exception):
     """
     This custom exception class is for easily handling errors in requests,
@@ -406,11 +1506,12 @@ class RequestError(Exception):
     required field.
     """
 
-    def __init__(self, status_code, error_message):
+    def __init__(self, status_code, error_message, headers=None):
         Exception.__init__(self)
 
         self.status_code = str(status_code)
         self.error_message = error_message
+        self.headers = headers or {}
 
     def to_response(self):
         """
@@ -420,10 +1521,11 @@ class RequestError(Exception):
 
         response = jsonify({'error': self.error_message})
         response.status = self.status_code
+        response.headers.extend(self.headers)
         return response
 
 
-@app.errorhandler(RequestError)
+@bp.app_errorhandler(RequestError)
 def handle_invalid_usage(error):
     """
     Returns a JSON response built from a RequestError.
@@ -447,19 +1549,19 @@ class BlogsView(MethodView):
         :return: JSON response
         """
 
-        db = get_db()
-        if db.get_all_accounts() == []:
+        db = get_read_db()
+        if not db.has_accounts():
             response = jsonify([])
         else:
             log_in()
             if blog_id is None:
-                response = jsonify(db.get_all_rows('blog'))
+                response = jsonify(get_rows(db, 'blog'))
             else:
                 blog = db.query_by_id('blog', blog_id)
 
                 if blog is not None:
 
-                    response = jsonify(blog)
+                    response = jsonify(include_related(db, blog))
                 else:
                     raise RequestError(404, 'blog not found')
 
@@ -562,13 +1664,13 @@ class AccountsView(MethodView):
         :return: JSON response
         """
 
-        db = get_db()
-        if db.get_all_accounts() == []:
+        db = get_read_db()
+        if not db.has_accounts():
             response = jsonify([])
         else:
             log_in()
             if account_id is None:
-                response = jsonify(db.get_all_accounts())
+                response = jsonify(get_rows(db, 'account'))
             else:
                 account = db.get_account_by_id(account_id)
 
@@ -656,13 +1758,13 @@ class CommentsView(MethodView):
         :return: JSON response
         """
 
-        db = get_db()
-        if db.get_all_accounts() == []:
+        db = get_read_db()
+        if not db.has_accounts():
             response = jsonify([])
         else:
             log_in()
             if comment_id is None:
-                response = jsonify(db.get_all_rows('comment'))
+                response = jsonify(get_rows(db, 'comment'))
 
                 return response
             else:
@@ -680,7 +1782,7 @@ class CommentsView(MethodView):
         Handles a POST request to insert a new comment. Returns a JSON
         response representing the new comment.
         The comment's content, blog_id, author_id must be provided in the
-        requests's form data.
+        requests's form data, parent_id is optional.
         :return: a response containing the JSON representation of the comment
         """
 
@@ -695,9 +1797,10 @@ class CommentsView(MethodView):
             verify_account_by_id(request.form['author_id'])
             insert = db.insert_comment(request.form['blog_id'],
                                        request.form['author_id'],
-                                       request.form['content'])
+                                       request.form['content'],
+                                       request.form.get('parent_id'))
             if insert is None:
-                raise RequestError(404, 'blog_id not found')
+                raise RequestError(404, 'blog_id or parent_id not found')
             else:
                 response = jsonify(insert)
 
@@ -753,7 +1856,7 @@ class CommentsView(MethodView):
         return response
 
 
-@app.route('/signup', methods=['GET', 'POST'])
+@bp.route('/signup', methods=['GET', 'POST'])
 def sign_up():
     """
     Serves a page for signing up.
@@ -782,7 +1885,7 @@ def sign_up():
     return render_template('signup.html')
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def show_login_page():
     """
     Serves a page for logging in when the request is GET.
@@ -805,24 +1908,21 @@ def show_login_page():
         account = db.get_account_by_username(username)
         login_user(User(account['id']))
 
-        blogs = db.get_all_rows('blog')
-        blogs_with_authors = []
-
-        for blog in blogs:
-            blogs_with_authors.append(db.get_blog_by_id(blog['id']))
-
-        blogs_with_authors.reverse()
-        authors = db.get_all_accounts()
+        db = get_read_db()
+        blogs_with_authors = db.get_blog_excerpts(
+            current_app.config['HOMEPAGE_LENGTH'])
+        top_author = db.get_author_directory(limit=1)[0]
 
         return render_template('homepage.html', blogs=blogs_with_authors,
-                               author=authors[0])
+                               author=top_author, feed='all')
 
 
-@app.route('/', methods=['GET', 'POST'])
+@bp.route('/', methods=['GET', 'POST'])
 @login_required
 def show_home_page():
     """
-    Serves the homepage containing all the blogs.
+    Serves the homepage containing the blogs of the user and the authors
+    they follow, or all the blogs with ?feed=all.
     When the request is POST, inserts a new blog into the database.
     """
     # global logged_in_username
@@ -841,25 +1941,28 @@ def show_home_page():
         author_id = current_user.id
         db.insert_blog(title, content, author_id)
 
-    blogs = db.get_all_rows('blog')
-    blogs_with_authors = []
-
-    for blog in blogs:
-        blogs_with_authors.append(db.get_blog_by_id(blog['id']))
+    feed = request.args.get('feed', 'following')
 
-    blogs_with_authors.reverse()
-    authors = db.get_all_accounts()
+    db = get_read_db()
+    if feed == 'all':
+        blogs_with_authors = db.get_blog_excerpts(
+            current_app.config['HOMEPAGE_LENGTH'])
+    else:
+        blogs_with_authors = db.get_timeline(
+            current_user.id, current_app.config['HOMEPAGE_LENGTH'])
+    top_author = db.get_author_directory(limit=1)[0]
 
     return render_template('homepage.html', blogs=blogs_with_authors,
-                           author=authors[0])
+                           author=top_author, feed=feed)
 
 
-@app.route('/blogs/<id>', methods=['GET', 'POST'])
+@bp.route('/blogs/<int:id>', methods=['GET', 'POST'])
 @login_required
 def show_blog(id):
     """
-    Serves a page that shows a blog and its comments.
-    When the request is POST, inserts a comment into the database.
+    Serves a page that shows a blog and its comments, threaded by reply.
+    When the request is POST, inserts a comment into the database, as a
+    reply if the form has a parent_id.
 
     :param id: ID of the blog
     """
@@ -877,59 +1980,311 @@ def show_blog(id):
             raise RequestError(422, 'Content must be provided')
 
         author_id = current_user.id
-        db.insert_comment(id, author_id, content)
+        parent_id = request.form.get('parent_id') or None
+        db.insert_comment(id, author_id, content, parent_id)
 
-    comments = db.get_comments_from_blog(id)
-    comments_with_author = []
+    db = get_read_db()
+    comments = db.get_comment_thread(id)
+    add_rendered_html(db, [blog] + comments)
+    top_author = db.get_author_directory(limit=1)[0]
 
-    for comment in comments:
-        comments_with_author.append(db.get_comment_by_id(comment['id']))
+    return render_template('post.html', blog=blog, comments=comments,
+                           author=top_author)
 
-    comments.reverse()
-    authors = db.get_all_accounts()
 
-    return render_template('post.html', blog=blog,
-                           comments=comments_with_author, author=authors[0])
+def format_event(comment):
+    """
+    Formats a comment as a Server-Sent Event whose id is the comment's ID
+    :param comment: dictionary representing the comment
+    :return: the event as a string
+    """
 
+    return 'id: {}\nevent: comment\ndata: {}\n\n'.format(
+        comment['id'], json.dumps(comment))
 
-@app.route('/authors/<id>')
+
+@bp.route('/blogs/<int:id>/events')
+@login_required
+def stream_blog_events(id):
+    """
+    Streams the comments posted on a blog from now on as Server-Sent Events.
+    A client reconnecting with a Last-Event-ID header, or a last_event_id
+    parameter, first gets the comments posted after that one. Streams wait
+    on a queue between comments, so idle streams use no CPU.
+
+    :param id: ID of the blog
+    """
+    db = get_db()
+
+    if db.query_by_id('blog', id) is None:
+        raise RequestError(404, 'Blog ID not found')
+
+    last_id = request.headers.get('Last-Event-ID',
+                                  request.args.get('last_event_id'))
+
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        raise RequestError(422, 'Last-Event-ID must be an integer')
+
+    events = get_events()
+    keepalive = current_app.config['EVENT_KEEPALIVE']
+
+    # Subscribe before reading the missed comments so none falls in between
+    subscription = events.subscribe(id)
+
+    missed = []
+    if last_id is not None:
+        missed = db.get_comments_since(id, last_id)
+        add_rendered_html(db, missed)
+
+    def stream():
+        sent = last_id or 0
+
+        try:
+            for comment in missed:
+                yield format_event(comment)
+                sent = comment['id']
+
+            while not (subscription.closed and subscription.empty()):
+                try:
+                    comment = subscription.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+
+                if comment['id'] > sent:
+                    yield format_event(comment)
+                    sent = comment['id']
+        finally:
+            events.unsubscribe(id, subscription)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+@bp.route('/authors/<id>')
 @login_required
 def show_author(id):
     """
-    Serves a page showing all the blogs of a specific author.
+    Serves a page showing the blogs of a specific author, newest first,
+    AUTHOR_PAGE_SIZE at a time. ?before=<blog id> shows the page of older
+    blogs and ?after=<blog id> the page of newer blogs. The menu lists
+    AUTHOR_MENU_SIZE authors, and ?authors_page=<n> shows the n-th page.
 
     :param id: ID of the author
     """
-    db = get_db()
+    db = get_read_db()
 
-    account = db.query_by_id('account', id)
+    author = db.get_account_by_id(id)
 
-    if account is None:
+    if author is None:
         raise RequestError(404, 'Author ID not found')
 
-    blogs = db.get_blog_by_author(id)
-    author = db.query_by_id('account', id)
-    authors = db.get_all_accounts()
-    blogs.reverse()
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    page_size = current_app.config['AUTHOR_PAGE_SIZE']
+
+    # One extra blog tells whether there is a page beyond this one
+    blogs = db.get_blog_by_author(id, before, after, page_size + 1)
+
+    if after is not None:
+        newer = len(blogs) > page_size
+        older = True
+        blogs = blogs[-page_size:]
+    else:
+        newer = before is not None
+        older = len(blogs) > page_size
+        blogs = blogs[:page_size]
+
+    # The menu lists authors with the most blogs first, a page at a time
+    menu_page = max(request.args.get('authors_page', 1, type=int), 1)
+    menu_size = current_app.config['AUTHOR_MENU_SIZE']
+    authors = db.get_author_directory((menu_page - 1) * menu_size,
+                                      menu_size + 1)
+    top_author = db.get_author_directory(limit=1)[0]
+
+    add_rendered_html(db, blogs)
+    following = db.is_following(current_user.id, id)
+
+    return render_template('authors.html', blogs=blogs,
+                           authors=authors[:menu_size], author=author,
+                           top_author=top_author, following=following,
+                           newer=newer and bool(blogs),
+                           older=older and bool(blogs), menu_page=menu_page,
+                           more_authors=len(authors) > menu_size)
+
+
+@bp.route('/authors/<int:id>/follow', methods=['POST'])
+@login_required
+def follow_author(id):
+    """
+    Makes the user follow or, when the form's action is 'unfollow', stop
+    following an author, then goes back to the author's page.
+
+    :param id: ID of the author
+    """
+    db = get_db()
+
+    if request.form.get('action') == 'unfollow':
+        db.unfollow(current_user.id, id)
+    elif db.follow(current_user.id, id) is None:
+        raise RequestError(404, 'Author ID not found')
 
-    return render_template('authors.html', blogs=blogs, authors=authors,
-                           author=author)
+    return redirect(url_for('blog.show_author', id=id))
 
 
-@app.route("/logout")
+@bp.route("/logout")
 @login_required
 def logout():
     logout_user()
     return render_template('logout.html')
 
 
+def make_session(pool_size, retries):
+    """
+    Creates an HTTP session for the command-line interface. Connections are
+    kept alive and pooled, and requests are retried with backoff on
+    connection errors, 5xx responses and 429 responses, waiting as long as
+    their Retry-After header asks.
+    :param pool_size: number of connections kept open
+    :param retries: number of times a request is retried
+    :return: requests.Session object
+    """
+    # Only the command-line interface needs requests, so the server does
+    # not pay for importing it
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # allowed_methods=None retries POST too, so a post whose response was
+    # lost can occasionally be made twice
+    retry = Retry(total=retries, backoff_factor=0.2,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=None, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                          max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def post_item(session, request_url, account_id, item):
+    """
+    Posts a blog or a comment. Items with a 'blog_id' are comments, other
+    items are blogs.
+    :param session: requests.Session object
+    :param request_url: base URL of the API
+    :param account_id: ID of the account posting
+    :param item: dictionary with 'content', and 'title' or 'blog_id'
+    :return: True if the item was posted, False if it failed or is missing
+    a key
+    """
+    import requests
+
+    if not isinstance(item, dict) or 'content' not in item \
+            or ('blog_id' not in item and 'title' not in item):
+        return False
+
+    if 'blog_id' in item:
+        url = request_url + '/comments/'
+        data = {'content': item['content'], 'author_id': account_id,
+                'blog_id': item['blog_id']}
+    else:
+        url = request_url + '/blogs/'
+        data = {'title': item['title'], 'content': item['content'],
+                'author_id': account_id}
+
+    try:
+        response = session.post(url, data=data, timeout=30)
+    except requests.RequestException:
+        return False
+
+    return response.status_code == 200
+
+
+def post_batch(session, request_url, account_id, lines, workers):
+    """
+    Posts the blogs and comments read from lines of JSON, using a bounded
+    pool of threads. At most twice as many items as threads are read ahead,
+    so large inputs are not loaded into memory. Lines that are not valid
+    items count as failed, like items the API rejects.
+    :param session: requests.Session object
+    :param request_url: base URL of the API
+    :param account_id: ID of the account posting
+    :param lines: iterable of JSON lines, one item per line
+    :param workers: number of threads
+    :return: tuple of the number of items posted and the number that failed
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    posted = 0
+    failed = 0
+    pending = set()
+
+    def collect(done):
+        nonlocal posted, failed
+        for future in done:
+            try:
+                ok = future.result()
+            except Exception:
+                ok = False
+
+            if ok:
+                posted += 1
+            else:
+                failed += 1
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for line in lines:
+            if not line.strip():
+                continue
+
+            try:
+                item = json.loads(line)
+            except ValueError:
+                failed += 1
+                continue
+
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            pending.add(executor.submit(post_item, session, request_url,
+                                        account_id, item))
+
+        collect(wait(pending).done)
+
+    return posted, failed
+
+
 def main():
     """
     Provides a command-line interface for posting comments and blogs.
     """
-
-    if len(sys.argv) != 1:
-        sys.exit('Usage: {}'.format(sys.argv[0]))
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Post blogs and comments. Without --batch, commands are '
+                    'read interactively.')
+    parser.add_argument('--batch', metavar='FILE',
+                        help="file of blogs and comments to post, one JSON "
+                             "object per line, or '-' for stdin")
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of concurrent posts in batch mode')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='retries on connection errors, 429 and 5xx '
+                             'responses')
+    parser.add_argument('--url', default='http://127.0.0.1:5000/api',
+                        help='base URL of the API')
+    args = parser.parse_args()
+
+    # Only used to check the login against the database, so it runs no jobs
+    app = create_app({'JOB_WORKERS': 0})
 
     try:
         with app.app_context():
@@ -937,7 +2292,28 @@ def main():
     except RequestError as e:
         sys.exit(e)
 
-    request_url = 'http://127.0.0.1:5000/api'
+    request_url = args.url
+    session = make_session(args.workers, args.retries)
+
+    if args.batch is not None:
+        started = time.perf_counter()
+
+        if args.batch == '-':
+            posted, failed = post_batch(session, request_url, account_id,
+                                        sys.stdin, args.workers)
+        else:
+            with open(args.batch) as lines:
+                posted, failed = post_batch(session, request_url, account_id,
+                                            lines, args.workers)
+
+        duration = time.perf_counter() - started
+        print('Posted {} items ({} failed) in {:.2f} seconds '
+              '({:.1f} items/s).'.format(posted, failed, duration,
+                                         posted / duration))
+
+        if failed:
+            sys.exit(1)
+        return
 
     print('''Commands:
              B: post a blog
@@ -950,18 +2326,12 @@ def main():
         if c == 'B':
             title = input('Title: ')
             content = input('Content: ')
-            try:
-                response = requests.post(request_url + '/blogs/',
-                                         data={'title': title, 'content': content,
-                                               'author_id': account_id})
-
-                if response.status_code != 200:
-                    sys.exit('Error in posting blog')
 
-                print('Posting Blog Successfully!')
+            if not post_item(session, request_url, account_id,
+                             {'title': title, 'content': content}):
+                sys.exit('Error in posting blog')
 
-            except RequestError as e:
-                sys.exit(e)
+            print('Posting Blog Successfully!')
 
         elif c[0] == 'C':
             try:
@@ -975,18 +2345,12 @@ def main():
                 sys.exit('Usage: C <id>')
 
             content = input('Content: ')
-            try:
-                response = requests.post(request_url + '/comments/',
-                                         data={'content': content,
-                                               'author_id': account_id,
-                                               'blog_id': blog_id})
-                if response.status_code != 200:
-                    sys.exit('Error in posting comment')
 
-                print('Posting Comment Successfully!')
+            if not post_item(session, request_url, account_id,
+                             {'content': content, 'blog_id': blog_id}):
+                sys.exit('Error in posting comment')
 
-            except RequestError as e:
-                sys.exit(e)
+            print('Posting Comment Successfully!')
 
         else:
             sys.exit('''Usage: 
@@ -997,29 +2361,42 @@ def main():
         c = input()
 
 
+@bp.route('/api/jobs/')
+def show_job_counts():
+    """
+    Returns JSON with the depth of the background job queue by state. Only
+    counts are returned, not the jobs themselves. Requires logging in like
+    the other API requests.
+    :return: a response containing the counts
+    """
+    log_in()
+
+    return jsonify(get_db().get_job_counts())
+
+
 # Register AccountView as the handler for all the api/accounts/requests.
 accounts_view = AccountsView.as_view('accounts_view')
-app.add_url_rule('/api/accounts/', defaults={'account_id': None},
-                 view_func=accounts_view, methods=['GET'])
-app.add_url_rule('/api/accounts/', view_func=accounts_view, methods=['POST'])
-app.add_url_rule('/api/accounts/<int:account_id>', view_func=accounts_view,
-                 methods=['GET', 'PATCH', 'DELETE'])
+bp.add_url_rule('/api/accounts/', defaults={'account_id': None},
+                view_func=accounts_view, methods=['GET'])
+bp.add_url_rule('/api/accounts/', view_func=accounts_view, methods=['POST'])
+bp.add_url_rule('/api/accounts/<int:account_id>', view_func=accounts_view,
+                methods=['GET', 'PATCH', 'DELETE'])
 
 # Register BlogsView as the handler for all the /blogs/ requests.
 blogs_view = BlogsView.as_view('blogs_view')
-app.add_url_rule('/api/blogs/', defaults={'blog_id': None},
-                 view_func=blogs_view, methods=['GET'])
-app.add_url_rule('/api/blogs/', view_func=blogs_view, methods=['POST'])
-app.add_url_rule('/api/blogs/<int:blog_id>', view_func=blogs_view,
-                 methods=['GET', 'PATCH', 'DELETE'])
+bp.add_url_rule('/api/blogs/', defaults={'blog_id': None},
+                view_func=blogs_view, methods=['GET'])
+bp.add_url_rule('/api/blogs/', view_func=blogs_view, methods=['POST'])
+bp.add_url_rule('/api/blogs/<int:blog_id>', view_func=blogs_view,
+                methods=['GET', 'PATCH', 'DELETE'])
 
 # Register CommentsView as the handler for all the /comments/ requests.
 comments_view = CommentsView.as_view('comments_view')
-app.add_url_rule('/api/comments/', defaults={'comment_id': None},
-                 view_func=comments_view, methods=['GET'])
-app.add_url_rule('/api/comments/', view_func=comments_view, methods=['POST'])
-app.add_url_rule('/api/comments/<int:comment_id>', view_func=comments_view,
-                 methods=['GET', 'PATCH', 'DELETE'])
+bp.add_url_rule('/api/comments/', defaults={'comment_id': None},
+                view_func=comments_view, methods=['GET'])
+bp.add_url_rule('/api/comments/', view_func=comments_view, methods=['POST'])
+bp.add_url_rule('/api/comments/<int:comment_id>', view_func=comments_view,
+                methods=['GET', 'PATCH', 'DELETE'])
 
 
 if __name__ == '__main__':
@@ -3,9 +3,13 @@ This module contains tests for the database in blogdb.py
 Run with: python3 -m pytest test_database.py
 """
 
+import gzip
+import io
 import pytest
 import tempfile
+import time
 import os
+import sqlite3
 
 import blogdb
 
@@ -17,6 +21,7 @@ def test_client():
 
     yield test_client
 
+    blogdb.BlogDB.close_watchers(tmp_fle)
     os.close(db_fd)
     os.unlink(tmp_fle)
 
@@ -186,3 +191,853 @@ def test_delete(test_client):
     test_client.delete_account(1)
     response = test_client.get_all_rows('account')
     assert response == []
+
+
+@pytest.fixture
+def sharded_client():
+    files = [tempfile.mkstemp() for _ in range(3)]
+    sharded_client = blogdb.BlogDB(files[0][1],
+                                   shards=[f[1] for f in files[1:]])
+
+    yield sharded_client
+
+    for db_fd, tmp_fle in files:
+        blogdb.BlogDB.close_watchers(tmp_fle)
+        os.close(db_fd)
+        os.unlink(tmp_fle)
+
+
+def test_sharded(sharded_client):
+    """
+    Tests that blogs and comments are routed to shards by author and blog,
+    and that reads across shards are merged in id order
+    :param sharded_client: sharded database test client
+    """
+    sharded_client.init_db()
+    sharded_client.insert_account('htran20', 'haha1232')
+    sharded_client.insert_account('tdinh20', '123hai')
+
+    sharded_client.insert_blog('Avenger 4', 'Iron man still alive', 1)
+    sharded_client.insert_blog('Spiderman', 'Not Peter Parker anymore', 2)
+    sharded_client.insert_blog('Thor', 'Still has a hammer', 1)
+    comment = sharded_client.insert_comment(2, 1, 'This blog is nice')
+
+    assert sharded_client.get_shard('blog', 1) == 1
+    assert sharded_client.get_shard('blog', 2) == 0
+    assert sharded_client.get_shard('comment', comment['id']) == 0
+    assert comment['blog_id'] == 2
+
+    # Ids are allocated without writing a shard map entry
+    assert sharded_client._conn.execute(
+        'SELECT COUNT(*) FROM blog_shard').fetchone()[0] == 0
+
+    response = sharded_client.get_all_rows('blog')
+    assert [blog['id'] for blog in response] == [1, 2, 3]
+    assert sharded_client.get_blog_by_id(2)['username'] == 'tdinh20'
+    assert sharded_client.get_comment_by_id(comment['id'])['username'] == \
+        'htran20'
+    assert len(sharded_client.get_blog_by_author(1)) == 2
+
+    sharded_client.delete_account(1)
+    assert [blog['id'] for blog in sharded_client.get_all_rows('blog')] == [2]
+    assert sharded_client.get_all_rows('comment') == []
+
+
+def test_replicas(test_client):
+    """
+    Tests that reads are served from a snapshot that is refreshed after
+    writes, and that a caller that wrote since the snapshot reads its writes
+    :param test_client: database test client
+    """
+    test_client.init_db()
+    replicas = blogdb.ReplicaSet(test_client.filename, count=2, writes=2,
+                                 background=False)
+    db = blogdb.BlogDB(test_client.filename, replicas=replicas)
+
+    db.insert_account('htran20', 'haha1232')
+    reader = blogdb.BlogDB(test_client.filename, replicas=replicas).reader()
+    assert reader.read_only
+    assert len(reader.get_all_accounts()) == 1
+    snapshot_time = replicas.refreshed_at
+
+    db.insert_account('tdinh20', '123hai')
+    assert replicas.refreshed_at == snapshot_time
+    assert db.reader() is db
+    reader = blogdb.BlogDB(test_client.filename, replicas=replicas).reader()
+    assert len(reader.get_all_accounts()) == 1
+    assert replicas.snapshot(since=db.last_write) is None
+
+    db.insert_account('hai20', 'hello')
+    assert replicas.refreshed_at > snapshot_time
+    reader = blogdb.BlogDB(test_client.filename, replicas=replicas).reader()
+    assert len(reader.get_all_accounts()) == 3
+
+    # A reader in the middle of a transaction keeps the copy it started on
+    other = sqlite3.connect(replicas.paths[0])
+    other.execute('BEGIN')
+    assert len(other.execute('SELECT * FROM account').fetchall()) == 3
+    db.insert_account('fli', 'lol')
+    assert replicas.refresh()
+    assert len(other.execute('SELECT * FROM account').fetchall()) == 3
+    other.close()
+    assert not os.path.exists(replicas.paths[0] + '.tmp')
+
+    def busy(src, path):
+        raise sqlite3.OperationalError('database is locked')
+
+    replicas._copy = busy
+    db.insert_account('hai21', 'hello')
+    assert not replicas.refresh()
+    assert replicas.writes_since_refresh == 1
+
+    for path in replicas.paths:
+        os.unlink(path)
+
+
+def test_background_replicas(test_client):
+    """
+    Tests that snapshots are refreshed by a background thread, with reads
+    served from the database until the first snapshot exists
+    :param test_client: database test client
+    """
+    test_client.init_db()
+    replicas = blogdb.ReplicaSet(test_client.filename, writes=1)
+    db = blogdb.BlogDB(test_client.filename, replicas=replicas)
+
+    assert replicas.snapshot() is None
+    db.insert_account('htran20', 'haha1232')
+    assert replicas._thread is not None
+
+    deadline = time.time() + 5
+    while replicas.refreshed_at is None and time.time() < deadline:
+        time.sleep(0.01)
+
+    reader = blogdb.BlogDB(test_client.filename, replicas=replicas).reader()
+    assert reader.read_only
+    reader.close()
+    db.close()
+
+    for path in replicas.paths:
+        os.unlink(path)
+
+
+def test_backup(test_client):
+    """
+    Tests that an online backup copies the whole database in steps and can
+    be compressed
+    :param test_client: database test client
+    """
+    test_client.init_db()
+    test_client.insert_account('htran20', 'haha1232')
+    test_client.insert_blog('Avenger 4', 'Iron man still alive' * 1000, 1)
+
+    db_fd, target = tempfile.mkstemp()
+    steps = []
+    stats = test_client.backup(target + '.gz', pages=1, sleep=0,
+                               compress=True,
+                               progress=lambda r, t: steps.append(r))
+
+    assert stats['pages'] > 1
+    assert len(steps) == stats['pages']
+    assert stats['duration'] >= 0
+
+    with gzip.open(target + '.gz', 'rb') as src, open(target, 'wb') as out:
+        out.write(src.read())
+
+    backup = blogdb.BlogDB(target)
+    assert backup.get_all_rows('blog') == test_client.get_all_rows('blog')
+
+    os.close(db_fd)
+    os.unlink(target)
+    os.unlink(target + '.gz')
+
+
+def test_export_import(test_client, sharded_client):
+    """
+    Tests that rows exported as NDJSON are imported with their ids, here
+    from a single database into a sharded one
+    :param test_client: database test client
+    :param sharded_client: sharded database test client
+    """
+    test_client.init_db()
+    test_client.insert_account('htran20', 'haha1232')
+    test_client.insert_account('tdinh20', '123hai')
+    test_client.insert_blog('Avenger 4', 'Iron man still alive', 1)
+    test_client.insert_blog('Spiderman', 'Not Peter Parker anymore', 2)
+    test_client.insert_comment(2, 1, 'This blog is nice')
+
+    out = io.StringIO()
+    counts = []
+    assert test_client.export_rows(out, batch_size=2,
+                                   progress=counts.append) == 5
+    assert counts == [2, 4, 5]
+
+    sharded_client.init_db()
+    out.seek(0)
+    counts = []
+    assert sharded_client.import_rows(out, batch_size=2,
+                                      progress=counts.append) == 5
+    assert counts == [2, 4, 5]
+
+    for table in ('account', 'blog', 'comment'):
+        assert sharded_client.get_all_rows(table) == \
+            test_client.get_all_rows(table)
+    assert sharded_client.get_shard('comment', 1) == 0
+
+
+def test_import_timelines(test_client, sharded_client):
+    """
+    Tests that timelines are rebuilt from the blogs and follows of imported
+    rows
+    :param test_client: database test client
+    :param sharded_client: sharded database test client
+    """
+    test_client.init_db()
+    test_client.insert_account('htran20', 'haha1232')
+    test_client.insert_account('tdinh20', '123hai')
+    test_client.insert_blog('Avenger 4', 'Iron man still alive', 1)
+    test_client.insert_blog('Spiderman', 'Not Peter Parker anymore', 2)
+    test_client.follow(1, 2)
+
+    out = io.StringIO()
+    test_client.export_rows(out)
+
+    sharded_client.init_db()
+    out.seek(0)
+    sharded_client.import_rows(out)
+
+    for account_id in (1, 2):
+        assert sharded_client.get_timeline(account_id) == \
+            test_client.get_timeline(account_id)
+    assert [b['id'] for b in sharded_client.get_timeline(1)] == [2, 1]
+    assert [b['id'] for b in sharded_client.get_timeline(2)] == [2]
+
+
+def test_compressed_content(test_client):
+    """
+    Tests that large blog content is stored compressed, reads back
+    unchanged, and that existing rows can be compressed later
+    :param test_client: database test client
+    """
+    test_client.init_db()
+    test_client.insert_account('htran20', 'haha1232')
+    long_content = 'Iron man still alive. ' * 100
+    test_client.insert_blog('Avenger 4', long_content, 1)
+
+    test_client.compress_threshold = 1000
+    test_client.insert_blog('Spiderman', long_content, 1)
+    test_client.insert_blog('Thor', 'Still has a hammer', 1)
+
+    cur = test_client.connect_db().execute(
+        'SELECT typeof(content) FROM blog ORDER BY id')
+    assert [row[0] for row in cur] == ['text', 'blob', 'text']
+    assert test_client.get_blog_by_id(2)['content'] == long_content
+    assert test_client.query_by_id('blog', 1)['content'] == long_content
+
+    assert test_client.compress_existing_content() == 1
+    response = test_client.get_all_rows('blog')
+    assert [blog['content'] for blog in response] == \
+        [long_content, long_content, 'Still has a hammer']
+
+
+def test_rendered_html(test_client):
+    """
+    Tests that Markdown content is rendered when written, refreshed when
+    updated, and that raw HTML is escaped
+    :param test_client: database test client
+    """
+    test_client.init_db()
+    test_client.insert_account('htran20', 'haha1232')
+    test_client.insert_blog('Avenger 4', '*Iron man* still alive', 1)
+    test_client.insert_comment(1, 1, '<script>alert(1)</script>')
+
+    rendered = test_client.get_all_rows('rendered')
+    assert len(rendered) == 2
+
+    html = test_client.get_rendered_html(['*Iron man* still alive',
+                                          '<script>alert(1)</script>'])
+    assert html[0] == '<p><em>Iron man</em> still alive</p>'
+    assert '<script>' not in html[1]
+
+    test_client.update_blog(1, None, '**Spiderman**')
+    test_client.update_comment(1, '**Spiderman**')
+    assert len(test_client.get_all_rows('rendered')) == 3
+    assert test_client.get_rendered_html(['**Spiderman**']) == \
+        ['<p><strong>Spiderman</strong></p>']
+
+    # The old contents are no longer used by any blog or comment
+    assert test_client.prune_rendered() == 2
+    assert len(test_client.get_all_rows('rendered')) == 1
+
+    # Large HTML is compressed like blog content
+    db = blogdb.BlogDB(test_client.filename, compress_threshold=256)
+    long_content = '*Iron man* still alive. ' * 100
+    db.insert_blog('Avenger 4', long_content, 1)
+    row = db._conn.execute('SELECT html FROM rendered WHERE hash = ?',
+                           (db.content_hash(long_content),)).fetchone()
+    assert row['html'].startswith(blogdb.BlogDB.COMPRESSED_MARKER)
+
+    # More contents than are looked up in one query
+    contents = [long_content] + ['Comment {}'.format(i) for i in range(1200)]
+    html = db.get_rendered_html(contents)
+    assert html[0] == db.render_markdown(long_content)
+    assert html[-1] == '<p>Comment 1199</p>'
+    assert db.get_rendered_html(contents) == html
+
+
+def test_unsafe_urls(test_client):
+    """
+    Tests that links and images with a script URL are rendered without it,
+    while web, mail and relative URLs are kept
+    :param test_client: database test client
+    """
+    render = blogdb.BlogDB.render_markdown
+
+    assert render('[x](javascript:alert(1))') == '<p><a>x</a></p>'
+    assert 'javascript' not in render('![x](javascript:alert(1))')
+    assert 'href' not in render('[x](JavaScript&#58;alert(1))')
+    assert 'href' not in render('[x](java\tscript:alert(1))')
+    assert 'href' not in render('[x]: data:text/html,hi\n\n[y][x]')
+    assert render('[x](https://example.com) [y](mailto:a@b.c) [z](/blogs/1)') \
+        == ('<p><a href="https://example.com">x</a> '
+            '<a href="mailto:a@b.c">y</a> <a href="/blogs/1">z</a></p>')
+
+
+def test_excerpt(test_client):
+    """
+    Tests that excerpts are written with blogs and listed instead of content
+    :param test_client: database test client
+    """
+    test_client.init_db()
+    test_client.insert_account('htran20', 'haha1232')
+    test_client.insert_blog('Avenger 4', 'Iron man still alive ' * 20, 1)
+    test_client.insert_blog('Spiderman', 'Not Peter Parker anymore', 1)
+
+    response = test_client.get_blog_excerpts()
+    assert [blog['id'] for blog in response] == [2, 1]
+    assert 'content' not in response[0]
+    assert response[0]['username'] == 'htran20'
+    assert response[0]['excerpt'] == 'Not Peter Parker anymore'
+    assert len(response[1]['excerpt']) == blogdb.BlogDB.EXCERPT_LENGTH
+
+    test_client.update_blog(2, None, 'Peter Parker is back')
+    assert test_client.get_all_rows('blog', ['excerpt'])[1] == \
+        {'excerpt': 'Peter Parker is back'}
+
+    with pytest.raises(ValueError):
+        test_client.get_all_rows('blog', ['id', 'secret'])
+    with pytest.raises(ValueError):
+        test_client.get_all_accounts([])
+
+
+def test_rows_by_ids(sharded_client):
+    """
+    Tests fetching a batch of rows by their IDs across shards
+    :param sharded_client: sharded database test client
+    """
+    sharded_client.init_db()
+    sharded_client.insert_account('htran20', 'haha1232')
+    sharded_client.insert_account('fli', 'lol')
+    sharded_client.insert_blog('Avenger 4', 'Iron man still alive', 1)
+    sharded_client.insert_blog('Spiderman', 'Not Peter Parker anymore', 2)
+    sharded_client.insert_blog('Thor', 'Lost his hammer', 1)
+
+    response = sharded_client.get_rows_by_ids('blog', [3, 1, 2, 7],
+                                              ['id', 'author_id'])
+    assert response == [{'id': 1, 'author_id': 1},
+                        {'id': 2, 'author_id': 2},
+                        {'id': 3, 'author_id': 1}]
+
+    response = sharded_client.get_rows_by_ids('account', [2])
+    assert response == [{'id': 2, 'username': 'fli'}]
+
+    assert sharded_client.get_rows_by_ids('blog', []) == []
+
+    # More ids than SQLite binds in one statement
+    response = sharded_client.get_rows_by_ids('blog', range(1, 40000), ['id'])
+    assert response == [{'id': 1}, {'id': 2}, {'id': 3}]
+
+
+def test_comment_threads(test_client):
+    """
+    Tests replies to comments and fetching threads and subtrees in order
+    :param test_client: database test client
+    """
+    test_client.init_db()
+    test_client.insert_account('htran20', 'haha1232')
+    test_client.insert_blog('Avenger 4', 'Iron man still alive', 1)
+    test_client.insert_blog('Spiderman', 'Not Peter Parker anymore', 1)
+
+    test_client.insert_comment(1, 1, 'first')
+    test_client.insert_comment(1, 1, 'second')
+    test_client.insert_comment(1, 1, 'reply to first', 1)
+    test_client.insert_comment(1, 1, 'reply to reply', 3)
+
+    # The parent must be a comment on the same blog
+    assert test_client.insert_comment(2, 1, 'wrong blog', 1) is None
+    assert test_client.insert_comment(1, 1, 'no parent', 99) is None
+
+    thread = test_client.get_comment_thread(1)
+    assert [c['id'] for c in thread] == [1, 3, 4, 2]
+    assert [c['depth'] for c in thread] == [0, 1, 2, 0]
+    assert thread[1]['parent_id'] == 1
+    assert thread[1]['username'] == 'htran20'
+
+    subtree = test_client.get_comment_subtree(3)
+    assert [c['id'] for c in subtree] == [3, 4]
+    assert test_client.get_comment_subtree(99) == []
+
+    test_client.delete_comment(1)
+    assert [c['id'] for c in test_client.get_comment_thread(1)] == [2]
+
+
+def test_delete_account_replies(sharded_client):
+    """
+    Tests that deleting an account also deletes the replies of others to its
+    comments, and updates the feed's comment counts
+    :param sharded_client: sharded database test client
+    """
+    sharded_client.init_db()
+    sharded_client.insert_account('htran20', 'haha1232')
+    sharded_client.insert_account('tdinh20', '123hai')
+    blog_id = sharded_client.insert_blog('Avenger 4', 'Iron man still alive',
+                                         2)['id']
+
+    first = sharded_client.insert_comment(blog_id, 1, 'first')['id']
+    reply = sharded_client.insert_comment(blog_id, 2, 'reply', first)['id']
+    sharded_client.insert_comment(blog_id, 1, 'reply to reply', reply)
+    second = sharded_client.insert_comment(blog_id, 2, 'second')['id']
+
+    sharded_client.delete_account(1)
+    assert [c['id'] for c in sharded_client.get_comment_thread(blog_id)] == \
+        [second]
+    assert sharded_client.get_blog_excerpts()[0]['comment_count'] == 1
+
+
+def test_sharded_comment_threads(sharded_client):
+    """
+    Tests replies to comments on a sharded database
+    :param sharded_client: sharded database test client
+    """
+    sharded_client.init_db()
+    sharded_client.insert_account('htran20', 'haha1232')
+    sharded_client.insert_account('tdinh20', '123hai')
+    blog_id = sharded_client.insert_blog('Avenger 4', 'Iron man still alive',
+                                         2)['id']
+
+    first = sharded_client.insert_comment(blog_id, 1, 'first')['id']
+    reply = sharded_client.insert_comment(blog_id, 2, 'reply', first)['id']
+    second = sharded_client.insert_comment(blog_id, 1, 'second')['id']
+
+    thread = sharded_client.get_comment_thread(blog_id)
+    assert [c['id'] for c in thread] == [first, reply, second]
+    assert [c['username'] for c in thread] == ['htran20', 'tdinh20',
+                                               'htran20']
+    assert [c['id'] for c in sharded_client.get_comment_subtree(first)] == \
+        [first, reply]
+
+
+def test_timeline(test_client):
+    """
+    Tests following authors and reading their blogs from the timeline
+    :param test_client: database test client
+    """
+    test_client.init_db()
+    test_client.insert_account('htran20', 'haha1232')
+    test_client.insert_account('tdinh20', '123hai')
+    test_client.insert_account('fli', 'lol')
+    test_client.insert_blog('Avenger 4', 'Iron man still alive', 2)
+
+    # Following copies the author's existing blogs into the timeline
+    assert test_client.follow(1, 2)
+    assert test_client.follow(1, 9) is None
+    assert test_client.is_following(1, 2)
+    assert [b['id'] for b in test_client.get_timeline(1)] == [1]
+
+    test_client.insert_blog('Spiderman', 'Not Peter Parker anymore', 3)
+    test_client.insert_blog('Thor', 'Lost his hammer', 2)
+    test_client.insert_blog('Hulk', 'Angry', 1)
+
+    response = test_client.get_timeline(1)
+    assert [b['id'] for b in response] == [4, 3, 1]
+    assert response[1]['username'] == 'tdinh20'
+    assert response[1]['excerpt'] == 'Lost his hammer'
+    assert [b['id'] for b in test_client.get_timeline(1, limit=1)] == [4]
+
+    test_client.delete_blog(3)
+    assert [b['id'] for b in test_client.get_timeline(1)] == [4, 1]
+
+    test_client.unfollow(1, 2)
+    assert not test_client.is_following(1, 2)
+    assert [b['id'] for b in test_client.get_timeline(1)] == [4]
+
+
+def test_upgrade_timeline(sharded_client):
+    """
+    Tests that upgrading a database from before timelines copies every
+    author's blogs into their own timeline
+    :param sharded_client: sharded database test client
+    """
+    sharded_client.init_db()
+    sharded_client.insert_account('htran20', 'haha1232')
+    sharded_client.insert_account('tdinh20', '123hai')
+    sharded_client.insert_blog('Avenger 4', 'Iron man still alive', 2)
+    sharded_client.insert_blog('Spiderman', 'Not Peter Parker anymore', 1)
+    sharded_client.insert_blog('Thor', 'Lost his hammer', 2)
+    sharded_client._conn.executescript('DROP TABLE timeline; '
+                                       'DROP TABLE follow;')
+
+    sharded_client.upgrade_db()
+    assert [b['id'] for b in sharded_client.get_timeline(1)] == [3]
+    assert [b['id'] for b in sharded_client.get_timeline(2)] == [4, 2]
+
+
+def test_sharded_timeline(sharded_client):
+    """
+    Tests that blogs from several shards are read back from a timeline, and
+    that queued jobs copy blogs into timelines
+    :param sharded_client: sharded database test client
+    """
+    sharded_client.init_db()
+    sharded_client.insert_account('htran20', 'haha1232')
+    sharded_client.insert_account('tdinh20', '123hai')
+    sharded_client.follow(1, 2)
+
+    jobs = blogdb.JobQueue(sharded_client.filename, sharded_client.shards,
+                           workers=0)
+    sharded_client.jobs = jobs
+    sharded_client.insert_blog('Avenger 4', 'Iron man still alive', 2)
+    sharded_client.insert_blog('Spiderman', 'Not Peter Parker anymore', 1)
+
+    # Authors see their own blog at once, followers once the job ran
+    assert [b['id'] for b in sharded_client.get_timeline(1)] == [3]
+    assert [b['id'] for b in sharded_client.get_timeline(2)] == [2]
+
+    while jobs.run_once(sharded_client):
+        pass
+
+    response = sharded_client.get_timeline(1)
+    assert [b['id'] for b in response] == [3, 2]
+    assert [b['username'] for b in response] == ['htran20', 'tdinh20']
+    assert [b['id'] for b in sharded_client.get_timeline(2)] == [2]
+
+
+def test_job_retries(test_client):
+    """
+    Tests that failed jobs are retried with backoff, then kept as failed
+    :param test_client: database test client
+    """
+    test_client.init_db()
+    jobs = blogdb.JobQueue(test_client.filename, workers=0, max_attempts=2,
+                           retry_delay=0)
+    test_client.jobs = jobs
+
+    # fan_out() has no color argument, so this job always fails
+    test_client.enqueue('fan_out', blog_id=1, author_id=1, color='red')
+    test_client.enqueue('fan_out', blog_id=2, author_id=1)
+    test_client._conn.commit()
+
+    with pytest.raises(ValueError):
+        test_client.enqueue('delete_account', account_id=1)
+
+    assert test_client.get_job_counts() == {'ready': 2, 'scheduled': 0,
+                                            'running': 0, 'failed': 0}
+
+    assert jobs.run_once(test_client)
+    assert jobs.run_once(test_client)
+    assert test_client.get_job_counts()['ready'] == 1
+
+    assert jobs.run_once(test_client)
+    assert not jobs.run_once(test_client)
+    assert test_client.get_job_counts() == {'ready': 0, 'scheduled': 0,
+                                            'running': 0, 'failed': 1}
+
+
+def test_job_resume(test_client, monkeypatch):
+    """
+    Tests that leftover jobs are picked up at startup, that jobs are
+    claimed on SQLite versions without RETURNING, and that a job for a
+    deleted blog does nothing
+    :param test_client: database test client
+    :param monkeypatch: pytest fixture to patch the SQLite version
+    """
+    jobs = blogdb.JobQueue(test_client.filename, workers=0)
+    assert not jobs.resume()
+
+    test_client.init_db()
+    test_client.insert_account('htran20', 'haha1232')
+    assert not jobs.resume()
+
+    test_client.jobs = jobs
+    test_client.enqueue('fan_out', blog_id=1, author_id=1)
+    test_client._conn.commit()
+    assert jobs.resume()
+
+    monkeypatch.setattr(blogdb.sqlite3, 'sqlite_version_info', (3, 34, 0))
+    job = test_client.claim_job(60)
+    assert job['payload'] == {'blog_id': 1, 'author_id': 1}
+    assert job['attempts'] == 1
+    assert test_client.claim_job(60) is None
+
+    # With no job due, polling does not wait for the write lock
+    other = sqlite3.connect(test_client.filename)
+    other.execute('BEGIN IMMEDIATE')
+    assert test_client.claim_job(60) is None
+    other.rollback()
+    other.close()
+
+    assert test_client.fan_out(1, 1) == 0
+    assert test_client.get_timeline(1) == []
+
+
+def test_comment_events(test_client):
+    """
+    Tests that new comments are published to the blog's subscribers, and
+    that subscribers falling behind are dropped
+    :param test_client: database test client
+    """
+    test_client.init_db()
+    test_client.insert_account('htran20', 'haha1232')
+    test_client.insert_blog('Avenger 4', 'Iron man still alive', 1)
+    test_client.insert_blog('Spiderman', 'Not Peter Parker anymore', 1)
+
+    test_client.events = blogdb.EventBroker(queue_size=2)
+    subscription = test_client.events.subscribe(1)
+
+    test_client.insert_comment(1, 1, 'first')
+    test_client.insert_comment(2, 1, 'other blog')
+
+    event = subscription.get_nowait()
+    assert event['content'] == 'first'
+    assert event['username'] == 'htran20'
+    assert event['html'] == '<p>first</p>'
+    assert subscription.empty()
+
+    for i in range(3):
+        test_client.insert_comment(1, 1, 'comment {}'.format(i))
+    assert subscription.closed
+    assert test_client.events.count() == 0
+
+    response = test_client.get_comments_since(1, 3)
+    assert [c['id'] for c in response] == [4, 5]
+
+
+def test_feed(test_client):
+    """
+    Tests that the feed table follows blog, comment and account changes,
+    and that it is rebuilt when added to an existing database
+    :param test_client: database test client
+    """
+    test_client.init_db()
+    test_client.insert_account('htran20', 'haha1232')
+    test_client.insert_account('tdinh20', '123hai')
+    test_client.insert_blog('Avenger 4', 'Iron man still alive', 1)
+    test_client.insert_blog('Spiderman', 'Not Peter Parker anymore', 2)
+    test_client.insert_blog('Thor', 'Lost his hammer', 1)
+
+    test_client.insert_comment(1, 2, 'first')
+    test_client.insert_comment(1, 1, 'reply', 1)
+    test_client.insert_comment(1, 2, 'second')
+    test_client.insert_comment(3, 2, 'nice')
+
+    response = test_client.get_blog_excerpts()
+    assert [b['id'] for b in response] == [3, 2, 1]
+    assert [b['comment_count'] for b in response] == [1, 0, 3]
+    assert response[1]['username'] == 'tdinh20'
+    assert [b['id'] for b in test_client.get_blog_excerpts(limit=2)] == [3, 2]
+
+    test_client.update_blog(2, 'Spiderman 2', 'Peter Parker is back')
+    response = test_client.get_blog_excerpts()[1]
+    assert response['title'] == 'Spiderman 2'
+    assert response['excerpt'] == 'Peter Parker is back'
+
+    # Deleting a comment also deletes its reply
+    test_client.delete_comment(1)
+    assert test_client.get_blog_excerpts()[2]['comment_count'] == 1
+
+    test_client.delete_blog(3)
+    assert [b['id'] for b in test_client.get_blog_excerpts()] == [2, 1]
+
+    test_client.delete_account(2)
+    response = test_client.get_blog_excerpts()
+    assert [b['id'] for b in response] == [1]
+    assert response[0]['comment_count'] == 0
+
+    test_client.insert_comment(1, 1, 'still here')
+    expected = test_client.get_blog_excerpts()
+    test_client._conn.execute('DROP TABLE feed')
+    test_client.upgrade_db()
+    assert test_client.get_blog_excerpts() == expected
+
+
+def test_blog_by_author_pages(test_client):
+    """
+    Tests reading an author's blogs newest first, a page at a time
+    :param test_client: database test client
+    """
+    test_client.init_db()
+    test_client.insert_account('htran20', 'haha1232')
+    test_client.insert_account('tdinh20', '123hai')
+    for i in range(5):
+        test_client.insert_blog('Blog {}'.format(i), 'Content', 1)
+    test_client.insert_blog('Other', 'Content', 2)
+
+    def ids(blogs):
+        return [blog['id'] for blog in blogs]
+
+    assert ids(test_client.get_blog_by_author(1)) == [5, 4, 3, 2, 1]
+    assert ids(test_client.get_blog_by_author(1, limit=2)) == [5, 4]
+    assert ids(test_client.get_blog_by_author(1, before=4, limit=2)) == [3, 2]
+    assert ids(test_client.get_blog_by_author(1, after=2, limit=2)) == [4, 3]
+    assert ids(test_client.get_blog_by_author(1, after=5)) == []
+
+
+def test_author_directory(test_client):
+    """
+    Tests the cached directory of authors ordered by their number of blogs
+    :param test_client: database test client
+    """
+    test_client.init_db()
+    assert not test_client.has_accounts()
+    assert test_client.get_author_directory() == []
+
+    test_client.insert_account('htran20', 'haha1232')
+    test_client.insert_account('tdinh20', '123hai')
+    test_client.insert_blog('Title', 'Content', 2)
+    assert test_client.has_accounts()
+
+    def usernames(authors):
+        return [author['username'] for author in authors]
+
+    assert usernames(test_client.get_author_directory()) == ['tdinh20',
+                                                            'htran20']
+    assert test_client.get_author_directory()[0]['post_count'] == 1
+
+    test_client.insert_account('jdoe20', 'pass')
+    assert usernames(test_client.get_author_directory(offset=1, limit=1)) \
+        == ['htran20']
+    assert usernames(test_client.get_author_directory(offset=2)) == ['jdoe20']
+
+    test_client.delete_account(2)
+    assert usernames(test_client.get_author_directory()) == ['htran20',
+                                                            'jdoe20']
+
+
+def test_row_formats(sharded_client):
+    """
+    Tests that listings return the same rows as dictionaries, records and
+    columns
+    :param sharded_client: sharded database test client
+    """
+    sharded_client.init_db()
+    sharded_client.compress_threshold = 10
+    sharded_client.insert_account('htran20', 'haha1232')
+    sharded_client.insert_account('tdinh20', '123hai')
+    sharded_client.insert_blog('Avenger 4', 'Iron man still alive', 1)
+    sharded_client.insert_blog('Dune', 'Spice', 2)
+    sharded_client.insert_comment(1, 1, 'Agreed')
+
+    blogs = sharded_client.get_all_rows('blog')
+    records = sharded_client.get_all_rows('blog', row_format='record')
+    assert [dict(record) for record in records] == blogs
+    assert records[0].content == 'Iron man still alive'
+    assert records[1]['title'] == 'Dune'
+    assert '_id' not in records[0]
+    with pytest.raises(AttributeError):
+        records[0].html = ''
+
+    columns = sharded_client.get_all_rows('blog', ['id', 'content'],
+                                          'columns')
+    assert columns == {'id': [1, 2],
+                       'content': ['Iron man still alive', 'Spice']}
+
+    accounts = sharded_client.get_all_accounts(row_format='columns')
+    assert accounts == {'id': [1, 2], 'username': ['htran20', 'tdinh20']}
+    assert sharded_client.get_all_rows('comment', row_format='columns')[
+        'content'] == ['Agreed']
+
+    assert [dict(record) for record in sharded_client.get_blog_by_author(
+        1, row_format='record')] == sharded_client.get_blog_by_author(1)
+    assert sharded_client.get_comments_from_blog(
+        1, 'record')[0].content == 'Agreed'
+
+    with pytest.raises(ValueError):
+        sharded_client.get_all_rows('blog', row_format='tuple')
+
+
+def test_iter_rows(sharded_client):
+    """
+    Tests that the generators yield the same rows as the listings, a batch
+    at a time
+    :param sharded_client: sharded database test client
+    """
+    sharded_client.init_db()
+    sharded_client.insert_account('htran20', 'haha1232')
+    sharded_client.insert_account('tdinh20', '123hai')
+    for i in range(3):
+        sharded_client.insert_blog('Blog {}'.format(i), 'Content', 1)
+        sharded_client.insert_blog('Other {}'.format(i), 'Content', 2)
+    sharded_client.insert_comment(1, 2, 'First')
+    sharded_client.insert_comment(1, 1, 'Second')
+
+    rows = sharded_client.iter_rows('blog', batch_size=2)
+    assert next(rows) == sharded_client.get_all_rows('blog')[0]
+    rows.close()
+
+    assert list(sharded_client.iter_rows('blog', batch_size=2)) == \
+        sharded_client.get_all_rows('blog')
+    assert list(sharded_client.iter_rows('account', fields=['username'])) \
+        == [{'username': 'htran20'}, {'username': 'tdinh20'}]
+
+    assert [blog['id'] for blog in sharded_client.iter_blogs_by_author(
+        1, batch_size=2)] == [5, 3, 1]
+    assert [comment['content'] for comment in
+            sharded_client.iter_comments_for_blog(1, batch_size=1)] == \
+        ['First', 'Second']
+    assert list(sharded_client.iter_comments_for_blog(9)) == []
+
+
+def test_data_version(test_client):
+    """
+    Tests that cached values are dropped once another connection, standing
+    in for another process, commits a change to what they are computed
+    from, and kept after other commits
+    :param test_client: database test client
+    """
+    test_client.init_db()
+    test_client.insert_account('htran20', 'haha1232')
+    test_client.insert_blog('Avenger 4', 'Iron man still alive', 1)
+    blogdb.BlogDB.check_data_version(test_client.filename)
+    assert len(test_client.get_author_directory()) == 1
+
+    # Like insert_account() in another process
+    other = sqlite3.connect(test_client.filename)
+    other.execute("INSERT INTO account(username, password) "
+                  "VALUES('tdinh20', '123hai')")
+    other.execute("UPDATE cache_version SET version = version + 1 "
+                  "WHERE name = 'author_directory'")
+    other.commit()
+
+    assert len(test_client.get_author_directory()) == 1
+    assert blogdb.BlogDB.check_data_version(test_client.filename)
+    assert len(test_client.get_author_directory()) == 2
+    assert not blogdb.BlogDB.check_data_version(test_client.filename)
+
+    # Comments do not change the directory, so it stays cached
+    other.execute("INSERT INTO comment(blog_id, author_id, content) "
+                  "VALUES(1, 2, 'This blog is nice')")
+    other.commit()
+    assert not blogdb.BlogDB.check_data_version(test_client.filename)
+    assert 'author_directory' in blogdb.BlogDB._caches[test_client.filename]
+
+    blogdb.BlogDB.close_watchers(test_client.filename)
+    assert test_client.filename not in blogdb.BlogDB._watchers
+
+    other.execute("DELETE FROM account WHERE id = 2")
+    other.execute("UPDATE cache_version SET version = version + 1 "
+                  "WHERE name = 'author_directory'")
+    other.commit()
+    other.close()
+
+    assert blogdb.BlogDB.check_data_version(test_client.filename)
+    assert len(test_client.get_author_directory()) == 1
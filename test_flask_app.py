@@ -2,10 +2,14 @@
 This module contains tests for the Flask app in main.py
 Run with: python3 -m pytest test_flask_app.py
 """
+import gzip
 import pytest
 import tempfile
 import json
 import os
+import shutil
+import threading
+import time
 import mock
 
 import main
@@ -13,18 +17,19 @@ import main
 
 @pytest.fixture
 def test_client():
-    db_fd, main.app.config['DATABASE'] = tempfile.mkstemp()
-    main.app.testing = True
-    test_client = main.app.test_client()
+    db_fd, database = tempfile.mkstemp()
+    app = main.create_app({'DATABASE': database, 'TESTING': True})
+    test_client = app.test_client()
 
-    with main.app.app_context():
+    with app.app_context():
         db = main.get_db()
         db.init_db()
 
     yield test_client
 
+    main.BlogDB.close_watchers(database)
     os.close(db_fd)
-    os.unlink(main.app.config['DATABASE'])
+    os.unlink(database)
 
 
 def mock_input(prompt):
@@ -430,3 +435,638 @@ def test_delete_accounts(test_client):
         response_json = json.loads(response.data)
 
         assert response_json == 'Delete Successfully'
+
+
+def test_gzip(test_client):
+    """
+    Tests that pages are gzipped for clients that accept it and that the
+    compressed body is reused for the same page.
+    :param test_client: flask test client
+    """
+    app = test_client.application
+
+    response = test_client.get('/login')
+    assert 'Content-Encoding' not in response.headers
+    assert 'Accept-Encoding' in response.headers['Vary']
+
+    with app.app_context():
+        cache = main.get_gzip_cache()
+    cached = len(cache)
+
+    for _ in range(2):
+        response = test_client.get('/login',
+                                   headers={'Accept-Encoding': 'gzip'})
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert b'Log in' in gzip.decompress(response.data)
+
+    assert len(cache) == cached + 1
+
+    # Static files are left to the front-end server
+    response = test_client.get('/static/css/blog.css',
+                               headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert 'Accept-Encoding' not in response.headers.get('Vary', '')
+    response.close()
+
+
+def test_fingerprinted_assets(test_client):
+    """
+    Tests that built static files are linked by fingerprinted URLs that are
+    cached forever.
+    :param test_client: flask test client
+    """
+    app = test_client.application
+
+    response = test_client.get('/static/css/blog.css')
+    assert 'immutable' not in response.headers.get('Cache-Control', '')
+    response.close()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['build-assets'])
+    assert result.exit_code == 0
+
+    try:
+        with app.test_request_context():
+            url = main.asset_url('css/blog.css')
+        assert url.startswith('/static/dist/css/blog.')
+
+        response = test_client.get(url)
+        assert response.status_code == 200
+        assert 'immutable' in response.headers['Cache-Control']
+        response.close()
+    finally:
+        app.extensions.pop('asset_manifest')
+        shutil.rmtree(os.path.join(app.static_folder, 'dist'))
+
+
+def test_precompile_templates(test_client):
+    """
+    Tests that precompiling fills the template cache.
+    :param test_client: flask test client
+    """
+    app = test_client.application
+    bytecode_cache = app.jinja_env.bytecode_cache
+    cache_dir = tempfile.mkdtemp()
+    app.jinja_env.bytecode_cache = \
+        main.FileSystemBytecodeCache(cache_dir)
+    app.jinja_env.cache.clear()
+
+    try:
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['precompile-templates'])
+        assert result.exit_code == 0
+        assert len(os.listdir(cache_dir)) == 6
+    finally:
+        app.jinja_env.bytecode_cache = bytecode_cache
+        shutil.rmtree(cache_dir)
+
+
+def test_create_app():
+    """
+    Tests that differently configured apps can run in one process, and that
+    importing main does not create one.
+    """
+    assert not hasattr(main, 'app')
+
+    db_fd1, database1 = tempfile.mkstemp()
+    db_fd2, database2 = tempfile.mkstemp()
+    app1 = main.create_app({'DATABASE': database1, 'TESTING': True})
+    app2 = main.create_app({'DATABASE': database2, 'TESTING': True})
+    assert app1.config['TEMPLATE_CACHE_DIR'].startswith(app1.instance_path)
+
+    for app in (app1, app2):
+        with app.app_context():
+            main.get_db().init_db()
+
+    app1.test_client().post('/api/accounts/',
+                            data={'username': 'htran20', 'password': 'haha'})
+
+    for app, count in ((app1, 1), (app2, 0)):
+        with app.app_context():
+            assert len(main.get_db().get_all_accounts()) == count
+
+    for db_fd, database in ((db_fd1, database1), (db_fd2, database2)):
+        main.BlogDB.close_watchers(database)
+        os.close(db_fd)
+        os.unlink(database)
+
+
+def test_post_batch(test_client):
+    """
+    Tests batch posting from the command-line interface.
+    :param test_client: flask test client
+    """
+    test_client.post('/api/accounts/',
+                     data={'username': 'htran20', 'password': 'haha1232'})
+
+    session = mock.Mock()
+    session.post.side_effect = lambda url, data, timeout: \
+        test_client.post(url[len('http://api'):], data=data)
+
+    lines = [
+        '{"title": "Avenger 4", "content": "Iron man still alive"}',
+        '',
+        '{"title": "Spiderman", "content": "Not Peter Parker anymore"}',
+        '{"blog_id": 99, "content": "This blog is nice"}',
+        '{"title": "Thor"',
+        '{"content": "Lost his hammer"}',
+        '["Hulk"]',
+    ]
+
+    with mock.patch.object(main, 'input', mock_input):
+        posted, failed = main.post_batch(session, 'http://api/api', 1,
+                                         lines, 2)
+
+    assert (posted, failed) == (2, 4)
+    assert session.post.call_count == 3
+
+    # Errors raised while posting fail the item, not the batch
+    session.post.side_effect = RuntimeError
+    posted, failed = main.post_batch(session, 'http://api/api', 1, lines, 2)
+    assert (posted, failed) == (0, 6)
+
+
+def test_blog_fields(test_client):
+    """
+    Tests GET of blogs with only some of their fields.
+    :param test_client: flask test client
+    """
+    account = {
+        'username': 'htran20',
+        'password': 'haha1232',
+    }
+    blog = {
+        'title': 'Avenger: Infiniy war',
+        'author_id': 1,
+        'content': 'Thanos destroys half the universe wiht one finger flick!',
+    }
+
+    test_client.post('/api/accounts/', data=account)
+
+    with mock.patch.object(main, 'input', mock_input):
+        test_client.post('/api/blogs/', data=blog)
+
+        response = test_client.get('/api/blogs/?fields=id,title,excerpt')
+        assert response.status_code == 200
+
+        response_json = json.loads(response.data)
+        assert response_json == [{
+            'id': 1,
+            'title': 'Avenger: Infiniy war',
+            'excerpt': 'Thanos destroys half the universe wiht one finger '
+                       'flick!',
+        }]
+
+        response = test_client.get('/api/accounts/?fields=id,password')
+        assert response.status_code == 422
+
+        response = test_client.get('/api/blogs/?fields=,')
+        assert response.status_code == 422
+
+
+def test_batch_get(test_client):
+    """
+    Tests GET of several rows by ID, and of a blog with its author and
+    comments.
+    :param test_client: flask test client
+    """
+    account = {
+        'username': 'htran20',
+        'password': 'haha1232',
+    }
+    blog = {
+        'title': 'Avenger: Infiniy war',
+        'author_id': 1,
+        'content': 'Thanos destroys half the universe wiht one finger flick!',
+    }
+    comment = {
+        'blog_id': 1,
+        'author_id': 1,
+        'content': 'LOL',
+    }
+
+    test_client.post('/api/accounts/', data=account)
+
+    with mock.patch.object(main, 'input', mock_input):
+        test_client.post('/api/blogs/', data=blog)
+        test_client.post('/api/blogs/', data=blog)
+        test_client.post('/api/comments/', data=comment)
+
+        response = test_client.get('/api/blogs/?ids=2,3&fields=id')
+        assert response.status_code == 200
+        assert json.loads(response.data) == [{'id': 2}]
+
+        response = test_client.get('/api/accounts/?ids=1')
+        assert json.loads(response.data) == [{'id': 1, 'username': 'htran20'}]
+
+        response = test_client.get('/api/comments/?ids=one')
+        assert response.status_code == 422
+
+        ids = ','.join(str(item) for item in range(1, 102))
+        response = test_client.get('/api/blogs/?ids=' + ids)
+        assert response.status_code == 422
+
+        response = test_client.get('/api/blogs/1?include=author,comments')
+        assert response.status_code == 200
+
+        response_json = json.loads(response.data)
+        assert response_json['author'] == {'id': 1, 'username': 'htran20'}
+        assert len(response_json['comments']) == 1
+        assert response_json['comments'][0]['content'] == 'LOL'
+        assert response_json['comments'][0]['username'] == 'htran20'
+
+        response = test_client.get('/api/blogs/1?include=likes')
+        assert response.status_code == 422
+
+
+def test_comment_reply(test_client):
+    """
+    Tests POST of a reply to a comment.
+    :param test_client: flask test client
+    """
+    account = {
+        'username': 'htran20',
+        'password': 'haha1232',
+    }
+    blog = {
+        'title': 'Avenger: Infiniy war',
+        'author_id': 1,
+        'content': 'Thanos destroys half the universe wiht one finger flick!',
+    }
+    comment = {
+        'blog_id': 1,
+        'author_id': 1,
+        'content': 'LOL',
+    }
+
+    test_client.post('/api/accounts/', data=account)
+
+    with mock.patch.object(main, 'input', mock_input):
+        test_client.post('/api/blogs/', data=blog)
+        test_client.post('/api/comments/', data=comment)
+
+        response = test_client.post('/api/comments/',
+                                    data=dict(comment, parent_id=1))
+        assert response.status_code == 200
+
+        response_json = json.loads(response.data)
+        assert response_json['parent_id'] == 1
+        assert response_json['path'] == '0000000001/0000000002/'
+
+        response = test_client.post('/api/comments/',
+                                    data=dict(comment, parent_id=5))
+        assert response.status_code == 404
+
+
+def test_follow(test_client):
+    """
+    Tests following an author from the browser and seeing their blogs in
+    the homepage's following feed.
+    :param test_client: flask test client
+    """
+    blog = {
+        'title': 'Avenger: Infiniy war',
+        'author_id': 1,
+        'content': 'Thanos destroys half the universe wiht one finger flick!',
+    }
+
+    test_client.post('/api/accounts/', data={'username': 'htran20',
+                                             'password': 'haha1232'})
+    test_client.post('/api/accounts/', data={'username': 'tdinh20',
+                                             'password': '123hai'})
+
+    with mock.patch.object(main, 'input', mock_input):
+        test_client.post('/api/blogs/', data=blog)
+
+    test_client.post('/login', data={'username': 'tdinh20',
+                                     'password': '123hai'})
+
+    response = test_client.get('/')
+    assert b'Avenger' not in response.data
+
+    response = test_client.post('/authors/1/follow')
+    assert response.status_code == 302
+
+    response = test_client.get('/')
+    assert b'Avenger' in response.data
+
+    test_client.post('/authors/1/follow', data={'action': 'unfollow'})
+
+    response = test_client.get('/')
+    assert b'Avenger' not in response.data
+
+    response = test_client.get('/?feed=all')
+    assert b'Avenger' in response.data
+
+    response = test_client.post('/authors/abc/follow',
+                                data={'action': 'unfollow'})
+    assert response.status_code == 404
+
+
+def test_blog_events(test_client):
+    """
+    Tests streaming the comments of a blog as Server-Sent Events, resuming
+    after the last event seen.
+    :param test_client: flask test client
+    """
+    app = test_client.application
+
+    blog = {
+        'title': 'Avenger: Infiniy war',
+        'author_id': 1,
+        'content': 'Thanos destroys half the universe wiht one finger flick!',
+    }
+    comment = {
+        'blog_id': 1,
+        'author_id': 1,
+        'content': 'LOL',
+    }
+
+    test_client.post('/api/accounts/', data={'username': 'htran20',
+                                             'password': 'haha1232'})
+
+    with mock.patch.object(main, 'input', mock_input):
+        test_client.post('/api/blogs/', data=blog)
+        test_client.post('/api/comments/', data=comment)
+        test_client.post('/api/comments/', data=dict(comment, content='Wow'))
+
+    test_client.post('/login', data={'username': 'htran20',
+                                     'password': 'haha1232'})
+
+    response = test_client.get('/blogs/1/events',
+                               headers={'Last-Event-ID': '1'})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+
+    stream = iter(response.response)
+    event = next(stream).decode()
+    assert event.startswith('id: 2\nevent: comment\ndata: ')
+    assert json.loads(event.split('data: ')[1])['content'] == 'Wow'
+
+    with mock.patch.object(main, 'input', mock_input):
+        test_client.post('/api/comments/', data=dict(comment, content='New'))
+
+    event = next(stream).decode()
+    assert event.startswith('id: 3\n')
+    assert json.loads(event.split('data: ')[1])['html'] == '<p>New</p>'
+
+    response.close()
+    with app.app_context():
+        assert main.get_events().count() == 0
+
+    response = test_client.get('/blogs/9/events')
+    assert response.status_code == 404
+
+
+def test_rate_limit():
+    """
+    Tests that writes over the rate limit get 429 with Retry-After, and
+    that reads are not limited.
+    """
+    db_fd, database = tempfile.mkstemp()
+    app = main.create_app({'DATABASE': database, 'TESTING': True,
+                           'RATE_LIMIT_PER_IP': (2, 0.01),
+                           'RATE_LIMIT_PER_ACCOUNT': None})
+    test_client = app.test_client()
+
+    with app.app_context():
+        main.get_db().init_db()
+
+    with mock.patch.object(main, 'input', mock_input):
+        for username in ('htran20', 'tdinh20'):
+            response = test_client.post('/api/accounts/',
+                                        data={'username': username,
+                                              'password': 'haha1232'})
+            assert response.status_code == 200
+
+        response = test_client.post('/api/accounts/',
+                                    data={'username': 'fli',
+                                          'password': 'lol'})
+        assert response.status_code == 429
+        assert 1 <= int(response.headers['Retry-After']) <= 101
+
+        response = test_client.get('/api/accounts/')
+        assert response.status_code == 200
+        assert len(json.loads(response.data)) == 2
+
+    main.BlogDB.close_watchers(database)
+    os.close(db_fd)
+    os.unlink(database)
+
+
+def test_account_rate_limit():
+    """
+    Tests that the account limit applies once the account is verified, so
+    requests naming someone else's account do not use up its bucket, and
+    that a request refused by the account limit gives its IP token back.
+    """
+    db_fd, database = tempfile.mkstemp()
+    app = main.create_app({'DATABASE': database, 'TESTING': True,
+                           'RATE_LIMIT_PER_IP': (3, 0.01),
+                           'RATE_LIMIT_PER_ACCOUNT': (1, 0.01)})
+    test_client = app.test_client()
+
+    with app.app_context():
+        main.get_db().init_db()
+        main.get_db().insert_account('htran20', 'haha1232')
+
+    def post_blog(author_id):
+        return test_client.post('/api/blogs/', data={'title': 'Title',
+                                                     'author_id': author_id,
+                                                     'content': 'Content'})
+
+    with mock.patch.object(main, 'input', lambda prompt: 'wrong'):
+        assert post_blog(1).status_code == 401
+
+    with mock.patch.object(main, 'input', mock_input):
+        assert post_blog(1).status_code == 200
+        assert post_blog(1).status_code == 429
+        assert app.extensions['rate_limits']['ip'].wait('127.0.0.1') == 0
+        assert post_blog(1).status_code == 429
+
+    main.BlogDB.close_watchers(database)
+    os.close(db_fd)
+    os.unlink(database)
+
+
+def test_token_buckets():
+    """
+    Tests that token buckets allow a burst, then refuse, and that only the
+    most recently used buckets are kept.
+    """
+    buckets = main.TokenBuckets(2, 0.5, 2)
+
+    assert buckets.take('a') == 0
+    assert buckets.take('a') == 0
+    assert 0 < buckets.take('a') <= 2
+
+    buckets.take('b')
+    buckets.take('c')
+    assert len(buckets) == 2
+
+    # The bucket of 'a' was forgotten so it is full again
+    assert buckets.take('a') == 0
+
+    assert buckets.wait('a') == 0
+    buckets.take('a')
+    assert buckets.wait('a') > 0
+    buckets.put_back('a')
+    assert buckets.wait('a') == 0
+
+
+def test_admission_limit():
+    """
+    Tests that requests over the limit wait for a turn, and are turned away
+    when the queue is full or the deadline passes.
+    """
+    limit = main.AdmissionLimit(1, 1, 5.0)
+    assert limit.acquire()
+
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(limit.acquire()))
+    waiter.start()
+    while limit.waiting == 0:
+        time.sleep(0.001)
+
+    # The only place in the queue is taken
+    assert not limit.acquire()
+
+    limit.release()
+    waiter.join()
+    assert results == [True]
+
+    limit.timeout = 0.01
+    assert not limit.acquire()
+
+
+def test_load_shedding():
+    """
+    Tests that writes get 503 while the write limit is full, without
+    holding up reads.
+    """
+    db_fd, database = tempfile.mkstemp()
+    app = main.create_app({'DATABASE': database, 'TESTING': True,
+                           'ADMISSION_WRITES': (1, 0)})
+    test_client = app.test_client()
+
+    with app.app_context():
+        main.get_db().init_db()
+        writes = main.get_admission_limits()['write']
+
+    writes.acquire()
+
+    response = test_client.post('/api/accounts/',
+                                data={'username': 'htran20',
+                                      'password': 'haha1232'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+    response = test_client.get('/api/accounts/')
+    assert response.status_code == 200
+
+    writes.release()
+
+    response = test_client.post('/api/accounts/',
+                                data={'username': 'htran20',
+                                      'password': 'haha1232'})
+    assert response.status_code == 200
+    assert writes.active == 0
+
+    main.BlogDB.close_watchers(database)
+    os.close(db_fd)
+    os.unlink(database)
+
+
+def test_job_counts(test_client):
+    """
+    Tests GET of the depth of the background job queue.
+    :param test_client: flask test client
+    """
+    with mock.patch.object(main, 'input', mock_input):
+        response = test_client.get('/api/jobs/')
+        assert response.status_code == 401
+
+        test_client.post('/api/accounts/', data={'username': 'htran20',
+                                                 'password': 'haha1232'})
+        response = test_client.get('/api/jobs/')
+    assert response.status_code == 200
+    assert set(json.loads(response.data)) == {'ready', 'scheduled',
+                                              'running', 'failed'}
+
+
+def test_author_pages(test_client):
+    """
+    Tests the navigation between pages of an author's blogs.
+    :param test_client: flask test client
+    """
+    app = test_client.application
+    app.config['AUTHOR_PAGE_SIZE'] = 2
+
+    test_client.post('/api/accounts/', data={'username': 'htran20',
+                                             'password': 'haha1232'})
+
+    with mock.patch.object(main, 'input', mock_input):
+        for i in range(5):
+            test_client.post('/api/blogs/', data={'title': 'Blog {}'.format(i),
+                                                  'author_id': 1,
+                                                  'content': 'Content'})
+
+    test_client.post('/login', data={'username': 'htran20',
+                                     'password': 'haha1232'})
+
+    try:
+        response = test_client.get('/authors/1')
+        assert b'Blog 4' in response.data and b'Blog 3' in response.data
+        assert b'Blog 2' not in response.data
+        assert b'?before=4' in response.data
+        assert b'?after=' not in response.data
+
+        response = test_client.get('/authors/1?before=4')
+        assert b'Blog 2' in response.data and b'Blog 1' in response.data
+        assert b'?after=3' in response.data
+        assert b'?before=2' in response.data
+
+        response = test_client.get('/authors/1?after=3')
+        assert b'Blog 4' in response.data and b'Blog 3' in response.data
+        assert b'?after=' not in response.data
+
+        response = test_client.get('/authors/9')
+        assert response.status_code == 404
+    finally:
+        app.config['AUTHOR_PAGE_SIZE'] = 10
+
+
+def test_author_menu(test_client):
+    """
+    Tests the pages of the author menu, listing authors with the most blogs
+    first.
+    :param test_client: flask test client
+    """
+    app = test_client.application
+    app.config['AUTHOR_MENU_SIZE'] = 1
+
+    for username in ('htran20', 'tdinh20'):
+        test_client.post('/api/accounts/', data={'username': username,
+                                                 'password': 'haha1232'})
+
+    with mock.patch.object(main, 'input', mock_input):
+        test_client.post('/api/blogs/', data={'title': 'Title',
+                                              'author_id': 1,
+                                              'content': 'Content'})
+
+    test_client.post('/login', data={'username': 'htran20',
+                                     'password': 'haha1232'})
+
+    try:
+        response = test_client.get('/authors/1')
+        assert b'htran20 (1)' in response.data
+        assert b'tdinh20 (0)' not in response.data
+        assert b'?authors_page=2' in response.data
+
+        response = test_client.get('/authors/1?authors_page=2')
+        assert b'tdinh20 (0)' in response.data
+        assert b'?authors_page=1' in response.data
+        assert b'?authors_page=3' not in response.data
+    finally:
+        app.config['AUTHOR_MENU_SIZE'] = 20